@@ -1 +1 @@
-from .expression import get_cells_expressing_genes
+from .expression import get_cells_expressing_genes, GeneIndex, write_gene_index
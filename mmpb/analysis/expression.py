@@ -1,13 +1,116 @@
+import os
+
 import numpy as np
 import pandas as pd
 
 
-def get_cells_expressing_genes(table_path, expression_threshold, gene_names):
-    if isinstance(gene_names, str):
-        gene_names = [gene_names]
-    if not isinstance(gene_names, list):
-        raise ValueError("Gene names must be a str or a list of strings")
+def gene_index_path(table_path):
+    """ Path of the gene index for the gene table.
+    """
+    return os.path.splitext(table_path)[0] + '_index.npz'
+
+
+def write_gene_index(table_path, index_path=None):
+    """ Write the inverted index of the gene table.
 
+    For each gene, the index stores the ids of the cells that express it and the expression
+    values, sorted by descending expression, so that the cells expressing a gene
+    above a threshold can be found without loading the table.
+
+    Arguments:
+        table_path [str] - path to the gene table
+        index_path [str] - path to the index, next to the table if None (default: None)
+    """
+    index_path = gene_index_path(table_path) if index_path is None else index_path
+    table = pd.read_csv(table_path, sep='\t')
+    label_ids = table['label_id'].values
+    gene_names = [name for name in table.columns if name != 'label_id']
+
+    offsets = np.zeros(len(gene_names) + 1, dtype='int64')
+    rows, values = [], []
+    for gene_id, name in enumerate(gene_names):
+        expression = table[name].values
+        gene_rows = np.where(expression > 0)[0]
+        gene_rows = gene_rows[np.argsort(-expression[gene_rows], kind='stable')]
+        rows.append(gene_rows)
+        values.append(expression[gene_rows])
+        offsets[gene_id + 1] = offsets[gene_id] + len(gene_rows)
+
+    # write to a temporary file and move it, so that the index is never read partially
+    tmp_path = index_path + '.tmp%i' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, label_ids=label_ids, gene_names=np.array(gene_names), offsets=offsets,
+                 rows=np.concatenate(rows) if rows else np.zeros(0, dtype='int64'),
+                 values=np.concatenate(values) if values else np.zeros(0, dtype='float64'))
+    os.replace(tmp_path, index_path)
+
+
+class GeneIndex:
+    """ Query the cells expressing combinations of genes with the inverted index of a gene table.
+
+    Arguments:
+        index_path [str] - path to the index written by 'write_gene_index'
+    """
+
+    def __init__(self, index_path):
+        with np.load(index_path) as f:
+            self.label_ids = f['label_ids']
+            self.gene_names = f['gene_names'].tolist()
+            self.offsets = f['offsets']
+            self.rows = f['rows']
+            self.values = f['values']
+        self.gene_ids = {name: gene_id for gene_id, name in enumerate(self.gene_names)}
+
+    @classmethod
+    def from_table(cls, table_path):
+        """ Load the index of the gene table, the index is (re-)built if it is missing or outdated.
+        """
+        index_path = gene_index_path(table_path)
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(table_path):
+            write_gene_index(table_path, index_path)
+        return cls(index_path)
+
+    def expressing(self, gene_name, expression_threshold=0.):
+        """ Mask over the cells that express the gene above the threshold.
+        """
+        if gene_name not in self.gene_ids:
+            raise RuntimeError("Could not find gene name %s in the gene index" % gene_name)
+        mask = np.zeros(len(self.label_ids), dtype='bool')
+        if expression_threshold < 0:
+            mask[:] = True
+        gene_id = self.gene_ids[gene_name]
+        start, stop = self.offsets[gene_id], self.offsets[gene_id + 1]
+        # the values are sorted in descending order, so the cells above the threshold are a prefix
+        n_above = np.searchsorted(-self.values[start:stop], -expression_threshold, side='left')
+        mask[self.rows[start:start + n_above]] = True
+        return mask
+
+    def query(self, expressed, not_expressed=(), expression_threshold=0.):
+        """ Get the ids of the cells that express all genes in expressed and none in not_expressed.
+
+        Arguments:
+            expressed [listlike or dict] - names of the genes that must be expressed,
+                can be a dict of names to thresholds for gene specific thresholds
+            not_expressed [listlike or dict] - names of the genes that must not be expressed,
+                can be a dict of names to thresholds for gene specific thresholds (default: ())
+            expression_threshold [float] - threshold for the genes without specific threshold (default: 0.)
+        """
+        def _thresholds(names):
+            if isinstance(names, str):
+                names = [names]
+            if isinstance(names, dict):
+                return names.items()
+            return [(name, expression_threshold) for name in names]
+
+        mask = np.ones(len(self.label_ids), dtype='bool')
+        for name, threshold in _thresholds(expressed):
+            mask &= self.expressing(name, threshold)
+        for name, threshold in _thresholds(not_expressed):
+            mask &= ~self.expressing(name, threshold)
+        return self.label_ids[mask]
+
+
+def _cells_from_table(table_path, expression_threshold, gene_names):
     table = pd.read_csv(table_path, sep='\t')
     label_ids = table['label_id']
 
@@ -23,3 +126,21 @@ def get_cells_expressing_genes(table_path, expression_threshold, gene_names):
     # get ids of columns expressing all genes
     label_ids = label_ids[expressing].values
     return label_ids
+
+
+def get_cells_expressing_genes(table_path, expression_threshold, gene_names):
+    if isinstance(gene_names, str):
+        gene_names = [gene_names]
+    if not isinstance(gene_names, list):
+        raise ValueError("Gene names must be a str or a list of strings")
+
+    # use the gene index if it is available and up-to-date, otherwise fall back to the table
+    index_path = gene_index_path(table_path)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(table_path):
+        index = GeneIndex(index_path)
+        unmatched = set(gene_names) - set(index.gene_names)
+        if len(unmatched) > 0:
+            raise RuntimeError("Could not find gene names %s in table %s" % (", ".join(unmatched),
+                                                                             table_path))
+        return index.query(gene_names, expression_threshold=expression_threshold)
+    return _cells_from_table(table_path, expression_threshold, gene_names)
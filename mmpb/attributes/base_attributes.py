@@ -1,17 +1,24 @@
 import os
 import json
+import multiprocessing
+from concurrent import futures
+
 import numpy as np
 import pandas as pd
 from elf.io import open_file
 from pybdv.util import get_key
+from scipy.ndimage.morphology import distance_transform_edt
 
 import luigi
-import nifty.tools as nt
 from cluster_tools.morphology import MorphologyWorkflow
 from cluster_tools.morphology import RegionCentersWorkflow
 from .util import write_csv
 from ..default_config import write_default_global_config
-from ..util import is_h5_file
+from ..util import is_h5_file, load_id_lut, lut_index
+
+# the methods for computing the anchors: only correct the anchors that are
+# outside of their object, or compute region centers for all objects
+ANCHOR_METHODS = ('outliers', 'region_centers')
 
 
 def n5_attributes(input_path, input_key, tmp_folder, target, max_jobs):
@@ -32,22 +39,23 @@ def n5_attributes(input_path, input_key, tmp_folder, target, max_jobs):
     return out_path, out_key
 
 
-# set the anchor to region center (= maximum of boundary distance transform
-# inside the object) instead of com
-def run_correction(input_path, input_key,
-                   tmp_folder, target, max_jobs):
-    task = RegionCentersWorkflow
-    config_folder = os.path.join(tmp_folder, 'configs')
+def _next_scale_key(scale_key, is_h5):
+    try:
+        scale = int(scale_key.split('/')[2]) + 1
+    except ValueError:
+        scale = int(scale_key.split('/')[-1][1:]) + 1
+    return get_key(is_h5, time_point=0, setup_id=0, scale=scale)
 
-    out_path = os.path.join(tmp_folder, 'data.n5')
-    out_key = 'region_centers'
 
-    # FIXME anchor correction still takes very long at this scale,
-    # maybe should switch to s5
-    # we need to run this at a lower scale, as a heuristic,
-    # we take the first scale with all dimensions < 1750 pix
-    # (corresponds to scale 4 in sbem)
-    max_dim_size = 1750
+def _scale_factor(f, input_key, scale_key):
+    shape1 = f[input_key].shape
+    shape2 = f[scale_key].shape
+    return np.array([float(sh1) / sh2 for sh1, sh2 in zip(shape1, shape2)])
+
+
+def get_scale_key(input_path, input_key, max_dim_size):
+    """ Get the key of the first scale with all dimensions <= max_dim_size.
+    """
     scale_key = input_key
     is_h5 = is_h5_file(input_path)
     with open_file(input_path, 'r') as f:
@@ -56,19 +64,46 @@ def run_correction(input_path, input_key,
             if all(sh <= max_dim_size for sh in shape):
                 break
 
-            try:
-                scale = int(scale_key.split('/')[2]) + 1
-            except ValueError:
-                scale = int(scale_key.split('/')[-1][1:]) + 1
-            next_scale_key = get_key(is_h5, time_point=0, setup_id=0, scale=scale)
+            next_scale_key = _next_scale_key(scale_key, is_h5)
             if next_scale_key not in f:
                 break
             scale_key = next_scale_key
+        scale_factor = _scale_factor(f, input_key, scale_key)
+    return scale_key, scale_factor
 
+
+def get_scale_keys(input_path, input_key, max_dim_size):
+    """ Get the keys and scale factors of the first scale with all dimensions <= max_dim_size
+    and of all coarser scales.
+    """
+    scale_key, scale_factor = get_scale_key(input_path, input_key, max_dim_size)
+    scales = [(scale_key, scale_factor)]
+    is_h5 = is_h5_file(input_path)
     with open_file(input_path, 'r') as f:
-        shape1 = f[input_key].shape
-        shape2 = f[scale_key].shape
-    scale_factor = np.array([float(sh1) / sh2 for sh1, sh2 in zip(shape1, shape2)])
+        while True:
+            scale_key = _next_scale_key(scale_key, is_h5)
+            if scale_key not in f:
+                break
+            scales.append((scale_key, _scale_factor(f, input_key, scale_key)))
+    return scales
+
+
+# set the anchor to region center (= maximum of boundary distance transform
+# inside the object) instead of com
+def run_correction(input_path, input_key,
+                   tmp_folder, target, max_jobs):
+    task = RegionCentersWorkflow
+    config_folder = os.path.join(tmp_folder, 'configs')
+
+    out_path = os.path.join(tmp_folder, 'data.n5')
+    out_key = 'region_centers'
+
+    # FIXME anchor correction still takes very long at this scale,
+    # maybe should switch to s5
+    # we need to run this at a lower scale, as a heuristic,
+    # we take the first scale with all dimensions < 1750 pix
+    # (corresponds to scale 4 in sbem)
+    scale_key, scale_factor = get_scale_key(input_path, input_key, max_dim_size=1750)
 
     config = task.get_config()['region_centers']
     config.update({'time_limit': 180, 'mem_limit': 32})
@@ -90,6 +125,119 @@ def run_correction(input_path, input_key,
     return anchors
 
 
+def values_at_points(ds, points, n_threads):
+    """ Read the values of the dataset at the points, loading each chunk only once.
+    """
+    # a dataset without chunks is read at once
+    chunks = np.array(ds.shape if ds.chunks is None else ds.chunks)
+    values = np.zeros(len(points), dtype=ds.dtype)
+    if len(points) == 0:
+        return values
+
+    # group the points by the chunk they are in
+    chunk_ids = points // chunks
+    unique_chunks, inverse = np.unique(chunk_ids, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    point_order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse, minlength=len(unique_chunks)))[:-1]
+    points_per_chunk = np.split(point_order, splits)
+
+    def read_chunk(chunk_index):
+        chunk_begin = unique_chunks[chunk_index] * chunks
+        bb = tuple(slice(int(beg), int(min(beg + ch, sh)))
+                   for beg, ch, sh in zip(chunk_begin, chunks, ds.shape))
+        data = ds[bb]
+        point_ids = points_per_chunk[chunk_index]
+        values[point_ids] = data[tuple((points[point_ids] - chunk_begin).T)]
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(read_chunk, chunk_index) for chunk_index in range(len(unique_chunks))]
+        [t.result() for t in tasks]
+    return values
+
+
+def region_center(ds, label_id, bb, sampling):
+    """ Compute the region center (maximum of the boundary distance transform)
+    of the object in the bounding box.
+    """
+    mask = ds[bb] == label_id
+    if not mask.any():
+        return None
+    # pad the mask, so that the bounding box border counts as boundary
+    dist = distance_transform_edt(np.pad(mask, 1), sampling=sampling)[1:-1, 1:-1, 1:-1]
+    center = np.unravel_index(np.argmax(dist), dist.shape)
+    return [c + b.start for c, b in zip(center, bb)]
+
+
+def _bounding_box(attributes, object_id, scale_factor, shape):
+    bb_min = np.floor((attributes[object_id, 5:8] + 0.5) / scale_factor).astype('int64')
+    bb_max = np.floor((attributes[object_id, 8:11] + 0.5) / scale_factor).astype('int64') + 1
+    return tuple(slice(int(max(mi, 0)), int(min(ma, sh)))
+                 for mi, ma, sh in zip(bb_min, bb_max, shape))
+
+
+def correct_anchors_for_outliers(input_path, input_key, attributes, resolution,
+                                 n_threads=None, max_dim_size=3500, max_bb_voxels=256**3):
+    """ Correct the anchors of objects whose center of mass is not inside the object.
+
+    The center of mass is kept as anchor if it is inside the object. Otherwise, the anchor
+    is set to the region center of the object, which is computed in the object's bounding box
+    at the first scale with all dimensions <= max_dim_size. For large objects, whose bounding box
+    has more than max_bb_voxels at this scale, the first coarser scale with a small enough bounding box
+    is used. This bounds the memory per thread. The objects are processed in parallel.
+
+    Arguments:
+        input_path [str] - path to the segmentation
+        input_key [str] - key of the segmentation
+        attributes [np.ndarray] - base attributes computed by 'n5_attributes'
+        resolution [listlike] - resolution of the segmentation in micron
+        n_threads [int] - number of threads, all cores if None (default: None)
+        max_dim_size [int] - maximal dimension size of the scale used for the correction (default: 3500)
+        max_bb_voxels [int] - maximal number of voxels in the bounding box of an object,
+            larger objects are corrected at a coarser scale (default: 256**3)
+    Returns:
+        np.ndarray - the anchors in pixel coordinates of the segmentation
+    """
+    n_threads = multiprocessing.cpu_count() if n_threads is None else n_threads
+    scales = get_scale_keys(input_path, input_key, max_dim_size)
+
+    anchors = attributes[:, 2:5].copy()
+    # skip the background and labels that are not in the segmentation
+    object_ids = np.where(np.logical_and(attributes[:, 0] != 0, attributes[:, 1] > 0))[0]
+
+    with open_file(input_path, 'r') as f:
+        datasets = [f[scale_key] for scale_key, _ in scales]
+        ds, scale_factor = datasets[0], scales[0][1]
+        shape = np.array(ds.shape)
+
+        # check which of the centers of mass are inside of their object
+        # (a pixel at coordinate c covers the interval [c - 0.5, c + 0.5])
+        com = np.floor((anchors[object_ids] + 0.5) / scale_factor).astype('int64')
+        com = np.clip(com, 0, shape - 1)
+        com_labels = values_at_points(ds, com, n_threads)
+        outliers = object_ids[com_labels != attributes[object_ids, 0]]
+        print("Correcting anchors for", len(outliers), "of", len(object_ids), "objects")
+
+        def correct_anchor(object_id):
+            # find the first scale at which the bounding box of the object is small enough
+            for scale_id, (ds, (_, scale_factor)) in enumerate(zip(datasets, scales)):
+                bb = _bounding_box(attributes, object_id, scale_factor, ds.shape)
+                n_voxels = np.prod([b.stop - b.start for b in bb])
+                if n_voxels <= max_bb_voxels:
+                    break
+            sampling = np.array(resolution) * scale_factor
+            center = region_center(ds, attributes[object_id, 0], bb, sampling)
+            # the object might vanish at the lower scale, then we keep the center of mass
+            if center is not None:
+                anchors[object_id] = (np.array(center) + 0.5) * scale_factor - 0.5
+
+        with futures.ThreadPoolExecutor(n_threads) as tp:
+            tasks = [tp.submit(correct_anchor, object_id) for object_id in outliers]
+            [t.result() for t in tasks]
+
+    return anchors
+
+
 def to_csv(input_path, input_key, output_path, resolution,
            anchors=None):
     # load the attributes from n5
@@ -141,7 +289,9 @@ def to_csv(input_path, input_key, output_path, resolution,
 
 
 def base_attributes(input_path, input_key, output_path, resolution,
-                    tmp_folder, target, max_jobs, correct_anchors=True):
+                    tmp_folder, target, max_jobs, correct_anchors=True,
+                    anchor_method='outliers', n_threads=8, max_dim_size=3500,
+                    max_bb_voxels=256**3):
 
     # prepare cluster tools tasks
     write_default_global_config(os.path.join(tmp_folder, 'configs'))
@@ -151,7 +301,14 @@ def base_attributes(input_path, input_key, output_path, resolution,
                                       tmp_folder, target, max_jobs)
 
     # correct anchor positions
-    if correct_anchors:
+    assert anchor_method in ANCHOR_METHODS, anchor_method
+    if correct_anchors and anchor_method == 'outliers':
+        with open_file(tmp_path, 'r') as f:
+            attributes = f[tmp_key][:]
+        anchors = correct_anchors_for_outliers(input_path, input_key, attributes, resolution,
+                                               n_threads=n_threads, max_dim_size=max_dim_size,
+                                               max_bb_voxels=max_bb_voxels)
+    elif correct_anchors:
         anchors = run_correction(input_path, input_key,
                                  tmp_folder, target, max_jobs)
     else:
@@ -166,10 +323,7 @@ def base_attributes(input_path, input_key, output_path, resolution,
     return label_ids
 
 
-def propagate_attributes(id_mapping_path, table_path, output_path,
-                         column_name, merge_rule=None, override=False):
-    """ Propagate id column to new ids.
-    """
+def _prepare_output(output_path, override):
     # if the output already exists, we assume that the propagation
     # was already done and we just continue
     if os.path.exists(output_path) and override:
@@ -177,62 +331,76 @@ def propagate_attributes(id_mapping_path, table_path, output_path,
             os.unlink(output_path)
         else:
             os.remove(output_path)
-    elif os.path.exists(output_path) and not override:
+        return True
+    return not os.path.exists(output_path)
+
+
+def _dropped_ids(old_ids, new_ids, mapping_counts):
+    # find the previous ids that are merged into the same new id;
+    # we keep the one with the largest mapped count and drop the others
+    order = np.lexsort((old_ids, mapping_counts, new_ids))
+    sorted_new_ids = new_ids[order]
+    # the last id in each group of new ids has the largest count
+    is_last = np.ones(len(order), dtype='bool')
+    is_last[:-1] = sorted_new_ids[:-1] != sorted_new_ids[1:]
+    # ids mapped to 0 are not merged
+    drop = np.logical_and(~is_last, sorted_new_ids != 0)
+    return old_ids[order[drop]]
+
+
+def propagate_tables(id_mapping_path, tables, merge_rule=None, override=False):
+    """ Propagate the id columns of multiple tables to new ids.
+
+    The id look-up table is loaded once and the id columns of all tables are mapped together.
+
+    Arguments:
+        id_mapping_path [str] - path to the id look-up table
+        tables [list[tuple]] - list of (table_path, output_path, column_name)
+        merge_rule - currently unused (default: None)
+        override [bool] - whether to override existing outputs (default: False)
+    """
+    tables = [(table_path, output_path, column_name)
+              for table_path, output_path, column_name in tables
+              if _prepare_output(output_path, override)]
+    if len(tables) == 0:
         return
 
-    with open(id_mapping_path, 'r') as f:
-        id_mapping = json.load(f)
-
-    # we have two different versions of the id mapping:
-    # the old one that only saves the mapped ids
-    # and the new one that also saves the mapped counts
-    # in the second case, we use the counts to decide the labeling for
-    # mapping ids that result from several merged previous ids
-    id_mapping = {int(k): v for k, v in id_mapping.items()}
-    if isinstance(id_mapping[0], list):
-        mapping_counts = np.array([v[1] for v in id_mapping.values()])
-        id_mapping = {k: v[0] for k, v in id_mapping.items()}
-    else:
-        mapping_counts = None
+    old_ids, new_ids, mapping_counts = load_id_lut(id_mapping_path)
+
+    loaded_tables, id_cols = [], []
+    for table_path, _, column_name in tables:
+        assert os.path.exists(table_path), table_path
+        table = pd.read_csv(table_path, sep='\t')
+        loaded_tables.append(table)
+        id_cols.append(table[column_name].fillna(0).values.astype('uint32'))
 
-    assert os.path.exists(table_path), table_path
-    table = pd.read_csv(table_path, sep='\t')
-    id_col = table[column_name].values
-    id_col[np.isnan(id_col)] = 0
-    id_col = id_col.astype('uint32')
+    # map the id columns of all tables at once
+    table_sizes = [len(id_col) for id_col in id_cols]
+    id_col = np.concatenate(id_cols)
+    index = lut_index(old_ids, id_col)
+    mapped = new_ids[index].astype('uint32')
 
     # use mapping counts to decide the mapped ids for merges
-    if mapping_counts is not None:
+    if mapping_counts is None:
+        keep_mask = np.ones(len(id_col), dtype='bool')
+    else:
+        keep_mask = ~np.isin(id_col, _dropped_ids(old_ids, new_ids, mapping_counts))
 
-        mapping_keys = np.array([int(key) for key in id_mapping.keys()])
-        mapping_values = np.array([int(val) for val in id_mapping.values()])
-        unique_vals, val_counts = np.unique(mapping_values, return_counts=True)
-        merged_ids = unique_vals[val_counts > 1]
-        if merged_ids[0] == 0:
-            merged_ids = merged_ids[1:]
+    offsets = np.cumsum([0] + table_sizes)
+    for (_, output_path, column_name), table, begin, end in zip(tables, loaded_tables,
+                                                                offsets[:-1], offsets[1:]):
+        table_keep = keep_mask[begin:end]
+        table = table[table_keep].reset_index(drop=True)
+        table[column_name] = mapped[begin:end][table_keep]
+        table.to_csv(output_path, index=False, sep='\t')
 
-        # this could be sped up with np.unique tricks, but I don't expect there to be many merged ids
-        # between versions, so this should not matter for now
-        keep_mask = np.ones(len(id_col), dtype='bool')
-        for merged_id in merged_ids:
-            id_mask = mapping_values == merged_id
-            source_ids = mapping_keys[id_mask]
-            ids_sorted = np.argsort(mapping_counts[id_mask])[::-1]
-            drop_ids = source_ids[ids_sorted[1:]]
-            keep_mask[np.isin(id_col, drop_ids)] = False
-
-        columns = table.columns
-        table = table.values
-        table = table[keep_mask]
-        table = pd.DataFrame(table, columns=columns)
-        id_col = id_col[keep_mask]
-        assert len(table) == len(id_col)
-
-    # map values for the id col
-    id_col = nt.takeDict(id_mapping, id_col)
-    table[column_name] = id_col
-
-    table.to_csv(output_path, index=False, sep='\t')
+
+def propagate_attributes(id_mapping_path, table_path, output_path,
+                         column_name, merge_rule=None, override=False):
+    """ Propagate id column to new ids.
+    """
+    propagate_tables(id_mapping_path, [(table_path, output_path, column_name)],
+                     merge_rule=merge_rule, override=override)
 
 
 # Do we need to extend the cell criterion? Possibilties:
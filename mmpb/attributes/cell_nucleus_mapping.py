@@ -1,21 +1,49 @@
 import numpy as np
 from elf.io import open_file
-from .util import write_csv, node_labels
+from .util import write_csv, region_overlaps, OverlapMatrix
 
 
-def overlaps_to_ids(overlaps, overlap_threshold):
-    # normalize the overlaps
-    overlap_counts = {label_id: float(sum(ovlps.values())) for label_id, ovlps in overlaps.items()}
-    # return all overlaps that are consistent with the overlap threshold
-    overlaps = {label_id: [ovlp_id for ovlp_id, ovlp in ovlps.items()
-                           if ((ovlp / overlap_counts[label_id]) > overlap_threshold) and (ovlp_id != 0)]
-                for label_id, ovlps in overlaps.items()}
-    return overlaps
+def _lookup(labels, ids):
+    # look up the labels for ids, ids that are out of range are mapped to 0
+    ids = np.asarray(ids, dtype='int64')
+    valid = ids < len(labels)
+    result = np.zeros(len(ids), dtype='int64')
+    result[valid] = labels[ids[valid]]
+    return result
+
+
+def overlaps_to_nucleus_ids(overlaps, label_ids, overlap_threshold):
+    """ Map cell ids to nucleus ids based on the overlaps of cells (rows) with nuclei (columns).
+
+    A cell is mapped to a nucleus if this nucleus is the only one that covers more than
+    overlap_threshold of the cell and the cell is the only one that covers more than
+    overlap_threshold of the nucleus. All other cells are mapped to 0.
+    """
+    # only keep cell ids that have overlap with a single nucleus
+    cids_to_nids = overlaps.unique_overlap(overlap_threshold, ignore_label=0)
+
+    # only keep nucleus ids that have overlap with a single cell
+    nids_to_cids = overlaps.transpose().unique_overlap(overlap_threshold, ignore_label=0)
+
+    # the background of the cells and the nuclei is not mapped
+    cids_to_nids[:1] = 0
+    nids_to_cids[:1] = 0
+
+    # only keep cell ids for which overlap-ids agree
+    cell_ids = np.arange(len(cids_to_nids), dtype='uint64')
+    agree = _lookup(nids_to_cids, cids_to_nids) == cell_ids
+    cids_to_nids[~agree] = 0
+
+    return _lookup(cids_to_nids, label_ids)
 
 
 def map_cells_to_nuclei(label_ids, seg_path, nuc_path, out_path,
                         tmp_folder, target, max_jobs,
                         overlap_threshold=.25):
+    """ Write the table that maps cells to nuclei.
+
+    Returns a dict that maps the name of the overlap result to whether it was loaded from the cache.
+    """
 
     # choose the keys of the same size
     if seg_path.endswith('.n5'):
@@ -32,34 +60,14 @@ def map_cells_to_nuclei(label_ids, seg_path, nuc_path, out_path,
         shape2 = f[nuc_key].shape
     assert shape1 == shape2
 
-    # compute the pixel-wise overlap of cells with nuclei
-    cids_to_nids = node_labels(seg_path, seg_key,
-                               nuc_path, nuc_key, prefix='nuc_to_cells',
-                               tmp_folder=tmp_folder, target=target, max_jobs=max_jobs,
-                               max_overlap=False, ignore_label=0)
-    cids_to_nids = overlaps_to_ids(cids_to_nids, overlap_threshold)
-
-    # compute the pixel-wise overlap of nuclei with cells
-    nids_to_cids = node_labels(nuc_path, nuc_key,
-                               seg_path, seg_key, prefix='cells_to_nuc',
-                               tmp_folder=tmp_folder, target=target, max_jobs=max_jobs,
-                               max_overlap=False, ignore_label=0)
-    nids_to_cids = overlaps_to_ids(nids_to_cids, overlap_threshold)
-
-    # only keep cell ids that have overlap with a single nucleus
-    cids_to_nids = {label_id: ovlp_ids[0] for label_id, ovlp_ids in cids_to_nids.items()
-                    if len(ovlp_ids) == 1}
-
-    # only keep nucleus ids that have overlap with a single cell
-    nids_to_cids = {label_id: ovlp_ids[0] for label_id, ovlp_ids in nids_to_cids.items()
-                    if len(ovlp_ids) == 1}
-
-    # only keep cell ids for which overlap-ids agree
-    cids_to_nids = {label_id: ovlp_id for label_id, ovlp_id in cids_to_nids.items()
-                    if nids_to_cids.get(ovlp_id, 0) == label_id}
-
-    data = np.array([cids_to_nids.get(label_id, 0) for label_id in label_ids])
+    # compute the joint contingency table of cells and nuclei in a single pass
+    # over both segmentations, it contains the overlaps in both directions
+    overlaps, cache_hits = region_overlaps(seg_path, seg_key, [nuc_path], [nuc_key], 'cells_and_nuclei',
+                                           tmp_folder, target, max_jobs, return_cache_hits=True)
+    overlaps = OverlapMatrix.from_pairs(*overlaps[0])
+    data = overlaps_to_nucleus_ids(overlaps, label_ids, overlap_threshold)
 
     col_names = ['label_id', 'nucleus_id']
     data = np.concatenate([label_ids[:, None], data[:, None]], axis=1)
     write_csv(out_path, data, col_names)
+    return cache_hits
@@ -2,9 +2,10 @@ from concurrent import futures
 import numpy as np
 import h5py
 import pandas as pd
-import nifty
 from elf.skeleton import skeletonize
 from scipy.ndimage import distance_transform_edt
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
 
 
 def get_mapped_cell_ids(cilia_ids, manual_mapping_table_path):
@@ -23,50 +24,93 @@ def make_indexable(path):
     return tuple(np.array([p[i] for p in path], dtype='uint64') for i in range(3))
 
 
-def compute_centerline(obj, resolution):
-    """ Compute the centerline path and its length
-        by computing the 3d skeleton via thinning and extracting
-        the longest path between terminals
+def _path_from_predecessors(predecessors, target):
+    path = [target]
+    while predecessors[path[-1]] >= 0:
+        path.append(predecessors[path[-1]])
+    return np.array(path[::-1])
+
+
+def _longest_path_terminals(graph, terminals):
+    # compute length between all terminals and find the longest path,
+    # this is quadratic in the number of terminals and only used for skeletons with cycles
+    distances, predecessors = dijkstra(graph, directed=False, indices=terminals,
+                                       return_predecessors=True)
+    terminal_distances = distances[:, terminals]
+    terminal_distances[np.isinf(terminal_distances)] = 0.
+    source, target = np.unravel_index(np.argmax(terminal_distances), terminal_distances.shape)
+    if terminal_distances[source, target] == 0:
+        raise ValueError("Did not find path between terminals.")
+    return _path_from_predecessors(predecessors[source], terminals[target])
+
+
+def _longest_path_forest(graph):
+    # find the longest path in each tree with two sweeps:
+    # the node furthest away from any node is an end point of the longest path and the
+    # node furthest away from it is the other end point.
+    # each sweep is done for all trees at once, because they are not connected
+    _, component_labels = connected_components(graph, directed=False)
+    _, roots = np.unique(component_labels, return_index=True)
+    distances = dijkstra(graph, directed=False, indices=roots, min_only=True)
+    # find the furthest node for each tree
+    order = np.lexsort((-distances, component_labels))
+    is_first = np.ones(len(order), dtype='bool')
+    is_first[1:] = component_labels[order][1:] != component_labels[order][:-1]
+    starts = order[is_first]
+
+    distances, predecessors, _ = dijkstra(graph, directed=False, indices=starts, min_only=True,
+                                          return_predecessors=True)
+    return _path_from_predecessors(predecessors, np.argmax(distances))
+
+
+def longest_path(nodes, edges, resolution):
+    """ Find the longest shortest path between terminals of the skeleton graph.
+
+    Arguments:
+        nodes [np.ndarray] - coordinates of the skeleton nodes
+        edges [np.ndarray] - edges of the skeleton graph
+        resolution [listlike] - resolution of the coordinates
+    Returns:
+        np.ndarray - nodes of the path
+        float - length of the path
     """
-    # compute skeleton and graph from skeleton
-    nodes, edges = skeletonize(obj)
-    graph = nifty.graph.undirectedGraph(len(nodes))
-    graph.insertEdges(edges)
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    n_nodes = len(nodes)
 
     # compute the length of the edges
     physical_coords = nodes.astype('float32') * np.array(list(resolution))
     edge_lens = physical_coords[edges[:, 0]] - physical_coords[edges[:, 1]]
     edge_lens = np.linalg.norm(edge_lens, axis=1)
     assert edge_lens.shape == (len(edges),), str(edge_lens.shape)
+    graph = csr_matrix((edge_lens, (edges[:, 0], edges[:, 1])), shape=(n_nodes, n_nodes))
 
     # compute the degrees and derive the terminals
-    degrees = np.array([len([adj for adj in graph.nodeAdjacency(u)])
-                       for u in range(graph.numberOfNodes)])
+    degrees = np.bincount(edges.ravel(), minlength=n_nodes)
     terminals = np.where(degrees == 1)[0]
     if len(terminals) < 2:
         raise ValueError("Did not find terminals.")
 
-    # compute length between all terminals and find the longest path
-    t0, t1 = None, None
-    max_plen = 0.
-    sp = nifty.graph.ShortestPathDijkstra(graph)
-    for ii, t in enumerate(terminals[:-1]):
-        targets = terminals[ii+1:]
-        paths = sp.runSingleSourceMultiTarget(edge_lens, t, targets,
-                                              returnNodes=False)
-        for target, p in zip(targets, paths):
-            # paths can be empty, not sure why
-            if not p:
-                continue
-            plen = edge_lens[np.array(p)].sum()
-            if plen > max_plen:
-                t0, t1 = t, target
-                max_plen = plen
-
-    path = sp.runSingleSourceSingleTarget(edge_lens, t0, t1,
-                                          returnNodes=True)
-    coordinates = make_indexable(nodes[np.array(path)])
-    return coordinates, max_plen
+    # the two sweeps only find the longest path if the skeleton does not contain cycles
+    n_components, _ = connected_components(graph, directed=False)
+    if len(edges) == n_nodes - n_components:
+        path = _longest_path_forest(graph)
+    else:
+        path = _longest_path_terminals(graph, terminals)
+
+    path_lens = np.linalg.norm(physical_coords[path[1:]] - physical_coords[path[:-1]], axis=1)
+    return path, path_lens.sum()
+
+
+def compute_centerline(obj, resolution):
+    """ Compute the centerline path and its length
+        by computing the 3d skeleton via thinning and extracting
+        the longest path between terminals
+    """
+    # compute skeleton and graph from skeleton
+    nodes, edges = skeletonize(obj)
+    path, path_len = longest_path(nodes, edges, resolution)
+    coordinates = make_indexable(nodes[path])
+    return coordinates, path_len
 
 
 def get_bb(base_table, cid, resolution, shape):
@@ -1,6 +1,8 @@
 import os
 import json
+from concurrent import futures
 from glob import glob
+from threading import Lock
 
 import luigi
 import numpy as np
@@ -11,10 +13,17 @@ from pybdv.metadata import get_data_path
 
 from ..extension.attributes import GenesLocal, GenesSlurm
 from ..extension.attributes import VCAssignmentsLocal, VCAssignmentsSlurm
+from ..extension.attributes.genes_impl import open_genes
+from ..analysis.expression import write_gene_index
 
 
 def gene_assignment_table(segm_file, genes_file, table_file, labels,
-                          tmp_folder, target, n_threads=8):
+                          tmp_folder, target, n_threads=8, max_gene_memory=8):
+    """ Write the table with the gene expression of all cells.
+
+    max_gene_memory is the memory used for the genes loaded at once in GB,
+    all genes are loaded at once if it is None (default: 8).
+    """
     task = GenesSlurm if target == 'slurm' else GenesLocal
     if os.path.splitext(segm_file)[1] == '.n5':
         seg_dset = 'setup0/timepoint0/s4'
@@ -23,8 +32,11 @@ def gene_assignment_table(segm_file, genes_file, table_file, labels,
 
     config_folder = os.path.join(tmp_folder, 'configs')
     config = task.default_task_config()
-    # this is very ram hungry because we load all the genes at once
-    config.update({'threads_per_job': n_threads, 'mem_limit': 128})
+    # the genes are streamed in chunks of max_gene_memory, we need additional memory
+    # for the segmentation and the result table
+    mem_limit = 128 if max_gene_memory is None else int(max_gene_memory) + 16
+    config.update({'threads_per_job': n_threads, 'mem_limit': mem_limit,
+                   'max_gene_memory': max_gene_memory})
     with open(os.path.join(config_folder, 'genes.config'), 'w') as f:
         json.dump(config, f)
 
@@ -40,6 +52,9 @@ def gene_assignment_table(segm_file, genes_file, table_file, labels,
     if not ret:
         raise RuntimeError("Computing gene expressions failed")
 
+    # rebuild the index for gene expression queries
+    write_gene_index(table_file)
+
 
 def vc_assignment_table(seg_path, vc_vol_path, vc_vol_key,
                         vc_expression_path, med_expression_path, output_path,
@@ -68,7 +83,59 @@ def vc_assignment_table(seg_path, vc_vol_path, vc_vol_key,
         raise RuntimeError("Computing gene expressions failed")
 
 
-def create_auxiliary_gene_file(meds_root, out_file, return_result=False):
+def _load_med(med_file, spatial_shape, n_threads=8):
+    is_h5 = os.path.splitext(med_file)[1] == '.h5'
+    med_key = get_key(is_h5, time_point=0, setup_id=0, scale=0)
+    with open_file(med_file, 'r') as f:
+        ds = f[med_key]
+        this_shape = ds.shape
+        if this_shape != spatial_shape:
+            raise RuntimeError("Incompatible shapes %s, %s" % (str(this_shape),
+                                                               str(spatial_shape)))
+        ds.n_threads = n_threads
+        data = ds[:]
+    return data
+
+
+def _write_packed_genes(f, med_files, spatial_shape, n_threads):
+    # pack eight genes into one byte per voxel, the groups of eight genes are packed in parallel;
+    # each group loads its genes one after the other with a single reader thread,
+    # so that at most n_threads genes are in memory at once
+    num_genes = len(med_files)
+    n_packed = (num_genes + 7) // 8
+    out_dset = f.create_dataset('genes_packed', shape=(n_packed,) + spatial_shape, dtype='uint8',
+                                chunks=(1, 64, 64, 64), compression='gzip')
+    out_dset.attrs['n_genes'] = num_genes
+    lock = Lock()
+
+    def pack_genes(packed_id):
+        group = med_files[8 * packed_id:8 * (packed_id + 1)]
+        # the first gene of the group is stored in the highest bit, like np.packbits
+        packed = np.zeros(spatial_shape, dtype='uint8')
+        for bit, med_file in enumerate(group):
+            gene = _load_med(med_file, spatial_shape, n_threads=1) != 0
+            packed |= gene.view('uint8') << np.uint8(7 - bit)
+        # writing is serialized, because hdf5 does not support parallel writes
+        with lock:
+            out_dset[packed_id] = packed
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(pack_genes, packed_id) for packed_id in range(n_packed)]
+        [t.result() for t in tqdm(tasks)]
+
+
+def create_auxiliary_gene_file(meds_root, out_file, return_result=False,
+                               packed=True, n_threads=8):
+    """ Write all prospr genes binarized into one file.
+
+    Arguments:
+        meds_root [str] - folder with the prospr gene xmls
+        out_file [str] - path to the output file
+        return_result [bool] - whether to return the genes (default: False)
+        packed [bool] - whether to store the genes bit-packed, eight genes per byte,
+            in the dataset 'genes_packed' instead of the boolean dataset 'genes' (default: True)
+        n_threads [int] - number of threads for building the packed genes (default: 8)
+    """
     all_genes_dset = 'genes'
     names_dset = 'gene_names'
 
@@ -98,22 +165,14 @@ def create_auxiliary_gene_file(meds_root, out_file, return_result=False):
 
     # iterate through med files and write down binarized into one file
     with open_file(out_file) as f:
-        out_dset = f.create_dataset(all_genes_dset, shape=shape, dtype='bool',
-                                    chunks=(1, 64, 64, 64), compression='gzip')
-        out_dset.n_threads = 8
-
-        for i, med_file in enumerate(tqdm(med_files)):
-            is_h5 = os.path.splitext(med_file)[1] == '.h5'
-            med_key = get_key(is_h5, time_point=0, setup_id=0, scale=0)
-            with open_file(med_file, 'r') as f2:
-                ds = f2[med_key]
-                this_shape = ds.shape
-                if this_shape != spatial_shape:
-                    raise RuntimeError("Incompatible shapes %s, %s" % (str(this_shape),
-                                                                       str(spatial_shape)))
-                ds.n_threads = 8
-                data = ds[:]
-            out_dset[i] = data
+        if packed:
+            _write_packed_genes(f, med_files, spatial_shape, n_threads)
+        else:
+            out_dset = f.create_dataset(all_genes_dset, shape=shape, dtype='bool',
+                                        chunks=(1, 64, 64, 64), compression='gzip')
+            out_dset.n_threads = 8
+            for i, med_file in enumerate(tqdm(med_files)):
+                out_dset[i] = _load_med(med_file, spatial_shape)
 
         gene_names_ascii = [n.encode('ascii', 'ignore') for n in gene_names]
         f.create_dataset(names_dset, data=gene_names_ascii, dtype='S40')
@@ -121,5 +180,5 @@ def create_auxiliary_gene_file(meds_root, out_file, return_result=False):
     if return_result:
         # reload the binarized version
         with open_file(out_file, 'r') as f:
-            all_genes = f[all_genes_dset][:]
+            all_genes = open_genes(f)[:]
         return all_genes
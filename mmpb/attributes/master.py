@@ -1,7 +1,8 @@
 import os
 from pybdv.metadata import get_data_path
 
-from .base_attributes import add_cell_criterion_column, base_attributes, propagate_attributes
+from .base_attributes import (add_cell_criterion_column, base_attributes,
+                              propagate_attributes, propagate_tables)
 from .cell_nucleus_mapping import map_cells_to_nuclei
 from .genes import gene_assignment_table, vc_assignment_table
 from .morphology import write_morphology_cells, write_morphology_nuclei
@@ -30,8 +31,9 @@ def make_cell_tables(old_folder, folder, name, tmp_folder, resolution,
     # make table with cell nucleus mapping
     nuc_mapping_table = os.path.join(table_folder, 'cells_to_nuclei.csv')
     nuc_path = get_seg_path(folder, 'sbem-6dpf-1-whole-segmented-nuclei', seg_key)
-    map_cells_to_nuclei(label_ids, seg_path, nuc_path, nuc_mapping_table,
-                        tmp_folder, target, max_jobs)
+    # keep track of the overlap results that were loaded from the cache
+    cache_hits = map_cells_to_nuclei(label_ids, seg_path, nuc_path, nuc_mapping_table,
+                                     tmp_folder, target, max_jobs)
 
     # add a column with (somewhat stringent) cell criterion to the default table
     add_cell_criterion_column(base_out, nuc_mapping_table)
@@ -61,8 +63,8 @@ def make_cell_tables(old_folder, folder, name, tmp_folder, resolution,
     # need to make sure the inputs are copied / updated in
     # the segmentation folder beforehand
     segmentation_folder = os.path.join(folder, 'images', 'local')
-    region_attributes(seg_path, region_out, segmentation_folder,
-                      label_ids, tmp_folder, target, max_jobs)
+    cache_hits.update(region_attributes(seg_path, region_out, segmentation_folder,
+                                        label_ids, tmp_folder, target, max_jobs))
 
     # make table with morphology
     xml_raw = os.path.join(folder, 'images', 'local', 'sbem-6dpf-1-whole-raw.xml')
@@ -80,8 +82,8 @@ def make_cell_tables(old_folder, folder, name, tmp_folder, resolution,
     extrapol_mask = os.path.join(folder, 'images', 'local', '%s.xml' % mask_name)
     extrapol_mask = get_data_path(extrapol_mask, return_absolute_path=True)
     extrapol_out = os.path.join(table_folder, 'extrapolated_intensity_correction.csv')
-    extrapolated_intensities(seg_path, k1, extrapol_mask, k2,
-                             extrapol_out, tmp_folder, target, max_jobs)
+    cache_hits.update(extrapolated_intensities(seg_path, k1, extrapol_mask, k2,
+                                               extrapol_out, tmp_folder, target, max_jobs))
 
     # TODO need to update the neuron trace table as well
     old_ganglia_table = os.path.join(old_folder, 'tables', name, 'ganglia_ids.csv')
@@ -101,13 +103,15 @@ def make_cell_tables(old_folder, folder, name, tmp_folder, resolution,
         cilia_name = 'sbem-6dpf-1-whole-segmented-cilia'
         old_cilia_table = os.path.join(old_folder, 'tables', cilia_name, 'cell_mapping.csv')
         new_cilia_table = os.path.join(folder, 'tables', cilia_name, 'cell_mapping.csv')
-        propagate_attributes(id_lut, old_cilia_table, new_cilia_table, 'cell_id', override=True)
 
-        # update the ganglia id mapping table, gene clusters and symmetric pairs
-        propagate_attributes(id_lut, old_ganglia_table, new_ganglia_table, 'label_id', override=True)
-        propagate_attributes(id_lut, old_gcluster_table, new_gcluster_table, 'label_id', override=True)
-        propagate_attributes(id_lut, old_symm_pair_table, new_symm_pair_table, 'label_id', override=True)
-        propagate_attributes(id_lut, old_mcluster_table, new_mcluster_table, 'label_id', override=True)
+        # update the ganglia id mapping table, gene clusters, symmetric pairs and morphology clusters,
+        # the id look-up table is only loaded once for all tables
+        propagate_tables(id_lut, [(old_cilia_table, new_cilia_table, 'cell_id'),
+                                  (old_ganglia_table, new_ganglia_table, 'label_id'),
+                                  (old_gcluster_table, new_gcluster_table, 'label_id'),
+                                  (old_symm_pair_table, new_symm_pair_table, 'label_id'),
+                                  (old_mcluster_table, new_mcluster_table, 'label_id')],
+                         override=True)
 
     else:
         # otherwise, need to copy the ganglia, gene cluster and symmetric pair table
@@ -117,6 +121,7 @@ def make_cell_tables(old_folder, folder, name, tmp_folder, resolution,
         make_squashed_link(old_mcluster_table, new_mcluster_table)
 
     write_additional_table_file(table_folder)
+    return cache_hits
 
 
 def make_nuclei_tables(old_folder, folder, name, tmp_folder, resolution,
@@ -150,10 +155,11 @@ def make_nuclei_tables(old_folder, folder, name, tmp_folder, resolution,
     extrapol_mask = os.path.join(folder, 'images', 'local', '%s.xml' % mask_name)
     extrapol_mask = get_data_path(extrapol_mask, return_absolute_path=True)
     extrapol_out = os.path.join(table_folder, 'extrapolated_intensity_correction.csv')
-    extrapolated_intensities(seg_path, k1, extrapol_mask, k2,
-                             extrapol_out, tmp_folder, target, max_jobs)
+    cache_hits = extrapolated_intensities(seg_path, k1, extrapol_mask, k2,
+                                          extrapol_out, tmp_folder, target, max_jobs)
 
     write_additional_table_file(table_folder)
+    return cache_hits
 
 
 def make_cilia_tables(old_folder, folder, name, tmp_folder, resolution,
@@ -188,3 +194,5 @@ def make_cilia_tables(old_folder, folder, name, tmp_folder, resolution,
         make_squashed_link(old_table_path, new_table_path)
 
     write_additional_table_file(table_folder)
+    # the cilia tables don't use any cached overlaps
+    return {}
@@ -3,16 +3,22 @@ import os
 import json
 from ..extension.attributes import MorphologyWorkflow
 
+# memory limit per worker process in GB
+MEM_LIMIT_PER_WORKER = 24
 
-def write_config(config_folder, config):
-    config.update({'mem_limit': 24})
+
+def write_config(config_folder, config, n_threads=1):
+    # each job computes its label range with n_threads worker processes,
+    # so the memory limit of the job scales with the number of workers
+    config.update({'mem_limit': MEM_LIMIT_PER_WORKER * n_threads, 'threads_per_job': n_threads})
     with open(os.path.join(config_folder, 'morphology.config'), 'w') as f:
         json.dump(config, f)
 
 
 def write_morphology_nuclei(raw_path, nucleus_seg_path, chromatin_seg_path,
                             table_in_path, table_out_path,
-                            tmp_folder, target, max_jobs):
+                            tmp_folder, target, max_jobs, feature_families=None,
+                            surface_area_mode='marching_cubes', n_threads=1):
     """
     Write csv files of morphology stats for the nucleus segmentation
 
@@ -24,10 +30,14 @@ def write_morphology_nuclei(raw_path, nucleus_seg_path, chromatin_seg_path,
     tmp_folder - string, temporary folder
     target - string, computation target (slurm or local)
     max_jobs - maximal number of jobs
+    feature_families - names of the feature families to compute, all families if None (default: None)
+    surface_area_mode - method for computing the surface area, 'marching_cubes' or 'voxel_faces'
+        (default: 'marching_cubes')
+    n_threads - number of worker processes per job, each worker gets 24 GB of memory (default: 1)
     """
     task = MorphologyWorkflow
     config_folder = os.path.join(tmp_folder, 'configs')
-    write_config(config_folder, task.get_config()['morphology'])
+    write_config(config_folder, task.get_config()['morphology'], n_threads)
 
     scale = 3  # this is the scale of the raw data
     min_size = 18313
@@ -39,7 +49,9 @@ def write_morphology_nuclei(raw_path, nucleus_seg_path, chromatin_seg_path,
              chromatin_segmentation_path=chromatin_seg_path,
              in_table_path=table_in_path,
              output_path=table_out_path,
-             scale=scale, min_size=min_size, max_bb=max_bb)
+             scale=scale, min_size=min_size, max_bb=max_bb,
+             feature_families=feature_families,
+             surface_area_mode=surface_area_mode)
     ret = luigi.build([t], local_scheduler=True)
     if not ret:
         raise RuntimeError("Nucleus morphology computation failed")
@@ -48,7 +60,9 @@ def write_morphology_nuclei(raw_path, nucleus_seg_path, chromatin_seg_path,
 def write_morphology_cells(raw_path, cell_seg_path, nucleus_seg_path,
                            table_in_path, table_out_path,
                            nucleus_mapping_path, region_path,
-                           tmp_folder, target, max_jobs):
+                           tmp_folder, target, max_jobs, feature_families=None,
+                           surface_area_mode='marching_cubes', n_threads=1,
+                           intensity_engine='per_row'):
 
     """
     Write csv files of morphology stats for both the nucleus and cell segmentation
@@ -61,10 +75,20 @@ def write_morphology_cells(raw_path, cell_seg_path, nucleus_seg_path,
     tmp_folder - string, temporary folder
     target - string, computation target (slurm or local)
     max_jobs - maximal number of jobs
+    feature_families - names of the feature families to compute, all families if None (default: None)
+    surface_area_mode - method for computing the surface area, 'marching_cubes' or 'voxel_faces'
+        (default: 'marching_cubes')
+    n_threads - number of worker processes per job, each worker gets 24 GB of memory (default: 1)
+    intensity_engine - engine for the intensity features, 'per_row' or 'blockwise'. 'blockwise' is faster,
+        but samples the segmentation at the object boundaries differently if it has a different scale
+        than the raw data, see 'INTENSITY_ENGINES' in 'mmpb.extension.attributes.morphology_impl'
+        (default: 'per_row')
     """
     task = MorphologyWorkflow
     config_folder = os.path.join(tmp_folder, 'configs')
-    write_config(config_folder, task.get_config()['morphology'])
+    config = task.get_config()['morphology']
+    config.update({'intensity_engine': intensity_engine})
+    write_config(config_folder, config, n_threads)
 
     scale = 3  # this is the scale of the raw data
     min_size = 88741  # Kimberly's lower size cutoff for cells
@@ -80,7 +104,9 @@ def write_morphology_cells(raw_path, cell_seg_path, nucleus_seg_path,
              scale=scale, max_bb=max_bb,
              min_size=min_size, max_size=max_size,
              nucleus_mapping_path=nucleus_mapping_path,
-             region_mapping_path=region_path)
+             region_mapping_path=region_path,
+             feature_families=feature_families,
+             surface_area_mode=surface_area_mode)
     ret = luigi.build([t], local_scheduler=True)
     if not ret:
         raise RuntimeError("Cell morphology computation failed")
@@ -5,11 +5,15 @@ import pandas as pd
 from elf.io import open_file
 from pybdv.metadata import get_data_path
 
-from .util import write_csv, node_labels, normalize_overlap_dict, get_seg_key_xml
+from .util import write_csv, node_labels, get_seg_key_xml, region_overlaps, OverlapMatrix
 
 
 def write_region_table(label_ids, label_list, semantic_mapping_list, out_path):
     assert len(label_list) == len(semantic_mapping_list)
+    # the labels can also be given as overlap matrix, in this case the region
+    # with maximal overlap is used for each label id
+    label_list = [labels.max_overlap() if isinstance(labels, OverlapMatrix) else labels
+                  for labels in label_list]
     n_labels = len(label_ids)
     assert all(len(labels) == n_labels for labels in label_list)
     col_names = ['label_id'] + [name for mapping in semantic_mapping_list
@@ -30,132 +34,123 @@ def write_region_table(label_ids, label_list, semantic_mapping_list, out_path):
     write_csv(out_path, table, col_names)
 
 
-def muscle_attributes(muscle_path, key_muscle,
-                      seg_path, key_seg,
-                      tmp_folder, target, max_jobs):
-    muscle_labels = node_labels(seg_path, key_seg,
-                                muscle_path, key_muscle,
-                                'muscle', tmp_folder,
-                                target, max_jobs, max_overlap=False)
-
-    foreground_id = 255
-
+def muscle_labels_from_overlaps(muscle_overlaps, foreground_id=255, overlap_threshold=.25):
+    """ Map the segment ids to muscle based on the OverlapMatrix of segment ids and muscle ids.
+    """
     # we count everything that has at least 25 % overlap as muscle
-    overlap_threshold = .25
-    muscle_labels = normalize_overlap_dict(muscle_labels)
-    label_ids = np.array([k for k in sorted(muscle_labels.keys())])
-    overlap_values = np.array([muscle_labels[label_id].get(foreground_id, 0.)
-                               for label_id in label_ids])
-    overlap_labels = label_ids[overlap_values > overlap_threshold]
+    overlap_values = muscle_overlaps.overlap_fraction(foreground_id)
+    muscle_labels = np.zeros(muscle_overlaps.n_labels, dtype='uint8')
+    muscle_labels[overlap_values > overlap_threshold] = foreground_id
+    return muscle_labels
 
-    n_labels = int(label_ids.max()) + 1
-    muscle_labels = np.zeros(n_labels, dtype='uint8')
-    muscle_labels[overlap_labels] = foreground_id
 
-    semantic_muscle = {'muscle': [foreground_id]}
-    return muscle_labels, semantic_muscle
+def _region_input(segmentation_folder, name):
+    xml_path = os.path.join(segmentation_folder, name)
+    key = get_seg_key_xml(xml_path, scale=0)
+    return get_data_path(xml_path, return_absolute_path=True), key
 
 
 def region_attributes(seg_path, region_out, segmentation_folder,
                       label_ids, tmp_folder, target, max_jobs,
                       key_seg=None):
+    """ Write the table that maps the segment ids to regions.
+
+    Returns a dict that maps the name of each overlap result to whether it was loaded from the cache.
+    """
     if seg_path.endswith('.n5') and key_seg is None:
         key_seg = 'setup0/timepoint0/s2'
     elif key_seg is None:
         key_seg = 't00000/s00/2/cells'
 
-    # 1.) compute the mapping to carved regions
-    carved_path = os.path.join(segmentation_folder,
-                               'sbem-6dpf-1-whole-segmented-tissue.xml')
-    carved_key = get_seg_key_xml(carved_path, scale=0)
-    carved_path = get_data_path(carved_path, return_absolute_path=True)
-    carved_labels = node_labels(seg_path, key_seg,
-                                carved_path, carved_key,
-                                'carved-regions', tmp_folder,
-                                target, max_jobs)
+    # 1.) collect all the region volumes: the carved regions, the muscles,
+    # the segmented prospr regions, the midgut and the nephridia
+    prefix = 'sbem-6dpf-1-whole-segmented-'
+    carved_path, carved_key = _region_input(segmentation_folder, prefix + 'tissue.xml')
+    muscle_path, muscle_key = _region_input(segmentation_folder, prefix + 'muscle.xml')
+    region_paths = glob.glob(os.path.join(segmentation_folder,
+                                          "prospr-6dpf-1-whole-segmented-*"))
+    region_names = [os.path.splitext(pp.split('-')[-1])[0].lower() for pp in region_paths]
+    region_inputs = [_region_input(segmentation_folder, os.path.basename(rpath))
+                     for rpath in region_paths]
+    midgut_path, midgut_key = _region_input(segmentation_folder, prefix + 'midgut.xml')
+    nephridia_path, nephridia_key = _region_input(segmentation_folder, prefix + 'nephridia.xml')
+
+    input_paths = [carved_path, muscle_path] + [rpath for rpath, _ in region_inputs] +\
+        [midgut_path, nephridia_path]
+    input_keys = [carved_key, muscle_key] + [rkey for _, rkey in region_inputs] +\
+        [midgut_key, nephridia_key]
+
+    # 2.) compute the overlaps with all region volumes in a single pass over the segmentation
+    overlaps, cache_hits = region_overlaps(seg_path, key_seg, input_paths, input_keys,
+                                           'regions', tmp_folder, target, max_jobs,
+                                           return_cache_hits=True)
+    n_labels = len(label_ids)
+    overlaps = [OverlapMatrix.from_pairs(*overlap, n_labels=n_labels) for overlap in overlaps]
+    carved_overlaps, muscle_overlaps = overlaps[:2]
+    prospr_overlaps = overlaps[2:-2]
+    midgut_overlaps, nephridia_overlaps = overlaps[-2:]
+
+    # 3.) map to the carved regions
     # load the mapping of ids to semantics
     with open_file(carved_path, 'r') as f:
         attrs = f.attrs
         names = attrs['semantic_names']
         ids = attrs['semantic_mapping']
     semantics_to_carved_ids = {name: idx for name, idx in zip(names, ids)}
-    label_list = [carved_labels]
+    label_list = [carved_overlaps]
     semantic_mapping_list = [semantics_to_carved_ids]
 
-    # 2.) compute the mapping to muscles
-    muscle_path = os.path.join(segmentation_folder, 'sbem-6dpf-1-whole-segmented-muscle.xml')
-    muscle_key = get_seg_key_xml(muscle_path, scale=0)
-    muscle_path = get_data_path(muscle_path, return_absolute_path=True)
+    # 4.) map to the muscles
     # need to be more lenient with the overlap criterion for the muscle mapping
-    muscle_labels, semantic_muscle = muscle_attributes(muscle_path, muscle_key,
-                                                       seg_path, key_seg,
-                                                       tmp_folder, target, max_jobs)
+    foreground_id = 255
+    muscle_labels = muscle_labels_from_overlaps(muscle_overlaps, foreground_id)
     label_list.append(muscle_labels)
-    semantic_mapping_list.append(semantic_muscle)
+    semantic_mapping_list.append({'muscle': [foreground_id]})
 
-    # 3.) map all the segmented prospr regions
-    region_paths = glob.glob(os.path.join(segmentation_folder,
-                                          "prospr-6dpf-1-whole-segmented-*"))
-    region_names = [os.path.splitext(pp.split('-')[-1])[0].lower() for pp in region_paths]
-    region_keys = [get_seg_key_xml(rpath, scale=0) for rpath in region_paths]
-    region_paths = [get_data_path(rp, return_absolute_path=True)
-                    for rp in region_paths]
-    for rpath, rkey, rname in zip(region_paths, region_keys, region_names):
-        rlabels = node_labels(seg_path, key_seg,
-                              rpath, rkey,
-                              rname, tmp_folder,
-                              target, max_jobs)
-        label_list.append(rlabels)
+    # 5.) map all the segmented prospr regions
+    for rname, roverlaps in zip(region_names, prospr_overlaps):
+        label_list.append(roverlaps)
         semantic_mapping_list.append({rname: [255]})
 
-    # 4.) map the midgut segmentation
-    midgut_path = os.path.join(segmentation_folder, 'sbem-6dpf-1-whole-segmented-midgut.xml')
-    midgut_key = get_seg_key_xml(midgut_path, scale=0)
-    midgut_path = get_data_path(midgut_path, return_absolute_path=True)
-    midgut_labels = node_labels(seg_path, key_seg, midgut_path, midgut_key,
-                                'midgut', tmp_folder, target, max_jobs)
-    label_list.append(midgut_labels)
+    # 6.) map the midgut segmentation
+    label_list.append(midgut_overlaps)
     semantic_mapping_list.append({'midgut': [255]})
 
-    # 5.) merge the mappings and write new table
+    # 7.) merge the mappings and write new table
     write_region_table(label_ids, label_list, semantic_mapping_list, region_out)
 
-    # 6.) add nephridia to the table
-    nephridia_path = os.path.join(segmentation_folder, 'sbem-6dpf-1-whole-segmented-nephridia.xml')
-    nephridia_key = get_seg_key_xml(nephridia_path, scale=0)
-    nephridia_path = get_data_path(nephridia_path, return_absolute_path=True)
-    nephridia_labels = node_labels(seg_path, key_seg, nephridia_path, nephridia_key,
-                                   'nephridia', tmp_folder, target, max_jobs)
-
+    # 8.) add nephridia to the table
+    nephridia_labels = nephridia_overlaps.max_overlap()
     region_table = pd.read_csv(region_out, sep='\t')
     if 'nephridia' in region_table.columns:
-        return
+        return cache_hits
     assert len(nephridia_labels) == len(label_ids)
     region_table['nephridia'] = nephridia_labels
     region_table.to_csv(region_out, sep='\t', index=False)
+    return cache_hits
 
 
 def extrapolated_intensities(seg_path, seg_key, mask_path, mask_key, out_path,
                              tmp_folder, target, max_jobs, overlap_threshold=.5):
-    foreground_id = 255
-    mask_labels = node_labels(seg_path, seg_key,
-                              mask_path, mask_key,
-                              'extrapolated_intensities', tmp_folder,
-                              target, max_jobs, max_overlap=False)
+    """ Write the table that marks the segment ids in the extrapolated intensity mask.
 
-    # we count everything that has at least 25 % overlap as muscle
-    mask_labels = normalize_overlap_dict(mask_labels)
-    label_ids = np.array([k for k in sorted(mask_labels.keys())])
-    overlap_values = np.array([mask_labels[label_id].get(foreground_id, 0.)
-                               for label_id in label_ids])
-    overlap_labels = label_ids[overlap_values > overlap_threshold]
+    Returns a dict that maps the name of the overlap result to whether it was loaded from the cache.
+    """
+    foreground_id = 255
+    mask_overlaps, cache_hits = node_labels(seg_path, seg_key,
+                                            mask_path, mask_key,
+                                            'extrapolated_intensities', tmp_folder,
+                                            target, max_jobs, max_overlap=False,
+                                            return_cache_hits=True)
 
-    n_labels = int(label_ids.max()) + 1
-    mask_labels = np.zeros(n_labels, dtype='uint8')
-    mask_labels[overlap_labels] = 1
+    # we count everything that has more overlap with the mask than the threshold as extrapolated
+    overlap_values = mask_overlaps.overlap_fraction(foreground_id)
+    n_labels = mask_overlaps.n_labels
+    mask_labels = (overlap_values > overlap_threshold).astype('uint8')
 
     label_ids = np.arange(n_labels)
     data = np.concatenate([label_ids[:, None], mask_labels[:, None]], axis=1)
     cols = ['label_id', 'has_extrapolated_intensities']
     table = pd.DataFrame(data, columns=cols)
     table.to_csv(out_path, sep='\t', index=False)
+    return cache_hits
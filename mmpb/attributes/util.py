@@ -1,13 +1,22 @@
 import os
 import csv
+import json
+import hashlib
+from concurrent import futures
+
 import luigi
+import numpy as np
 import z5py
 import nifty.distributed as ndist
+from scipy import sparse
 
 from elf.io import open_file
 from pybdv.metadata import get_data_path, get_bdv_format
 from pybdv.util import get_key
 from cluster_tools.node_labels import NodeLabelWorkflow
+from ..extension.attributes import RegionOverlapsLocal, RegionOverlapsSlurm
+from ..extension.attributes.region_overlaps_impl import max_overlap_labels, merge_overlaps
+from ..util import get_cache_folder
 
 
 def write_csv(output_path, data, col_names):
@@ -28,10 +37,203 @@ def normalize_overlap_dict(label_overlap_dict):
     return label_overlap_dict
 
 
+class OverlapMatrix:
+    """ Sparse matrix of the overlap counts of segment ids (rows) with region ids (columns).
+
+    Arguments:
+        counts [scipy.sparse.spmatrix] - the overlap counts
+    """
+
+    def __init__(self, counts):
+        self.counts = sparse.csr_matrix(counts)
+        self.counts.sum_duplicates()
+
+    @classmethod
+    def from_pairs(cls, seg_ids, region_ids, counts, n_labels=None, n_regions=None):
+        """ Build the matrix from the (segment id, region id, count) triplets.
+        """
+        seg_ids, region_ids = np.asarray(seg_ids, dtype='int64'), np.asarray(region_ids, dtype='int64')
+        if n_labels is None:
+            n_labels = int(seg_ids.max()) + 1 if len(seg_ids) > 0 else 0
+        if n_regions is None:
+            n_regions = int(region_ids.max()) + 1 if len(region_ids) > 0 else 0
+        counts = np.asarray(counts, dtype='float64')
+        return cls(sparse.coo_matrix((counts, (seg_ids, region_ids)), shape=(n_labels, n_regions)))
+
+    @classmethod
+    def from_dict(cls, overlaps, n_labels=None):
+        """ Build the matrix from the dictionary {label_id: {overlap_id: count}}.
+        """
+        n_pairs = sum(len(ovlps) for ovlps in overlaps.values())
+        seg_ids = np.fromiter((label_id for label_id, ovlps in overlaps.items() for _ in ovlps),
+                              dtype='int64', count=n_pairs)
+        region_ids = np.fromiter((ovlp_id for ovlps in overlaps.values() for ovlp_id in ovlps),
+                                 dtype='int64', count=n_pairs)
+        counts = np.fromiter((count for ovlps in overlaps.values() for count in ovlps.values()),
+                             dtype='float64', count=n_pairs)
+        return cls.from_pairs(seg_ids, region_ids, counts, n_labels=n_labels)
+
+    @property
+    def n_labels(self):
+        return self.counts.shape[0]
+
+    def transpose(self):
+        """ Return the overlaps of the region ids (rows) with the segment ids (columns).
+        """
+        return OverlapMatrix(self.counts.T)
+
+    def pairs(self, ignore_label=None):
+        """ Return the segment ids, region ids and counts of all non-zero overlaps.
+        """
+        coo = self.counts.tocoo()
+        seg_ids, region_ids, counts = coo.row.astype('uint64'), coo.col.astype('uint64'), coo.data
+        if ignore_label is not None:
+            keep = region_ids != ignore_label
+            seg_ids, region_ids, counts = seg_ids[keep], region_ids[keep], counts[keep]
+        return seg_ids, region_ids, counts
+
+    def to_dict(self):
+        """ Return the overlaps as dictionary {label_id: {overlap_id: count}}.
+        """
+        result = {}
+        for seg_id, region_id, count in zip(*(values.tolist() for values in self.pairs())):
+            result.setdefault(seg_id, {})[region_id] = count
+        return result
+
+    def _without(self, ignore_label):
+        if ignore_label is None or ignore_label >= self.counts.shape[1]:
+            return self.counts
+        keep = np.ones(self.counts.shape[1], dtype='float64')
+        keep[ignore_label] = 0
+        return self.counts @ sparse.diags(keep)
+
+    def normalized(self, ignore_label=None):
+        """ Return the overlaps normalized by the total overlap of each segment id.
+
+        The total includes the overlap with the ignore label, only its column is removed
+        from the result, so that it is never a candidate region.
+        """
+        sums = np.asarray(self.counts.sum(axis=1)).ravel()
+        scale = np.divide(1., sums, out=np.zeros_like(sums), where=sums > 0)
+        return sparse.csr_matrix(sparse.diags(scale) @ self._without(ignore_label))
+
+    def overlap_fraction(self, region_id, ignore_label=None):
+        """ Return the fraction of each segment id that overlaps with the given region id.
+        """
+        if region_id >= self.counts.shape[1]:
+            return np.zeros(self.n_labels)
+        return self.normalized(ignore_label)[:, region_id].toarray().ravel()
+
+    def max_overlap(self, ignore_label=None):
+        """ Return the region id with the largest overlap for each segment id.
+
+        Segment ids without overlap are mapped to 0. For ties, the smaller region id is chosen.
+        """
+        return max_overlap_labels(*self.pairs(ignore_label), self.n_labels)
+
+    def unique_overlap(self, overlap_threshold, ignore_label=None):
+        """ Return the region id for segment ids that overlap with exactly one region
+        by more than the overlap threshold, all other segment ids are mapped to 0.
+        """
+        above = self.normalized(ignore_label) > overlap_threshold
+        above = above.tocsr()
+        above.eliminate_zeros()
+        n_above = np.diff(above.indptr)
+        labels = np.zeros(self.n_labels, dtype='uint64')
+        unique = np.where(n_above == 1)[0]
+        labels[unique] = above.indices[above.indptr[unique]]
+        return labels
+
+
+def dataset_fingerprint(path, key):
+    """ Fingerprint of a dataset that changes if the data of the dataset changes.
+
+    For n5 and zarr, it is computed from the size and modification time of all files of the dataset,
+    i.e. the attributes and the chunks, so that chunks that are rewritten in place are detected.
+    For hdf5 it is computed from the size and modification time of the file.
+    The path is resolved, so that datasets linked from different versions have the same fingerprint.
+    """
+    path = os.path.realpath(path)
+    ds_path = os.path.join(path, key)
+    fingerprint = hashlib.sha1(key.encode('utf-8'))
+    if os.path.isdir(ds_path):
+        # the stats are hashed per directory, large datasets have millions of chunks
+        for root, dirs, files in os.walk(ds_path):
+            dirs.sort()
+            stats = []
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                stats.append([name, stat.st_size, stat.st_mtime_ns])
+            fingerprint.update(json.dumps([os.path.relpath(root, ds_path), stats]).encode('utf-8'))
+    else:
+        stat = os.stat(path)
+        fingerprint.update(json.dumps([stat.st_size, stat.st_mtime_ns]).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def _overlap_cache_path(kind, seg_path, seg_key, input_path, input_key):
+    fingerprint = json.dumps([kind, dataset_fingerprint(seg_path, seg_key),
+                              dataset_fingerprint(input_path, input_key)])
+    fingerprint = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+    return os.path.join(get_cache_folder(), 'overlaps_%s.npz' % fingerprint)
+
+
+def _load_cached_overlaps(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    with np.load(cache_path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def _save_cached_overlaps(cache_path, **data):
+    # write to a temporary file and move it, so that concurrent processes never read a partial cache
+    tmp_path = cache_path + '.tmp%i' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **data)
+    os.replace(tmp_path, cache_path)
+
+
+def _deserialize_overlaps(path, key, n_threads):
+    with z5py.File(path, 'r') as f:
+        n_chunks = f[key].number_of_chunks
+
+    def deserialize_chunk(chunk_id):
+        overlaps = ndist.deserializeOverlapChunk(path, key, (chunk_id,))[0]
+        return OverlapMatrix.from_dict(overlaps).pairs() if overlaps else None
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(deserialize_chunk, chunk_id) for chunk_id in range(n_chunks)]
+        pairs = [t.result() for t in tasks]
+    pairs = [chunk_pairs for chunk_pairs in pairs if chunk_pairs is not None]
+    if len(pairs) == 0:
+        return OverlapMatrix.from_pairs([], [], [])
+    return OverlapMatrix.from_pairs(*[np.concatenate(values) for values in zip(*pairs)])
+
+
 def node_labels(seg_path, seg_key,
                 input_path, input_key, prefix,
                 tmp_folder, target, max_jobs,
-                max_overlap=True, ignore_label=None):
+                max_overlap=True, ignore_label=None, n_threads=8, use_cache=True,
+                return_cache_hits=False):
+    """ Map the ids of the segmentation to the ids of the input.
+
+    Returns the id with maximal overlap for each segment id if max_overlap is True,
+    otherwise the OverlapMatrix of all overlaps. If use_cache is True, the result is
+    cached and reused if neither the segmentation nor the input change.
+    If return_cache_hits is True, also returns a dict that maps the prefix
+    to whether the result was loaded from the cache.
+    """
+    if use_cache:
+        kind = 'node_labels_max_overlap' if max_overlap else 'node_labels'
+        cache_path = _overlap_cache_path([kind, ignore_label], seg_path, seg_key, input_path, input_key)
+        cached = _load_cached_overlaps(cache_path)
+        if cached is not None:
+            if max_overlap:
+                data = cached['labels']
+            else:
+                data = OverlapMatrix.from_pairs(cached['seg_ids'], cached['region_ids'], cached['counts'])
+            return (data, {prefix: True}) if return_cache_hits else data
+
     task = NodeLabelWorkflow
     config_folder = os.path.join(tmp_folder, 'configs')
 
@@ -49,20 +251,82 @@ def node_labels(seg_path, seg_key,
     if not ret:
         raise RuntimeError("Node labels for %s" % prefix)
 
-    f = z5py.File(out_path, 'r')
-    ds_out = f[out_key]
-
     if max_overlap:
-        data = ds_out[:]
+        with z5py.File(out_path, 'r') as f:
+            data = f[out_key][:]
     else:
-        n_chunks = ds_out.number_of_chunks
-        data = [ndist.deserializeOverlapChunk(out_path, out_key, (chunk_id,))[0]
-                for chunk_id in range(n_chunks)]
-        data = {label_id: overlaps
-                for chunk_data in data
-                for label_id, overlaps in chunk_data.items()}
-
-    return data
+        data = _deserialize_overlaps(out_path, out_key, n_threads)
+
+    if use_cache and max_overlap:
+        _save_cached_overlaps(cache_path, labels=data)
+    elif use_cache:
+        seg_ids, region_ids, counts = data.pairs()
+        _save_cached_overlaps(cache_path, seg_ids=seg_ids, region_ids=region_ids, counts=counts)
+
+    return (data, {prefix: False}) if return_cache_hits else data
+
+
+def region_overlaps(seg_path, seg_key, input_paths, input_keys, prefix,
+                    tmp_folder, target, max_jobs, n_threads=1, use_cache=True,
+                    return_cache_hits=False):
+    """ Compute the overlaps of the segmentation with many region volumes.
+
+    Each block of the segmentation is only loaded once, instead of once per region volume
+    as for 'node_labels'. Returns the segment ids, region ids and overlap counts
+    for each input volume. If use_cache is True, the overlaps are cached for each input
+    and only computed for the inputs where the segmentation or the input changed.
+    If return_cache_hits is True, also returns a dict that maps the name of each input
+    to whether its overlaps were loaded from the cache.
+    """
+    n_inputs = len(input_paths)
+    names = ['%s-%s' % (prefix, os.path.splitext(os.path.basename(path))[0]) for path in input_paths]
+    overlaps = [None] * n_inputs
+    if use_cache:
+        cache_paths = [_overlap_cache_path('region_overlaps', seg_path, seg_key, path, key)
+                       for path, key in zip(input_paths, input_keys)]
+        for input_id, (cache_path, name) in enumerate(zip(cache_paths, names)):
+            cached = _load_cached_overlaps(cache_path)
+            if cached is not None:
+                overlaps[input_id] = cached['seg_ids'], cached['region_ids'], cached['counts']
+    to_compute = [input_id for input_id in range(n_inputs) if overlaps[input_id] is None]
+    cache_hits = {name: overlap is not None for name, overlap in zip(names, overlaps)}
+    if len(to_compute) == 0:
+        return (overlaps, cache_hits) if return_cache_hits else overlaps
+
+    task = RegionOverlapsSlurm if target == 'slurm' else RegionOverlapsLocal
+    config_folder = os.path.join(tmp_folder, 'configs')
+    config = task.default_task_config()
+    config.update({'threads_per_job': n_threads})
+    with open(os.path.join(config_folder, 'region_overlaps.config'), 'w') as f:
+        json.dump(config, f)
+
+    # the task prefix depends on the inputs that are computed, so that the results
+    # for different subsets of the inputs are not mixed up in the tmp folder
+    compute_paths = [input_paths[input_id] for input_id in to_compute]
+    compute_keys = [input_keys[input_id] for input_id in to_compute]
+    inputs_hash = hashlib.sha1(json.dumps([compute_paths, compute_keys]).encode('utf-8')).hexdigest()
+    task_prefix = '%s_%s' % (prefix, inputs_hash[:8])
+    output_prefix = os.path.join(tmp_folder, 'region_overlaps_%s' % task_prefix)
+    t = task(tmp_folder=tmp_folder, config_dir=config_folder,
+             max_jobs=max_jobs, target=target,
+             segmentation_path=seg_path, segmentation_key=seg_key,
+             input_paths=compute_paths, input_keys=compute_keys,
+             output_prefix=output_prefix, prefix=task_prefix)
+    ret = luigi.build([t], local_scheduler=True)
+    if not ret:
+        raise RuntimeError("Region overlaps for %s" % prefix)
+
+    # only merge the job results of this run, which are listed by the task
+    with open(output_prefix + '_jobs.json') as f:
+        job_paths = json.load(f)
+    computed = merge_overlaps(job_paths)
+    assert len(computed) == len(to_compute), "%i, %i" % (len(computed), len(to_compute))
+    for input_id, (seg_ids, region_ids, counts) in zip(to_compute, computed):
+        overlaps[input_id] = seg_ids, region_ids, counts
+        if use_cache:
+            _save_cached_overlaps(cache_paths[input_id], seg_ids=seg_ids,
+                                  region_ids=region_ids, counts=counts)
+    return (overlaps, cache_hits) if return_cache_hits else overlaps
 
 
 def get_seg_path(folder, name, key=None):
@@ -7,7 +7,7 @@ from cluster_tools.node_labels import NodeLabelWorkflow
 from pybdv.metadata import get_data_path
 from pybdv.util import get_key
 from ..default_config import write_default_global_config
-from ..util import is_h5_file
+from ..util import is_h5_file, write_id_lut
 
 
 def get_seg_path(folder, name):
@@ -63,10 +63,8 @@ def map_ids(path1, path2, out_path, tmp_folder, max_jobs, target, prefix,
     ds = z5py.File(tmp_path)[tmp_key]
     lut = ds[:]
     assert lut.ndim == 2
-    lut = dict(zip(range(len(lut)), lut.tolist()))
-
-    with open(out_path, 'w') as f:
-        json.dump(lut, f)
+    # write the json look-up table and the binary table that can be memory-mapped
+    write_id_lut(lut, out_path)
 
 
 def map_segmentation_ids(src_folder, dest_folder, name, tmp_folder, max_jobs, target):
@@ -1,3 +1,4 @@
 from .genes import GenesLocal, GenesSlurm
 from .vc_assignments import VCAssignmentsLocal, VCAssignmentsSlurm
 from .workflow import MorphologyWorkflow
+from .region_overlaps import RegionOverlapsLocal, RegionOverlapsSlurm
@@ -12,6 +12,9 @@ from cluster_tools.utils.task_utils import DummyTask
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask
 from mmpb.extension.attributes.genes_impl import gene_assignments
 
+# maximal memory for the genes that are loaded at once, in GB
+DEFAULT_MAX_GENE_MEMORY = 8
+
 #
 # Gene Attribute Tasks
 #
@@ -37,6 +40,17 @@ class GenesBase(luigi.Task):
     def requires(self):
         return self.dependency
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        # maximal memory for the genes that are loaded at once, in GB,
+        # set to None to load all genes at once
+        config.update({'max_gene_memory': DEFAULT_MAX_GENE_MEMORY})
+        # engine for computing the expression, 'bincount' or 'per_cell'
+        config.update({'expression_engine': 'bincount'})
+        return config
+
     def run_impl(self):
         # get the global config and init configs
         shebang = self.global_config_values()[0]
@@ -92,10 +106,14 @@ def genes(job_id, config_path):
     labels_path = config['labels_path']
     output_path = config['output_path']
     n_threads = config.get('threads_per_job', 1)
+    max_gene_memory = config.get('max_gene_memory', DEFAULT_MAX_GENE_MEMORY)
+    max_memory = None if max_gene_memory is None else int(max_gene_memory * 1e9)
+    engine = config.get('expression_engine', 'bincount')
 
     labels = np.load(labels_path)
     gene_assignments(segmentation_path, segmentation_key,
-                     genes_path, labels, output_path, n_threads)
+                     genes_path, labels, output_path, n_threads,
+                     max_memory=max_memory, engine=engine)
     fu.log_job_success(job_id)
 
 
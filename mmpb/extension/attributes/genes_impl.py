@@ -24,30 +24,146 @@ def get_sizes_and_bbs(data):
     return cell_sizes, cell_bbs
 
 
-def get_cell_expression(segmentation, all_genes, n_threads):
-    num_genes = all_genes.shape[0]
-    # NOTE we need to recalculate the unique labels here, beacause we might not
-    # have all labels due to donwsampling
-    labels = np.unique(segmentation)
-    cells_expression = np.zeros((len(labels), num_genes), dtype='float32')
+class PackedGenes:
+    """ Read access to genes that are stored bit-packed along the gene axis, eight genes per byte.
+
+    Slicing along the gene axis returns the unpacked boolean genes, like for the dataset
+    of unpacked genes.
+
+    Arguments:
+        ds [dataset] - dataset with the packed genes and the attribute 'n_genes'
+    """
+
+    def __init__(self, ds):
+        self.ds = ds
+        self.n_genes = int(ds.attrs['n_genes'])
+        self.shape = (self.n_genes,) + tuple(ds.shape[1:])
+        self.dtype = np.dtype('bool')
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = int(index)
+            if index < 0:
+                index += self.n_genes
+            if not 0 <= index < self.n_genes:
+                raise IndexError("Gene index %i is out of range for %i genes" % (index, self.n_genes))
+            return self[index:index + 1][0]
+        if not isinstance(index, slice):
+            raise ValueError("PackedGenes only supports slicing along the gene axis")
+        start, stop, step = index.indices(self.n_genes)
+        assert step == 1, "PackedGenes does not support strided slicing"
+        if stop <= start:
+            return np.zeros((0,) + self.shape[1:], dtype='bool')
+        packed = self.ds[start // 8:(stop + 7) // 8]
+        genes = np.unpackbits(packed, axis=0).view('bool')
+        offset = start - 8 * (start // 8)
+        return genes[offset:offset + stop - start]
+
+    def __len__(self):
+        return self.n_genes
+
+
+def open_genes(f):
+    """ Get the genes from the auxiliary gene file, supports bit-packed and unpacked genes.
+    """
+    if 'genes_packed' in f:
+        return PackedGenes(f['genes_packed'])
+    return f['genes']
+
+
+def gene_chunks(n_genes, spatial_shape, itemsize, max_memory=None):
+    """ Split the genes into chunks that fit into max_memory bytes.
+    """
+    if max_memory is None:
+        return [(0, n_genes)]
+    gene_size = int(np.prod(spatial_shape)) * itemsize
+    genes_per_chunk = max(1, int(max_memory // gene_size))
+    # use multiples of eight genes, so that bit-packed genes are read only once
+    if genes_per_chunk >= 8:
+        genes_per_chunk -= genes_per_chunk % 8
+    return [(gene_start, min(gene_start + genes_per_chunk, n_genes))
+            for gene_start in range(0, n_genes, genes_per_chunk)]
+
+
+def _counts_per_cell(segmentation, labels, n_threads):
+    # compute the expression counts for each cell and gene chunk with threads over the cells
     cell_sizes, cell_bbs = get_sizes_and_bbs(segmentation)
 
-    def compute_expressions(cell_idx, cell_label):
-        # get size and boundinng box of this cell
-        cell_size = cell_sizes[cell_label]
+    def compute_counts(genes, cell_label):
+        # get boundinng box of this cell
         bb = cell_bbs[cell_label]
         # get the cell mask and the gene expression in bounding box
         cell_masked = segmentation[bb] == cell_label
-        genes_in_cell = all_genes[(slice(None),) + bb]
+        genes_in_cell = genes[(slice(None),) + bb]
         # accumulate the gene expression channels over the cell mask
-        gene_expr_sum = np.sum(genes_in_cell[:, cell_masked] > 0, axis=1)
-        # divide by the cell size and write result
-        cells_expression[cell_idx] = gene_expr_sum / cell_size
-
-    with futures.ThreadPoolExecutor(n_threads) as tp:
-        tasks = [tp.submit(compute_expressions, cell_idx, cell_label)
-                 for cell_idx, cell_label in enumerate(labels) if cell_label != 0]
-        [t.result() for t in tasks]
+        return np.sum(genes_in_cell[:, cell_masked] > 0, axis=1)
+
+    def counts_for_chunk(genes, gene_counts):
+        with futures.ThreadPoolExecutor(n_threads) as tp:
+            tasks = {cell_idx: tp.submit(compute_counts, genes, cell_label)
+                     for cell_idx, cell_label in enumerate(labels) if cell_label != 0}
+            for cell_idx, t in tasks.items():
+                gene_counts[cell_idx] = t.result()
+
+    return cell_sizes[labels], counts_for_chunk
+
+
+def _counts_bincount(segmentation, labels, n_threads):
+    # compute the expression counts for all cells and a gene chunk at once,
+    # by counting the label ids of the voxels where a gene is expressed
+    seg_ids = segmentation.ravel()
+    n_ids = int(labels[-1]) + 1
+    cell_sizes = np.bincount(seg_ids, minlength=n_ids).astype('uint64')
+
+    def counts_for_gene(gene):
+        return np.bincount(seg_ids[gene.ravel() > 0], minlength=n_ids)[labels]
+
+    def counts_for_chunk(genes, gene_counts):
+        with futures.ThreadPoolExecutor(n_threads) as tp:
+            tasks = [tp.submit(counts_for_gene, gene) for gene in genes]
+            for gene_idx, t in enumerate(tasks):
+                gene_counts[:, gene_idx] = t.result()
+
+    return cell_sizes[labels], counts_for_chunk
+
+
+EXPRESSION_ENGINES = {'bincount': _counts_bincount, 'per_cell': _counts_per_cell}
+
+
+def get_cell_expression(segmentation, all_genes, n_threads, max_memory=None, engine='bincount'):
+    """ Compute the fraction of each cell that expresses each gene.
+
+    Arguments:
+        segmentation [np.ndarray] - the cell segmentation in gene space
+        all_genes [np.ndarray or dataset] - the gene expression, genes are in the first axis
+        n_threads [int] - number of threads used for the computation
+        max_memory [int] - maximal number of bytes used for loading genes at once.
+            If given, the genes are loaded and accumulated chunk by chunk,
+            otherwise they are loaded all at once (default: None)
+        engine [str] - the engine for computing the expression counts, 'bincount' counts the
+            expressed voxels for all cells at once, 'per_cell' loops over the cell bounding boxes
+            (default: 'bincount')
+    """
+    if engine not in EXPRESSION_ENGINES:
+        raise ValueError("Invalid engine %s, expected one of %s" % (engine, list(EXPRESSION_ENGINES)))
+    num_genes = all_genes.shape[0]
+    # NOTE we need to recalculate the unique labels here, beacause we might not
+    # have all labels due to donwsampling
+    labels = np.unique(segmentation)
+    # number of voxels of each cell where each gene is expressed
+    gene_counts = np.zeros((len(labels), num_genes), dtype='uint32')
+    cell_sizes, counts_for_chunk = EXPRESSION_ENGINES[engine](segmentation, labels, n_threads)
+
+    chunks = gene_chunks(num_genes, all_genes.shape[1:], all_genes.dtype.itemsize, max_memory)
+    for gene_start, gene_stop in chunks:
+        genes = all_genes[gene_start:gene_stop]
+        counts_for_chunk(genes, gene_counts[:, gene_start:gene_stop])
+        del genes
+
+    # divide by the cell sizes
+    cells_expression = np.zeros((len(labels), num_genes), dtype='float32')
+    has_cell = labels != 0
+    cells_expression[has_cell] = gene_counts[has_cell] / cell_sizes[has_cell][:, None]
     return labels, cells_expression
 
 
@@ -69,35 +185,39 @@ def write_genes_table(output_path, expression, gene_names, labels, avail_labels)
 
 def gene_assignments(segmentation_path, segmentation_key,
                      genes_path, labels, output_path,
-                     n_threads):
+                     n_threads, max_memory=None, engine='bincount'):
     """ Write a table with genes assigned to segmentation by overlap.
 
     Arguments:
         segmentation_path [str] - path to hdf5 file with the cell segmentation
         segmentation_key [str] - path in file to the segmentation dataset.
         genes_path [str] - path to hdf5 file with spatial gene expression.
-            We expect the datasets 'genes' and 'gene_names' to be present.
+            We expect the datasets 'genes' or 'genes_packed' and 'gene_names' to be present.
         labels [np.ndarray] - cell id labels
         output_path [str] - where to write the result table
         n_threads [int] - number of threads used for the computation
+        max_memory [int] - maximal number of bytes used for loading genes at once,
+            load all genes at once if None (default: None)
+        engine [str] - engine for computing the expression, see 'get_cell_expression' (default: 'bincount')
     """
 
     with open_file(segmentation_path, 'r') as f:
         segmentation = f[segmentation_key][:]
 
-    genes_dset = 'genes'
     names_dset = 'gene_names'
     with open_file(genes_path, 'r') as f:
-        ds = f[genes_dset]
+        ds = open_genes(f)
         gene_shape = ds.shape[1:]
-        all_genes = ds[:]
         gene_names = [i.decode('utf-8') for i in f[names_dset]]
 
-    # resize the segmentation to gene space
-    segmentation = resize(segmentation.astype("float32"),
-                          shape=gene_shape, order=0).astype('uint16')
-    print("Compute gene expression ...")
-    avail_labels, expression = get_cell_expression(segmentation, all_genes, n_threads)
+        # resize the segmentation to gene space
+        segmentation = resize(segmentation.astype("float32"),
+                              shape=gene_shape, order=0).astype('uint16')
+        print("Compute gene expression ...")
+        # the genes are loaded chunk-wise from the dataset if max_memory is given
+        all_genes = ds if max_memory is not None else ds[:]
+        avail_labels, expression = get_cell_expression(segmentation, all_genes, n_threads,
+                                                       max_memory=max_memory, engine=engine)
 
     print('Save results to %s' % output_path)
     write_genes_table(output_path, expression, gene_names, labels, avail_labels)
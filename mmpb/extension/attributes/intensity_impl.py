@@ -0,0 +1,186 @@
+# blockwise computation of the intensity statistics for all labels of a segmentation, can be called standalone
+from concurrent import futures
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+import nifty.tools as nt
+from elf.io import open_file
+
+INTENSITY_COLUMNS = ['intensity_mean', 'intensity_st_dev', 'intensity_median', 'intensity_iqr',
+                     'intensity_total']
+N_BINS = 256
+
+
+def _index_to_other_shape(bb, shape, other_shape):
+    # nearest neighbor mapping of the bounding box to a volume of different shape
+    indices = [(np.arange(b.start, b.stop) * osh) // sh
+               for b, sh, osh in zip(bb, shape, other_shape)]
+    other_bb = tuple(slice(int(ind[0]), int(ind[-1]) + 1) for ind in indices)
+    indices = tuple(ind - ob.start for ind, ob in zip(indices, other_bb))
+    return other_bb, np.ix_(*indices)
+
+
+def load_to_shape(ds, bb, shape):
+    """ Load the data corresponding to the bounding box bb in a volume of shape
+    from the dataset ds, resampling with nearest neighbor if the shapes don't agree.
+
+    The voxel positions are mapped for the full volume, not for the bounding box,
+    so the result does not depend on how the volume is split into blocks.
+    This differs from resizing a crop to the shape of another crop, e.g. in 'morphology_features_for_row',
+    where the voxels at the border of the crop can be mapped differently.
+    """
+    if ds.shape == tuple(shape):
+        return ds[bb]
+    other_bb, index = _index_to_other_shape(bb, shape, ds.shape)
+    return ds[other_bb][index]
+
+
+def percentiles_from_histograms(cumulative_hist, n_values, q):
+    """ Compute the exact percentile q (with linear interpolation, like np.percentile)
+    for each row of the cumulative histograms.
+    """
+    position = (q / 100.) * (n_values - 1)
+    lower_rank = np.floor(position)
+    fraction = position - lower_rank
+    upper_rank = np.minimum(lower_rank + 1, n_values - 1)
+    # the value with rank k is the first bin whose cumulative count exceeds k
+    lower = np.argmax(cumulative_hist > lower_rank[:, None], axis=1).astype('float64')
+    upper = np.argmax(cumulative_hist > upper_rank[:, None], axis=1).astype('float64')
+    return lower + fraction * (upper - lower)
+
+
+def statistics_from_histograms(hist, chunk_size=10000):
+    """ Compute mean, standard deviation, median, inter-quartile range and total
+    of the intensities from the per-label intensity histograms.
+    """
+    n_labels = hist.shape[0]
+    stats = np.full((n_labels, len(INTENSITY_COLUMNS)), np.nan, dtype='float64')
+    values = np.arange(hist.shape[1], dtype='float64')
+
+    # process the labels in chunks to limit the size of temporary arrays
+    for begin in range(0, n_labels, chunk_size):
+        end = min(begin + chunk_size, n_labels)
+        sub_hist = hist[begin:end].astype('float64')
+        n_values = sub_hist.sum(axis=1)
+        valid = n_values > 0
+        sub_hist, n_values = sub_hist[valid], n_values[valid]
+        if len(n_values) == 0:
+            continue
+
+        total = sub_hist.dot(values)
+        mean = total / n_values
+        std = np.sqrt((sub_hist * (values[None] - mean[:, None]) ** 2).sum(axis=1) / n_values)
+
+        cumulative_hist = np.cumsum(sub_hist, axis=1)
+        median = percentiles_from_histograms(cumulative_hist, n_values, 50)
+        iqr = percentiles_from_histograms(cumulative_hist, n_values, 75) -\
+            percentiles_from_histograms(cumulative_hist, n_values, 25)
+
+        stats[begin:end][valid] = np.stack([mean, std, median, iqr, total], axis=1)
+    return stats
+
+
+def intensity_statistics(seg_path, seg_key, raw_path, raw_key, label_ids,
+                         exclude_path=None, exclude_key=None, exclude_ids=None,
+                         block_shape=(64, 256, 256), bounding_boxes=None, n_threads=1):
+    """ Compute the intensity statistics for all labels in one blockwise sweep
+    over the segmentation and raw data.
+
+    Accumulates the intensity histogram for each label (raw data must be uint8)
+    and derives the exact statistics from the histograms. The segmentation
+    and exclusion mask are resampled to the shape of the raw data.
+
+    Arguments:
+        seg_path [str] - path to the segmentation
+        seg_key [str] - key of the segmentation
+        raw_path [str] - path to the raw data
+        raw_key [str] - key of the raw data
+        label_ids [np.ndarray] - the label ids for which to compute the statistics
+        exclude_path [str] - path to a segmentation that is excluded from
+            the label masks, e.g. the nucleus segmentation (default: None)
+        exclude_key [str] - key of the exclusion segmentation (default: None)
+        exclude_ids [np.ndarray] - the id in the exclusion segmentation
+            that is excluded for each label id in label_ids (default: None)
+        block_shape [tuple] - shape of the blocks processed at once (default: (64, 256, 256))
+        bounding_boxes [list] - bounding boxes of the labels in the coordinates of the raw data,
+            only the blocks overlapping them are processed (default: None = all blocks)
+        n_threads [int] - number of threads (default: 1)
+    Returns:
+        pd.DataFrame - table with the columns 'label_id' and the intensity columns
+    """
+    label_ids = np.array(label_ids, dtype='uint64')
+    max_id = int(label_ids.max())
+    # map the label ids to their index in the histograms, -1 for labels we don't compute
+    label_to_index = np.full(max_id + 2, -1, dtype='int64')
+    label_to_index[label_ids] = np.arange(len(label_ids))
+
+    have_exclude = exclude_path is not None
+    if have_exclude:
+        assert exclude_ids is not None and len(exclude_ids) == len(label_ids)
+        label_to_exclude = np.zeros(max_id + 2, dtype='uint64')
+        label_to_exclude[label_ids] = exclude_ids
+
+    hist = np.zeros((len(label_ids), N_BINS), dtype='uint64')
+    hist_flat = hist.reshape(-1)
+    lock = Lock()
+
+    f_seg, f_raw = open_file(seg_path, 'r'), open_file(raw_path, 'r')
+    ds_seg, ds_raw = f_seg[seg_key], f_raw[raw_key]
+    f_exclude = open_file(exclude_path, 'r') if have_exclude else None
+    ds_exclude = f_exclude[exclude_key] if have_exclude else None
+
+    shape = ds_raw.shape
+    blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
+
+    def accumulate_block(block_id):
+        block = blocking.getBlock(block_id)
+        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+        seg = load_to_shape(ds_seg, bb, shape)
+        seg = np.minimum(seg, max_id + 1).astype('int64')
+        index = label_to_index[seg]
+        mask = index != -1
+        if have_exclude:
+            exclude = load_to_shape(ds_exclude, bb, shape)
+            exclude_ids_block = label_to_exclude[seg]
+            mask = np.logical_and(mask, ~np.logical_and(exclude == exclude_ids_block,
+                                                        exclude_ids_block != 0))
+        if mask.sum() == 0:
+            return
+
+        # only load the raw data for blocks that contain one of the labels
+        raw = ds_raw[bb]
+        assert raw.dtype == np.dtype('uint8'), "Expect uint8 raw data, got %s" % raw.dtype
+        keys = index[mask] * N_BINS + raw[mask]
+        # counting with bincount is much faster than sorting the keys,
+        # but we only use it if the histograms are not much larger than the block
+        if hist_flat.size <= 4 * keys.size:
+            counts = np.bincount(keys, minlength=hist_flat.size).astype('uint64')
+            with lock:
+                np.add(hist_flat, counts, out=hist_flat)
+        else:
+            keys, counts = np.unique(keys, return_counts=True)
+            with lock:
+                hist_flat[keys] += counts.astype('uint64')
+
+    if bounding_boxes is None:
+        block_ids = range(blocking.numberOfBlocks)
+    else:
+        block_ids = set()
+        for bb in bounding_boxes:
+            block_ids.update(blocking.getBlockIdsOverlappingBoundingBox([b.start for b in bb],
+                                                                        [b.stop for b in bb]))
+        block_ids = sorted(block_ids)
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(accumulate_block, block_id) for block_id in block_ids]
+        [t.result() for t in tasks]
+
+    for f in (f_seg, f_raw, f_exclude):
+        if f is not None:
+            f.close()
+
+    stats = statistics_from_histograms(hist)
+    table = pd.DataFrame(stats, columns=INTENSITY_COLUMNS)
+    table.insert(0, 'label_id', label_ids.astype('float64'))
+    return table
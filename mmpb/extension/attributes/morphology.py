@@ -3,10 +3,9 @@
 import os
 import sys
 import json
-from math import ceil
+import hashlib
 
 import luigi
-import nifty.tools as nt
 import pandas as pd
 
 import cluster_tools.utils.volume_utils as vu
@@ -14,9 +13,31 @@ import cluster_tools.utils.function_utils as fu
 from cluster_tools.utils.task_utils import DummyTask
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask
 from mmpb.extension.attributes.morphology_impl import (morphology_impl_cell,
-                                                       morphology_impl_nucleus)
+                                                       morphology_impl_nucleus,
+                                                       balanced_label_ranges,
+                                                       compute_label_costs,
+                                                       get_feature_families,
+                                                       get_keys, get_scale_factor,
+                                                       peak_memory, read_table, write_table,
+                                                       run_all_filters,
+                                                       SURFACE_AREA_MODES,
+                                                       DEFAULT_MAX_BATCH_VOXELS)
 from pybdv.util import get_key
 
+# all resolutions are hard-coded for now, it would be more clean to get them from the metadata
+RAW_RESOLUTION = [0.025, 0.01, 0.01]
+NUCLEUS_RESOLUTION = [0.1, 0.08, 0.08]
+CELL_RESOLUTION = [0.025, 0.02, 0.02]
+CHROMATIN_RESOLUTION = [0.025, 0.02, 0.02]
+# number of label ids per checkpoint of a job
+DEFAULT_CHECKPOINT_CHUNK_SIZE = 1000
+# the config values that change the features; checkpoints are only re-used if they are the same
+CHECKPOINT_CONFIG_KEYS = ('compute_cell_features', 'in_table_path', 'raw_path',
+                          'nucleus_segmentation_path', 'cell_segmentation_path',
+                          'chromatin_segmentation_path', 'nucleus_mapping_path', 'region_mapping_path',
+                          'min_size', 'max_size', 'max_bb', 'scale',
+                          'feature_families', 'surface_area_mode', 'batched_texture', 'intensity_engine')
+
 #
 # Morphology Attribute Tasks
 #
@@ -28,7 +49,8 @@ class MorphologyBase(luigi.Task):
 
     task_name = 'morphology'
     src_file = os.path.abspath(__file__)
-    allow_retry = False
+    # the jobs write checkpoints and skip the labels already done when restarted
+    allow_retry = True
 
     # compute cell features or nucleus features?
     compute_cell_features = luigi.BoolParameter()
@@ -61,11 +83,32 @@ class MorphologyBase(luigi.Task):
     max_size = luigi.IntParameter(default=None)
     max_bb = luigi.IntParameter()
 
+    # names of the feature families to compute, compute all families if None
+    # (see morphology_impl.FEATURE_FAMILIES for the available families)
+    feature_families = luigi.ListParameter(default=None)
+    # method for computing the surface area, 'marching_cubes' or 'voxel_faces'
+    surface_area_mode = luigi.Parameter(default='marching_cubes')
+
     dependency = luigi.TaskParameter(default=DummyTask())
 
     def requires(self):
         return self.dependency
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        # maximal size of the union bounding box of objects that are loaded together
+        config.update({'max_batch_voxels': DEFAULT_MAX_BATCH_VOXELS})
+        # compute the texture features for all objects of a batch at once
+        config.update({'batched_texture': True})
+        # engine for the cell intensity features, 'per_row' or 'blockwise',
+        # 'per_row' reproduces the existing tables, see INTENSITY_ENGINES for the difference
+        config.update({'intensity_engine': 'per_row'})
+        # number of label ids per checkpoint, set to None to disable checkpoints
+        config.update({'checkpoint_chunk_size': DEFAULT_CHECKPOINT_CHUNK_SIZE})
+        return config
+
     def _update_config_for_cells(self, config):
         # check the relevant inputs for the cell morphology
         assert self.cell_segmentation_path is not None
@@ -104,11 +147,25 @@ class MorphologyBase(luigi.Task):
             n_labels = int(f[key].attrs['maxId']) + 1
         return n_labels
 
-    def _compute_block_len(self, number_of_labels):
-        ids_per_job = int(ceil(float(number_of_labels) / self.max_jobs))
-        return ids_per_job
+    def _get_label_costs(self):
+        # estimate the cost for each label from its bounding box in the base table,
+        # labels that are filtered out in the jobs don't have any cost
+        table = pd.read_csv(self.in_table_path, sep='\t')
+        if self.compute_cell_features:
+            table = run_all_filters(table, self.min_size, self.max_size, self.max_bb,
+                                    self.nucleus_mapping_path, self.region_mapping_path)
+            seg_path, seg_scale = self.cell_segmentation_path, self.scale - 1
+            resolution = CELL_RESOLUTION
+        else:
+            table = run_all_filters(table, self.min_size, self.max_size, self.max_bb, None, None)
+            seg_path, seg_scale = self.nucleus_segmentation_path, self.scale - 3
+            resolution = NUCLEUS_RESOLUTION
+        key_full, key = get_keys(seg_path, seg_scale)
+        scale_factor = get_scale_factor(seg_path, key_full, key, resolution)
+        return table['label_id'].values, compute_label_costs(table, scale_factor)
 
     def run_impl(self):
+        assert self.surface_area_mode in SURFACE_AREA_MODES, self.surface_area_mode
         # get the global config and init configs
         shebang = self.global_config_values()[0]
         self.init(shebang)
@@ -121,14 +178,18 @@ class MorphologyBase(luigi.Task):
         else:
             config = self._update_config_for_nuclei(config)
 
-        # TODO match block size and number of blocks
-        # we hard-code the chunk-size to 1000 for now
+        # the object sizes differ by orders of magnitude, so we split the labels
+        # into ranges of similar cost instead of ranges with the same number of labels
         number_of_labels = self._get_number_of_labels()
-        block_len = self._compute_block_len(number_of_labels)
-        block_list = vu.blocks_in_volume([number_of_labels], [block_len])
-        config.update({'block_len': block_len,
+        label_ids, label_costs = self._get_label_costs()
+        label_ranges = balanced_label_ranges(label_ids, label_costs,
+                                             number_of_labels, self.max_jobs)
+        block_list = list(range(len(label_ranges)))
+        config.update({'label_ranges': label_ranges,
                        'compute_cell_features': self.compute_cell_features,
-                       'number_of_labels': number_of_labels})
+                       'number_of_labels': number_of_labels,
+                       'feature_families': get_feature_families(self.feature_families),
+                       'surface_area_mode': self.surface_area_mode})
 
         prefix = 'cells' if self.compute_cell_features else 'nuclei'
         # prime and run the job
@@ -164,7 +225,7 @@ class MorphologySlurm(MorphologyBase, SlurmTask):
 #
 
 
-def _morphology_nuclei(config, table, label_start, label_stop):
+def _morphology_nuclei(config, table, label_start, label_stop, chunks, chunk_callback):
     # paths to raw data, nucleus segmentation and chromatin segmentation
     raw_path = config['raw_path']
     nucleus_segmentation_path = config['nucleus_segmentation_path']
@@ -175,21 +236,33 @@ def _morphology_nuclei(config, table, label_start, label_stop):
     raw_scale = config['scale']
     nucleus_scale = raw_scale - 3
     chromatin_scale = raw_scale - 1
-    # all resolutions are hard-coded for now, it would be more clean to get them from the metadata
-    raw_resolution = [0.025, 0.01, 0.01]
-    nucleus_resolution = [0.1, 0.08, 0.08]
-    chromatin_resolution = [0.025, 0.02, 0.02]
+    raw_resolution = RAW_RESOLUTION
+    nucleus_resolution = NUCLEUS_RESOLUTION
+    chromatin_resolution = CHROMATIN_RESOLUTION
+    # maximal size of the union bounding box of objects that are loaded together
+    max_batch_voxels = config.get('max_batch_voxels', DEFAULT_MAX_BATCH_VOXELS)
+    feature_families = config.get('feature_families', None)
+    surface_area_mode = config.get('surface_area_mode', 'marching_cubes')
+    batched_texture = config.get('batched_texture', True)
+    # the label range is processed by threads_per_job worker processes
+    n_workers = config.get('threads_per_job', 1)
     stats = morphology_impl_nucleus(nucleus_segmentation_path, raw_path,
                                     chromatin_segmentation_path,
                                     table, min_size, max_size, max_bb,
                                     nucleus_resolution, chromatin_resolution,
                                     raw_resolution,
                                     nucleus_scale, raw_scale, chromatin_scale,
-                                    label_start, label_stop)
+                                    label_start, label_stop,
+                                    max_batch_voxels=max_batch_voxels,
+                                    feature_families=feature_families,
+                                    surface_area_mode=surface_area_mode,
+                                    batched_texture=batched_texture,
+                                    n_workers=n_workers,
+                                    chunks=chunks, chunk_callback=chunk_callback)
     return stats
 
 
-def _morphology_cells(config, table, label_start, label_stop):
+def _morphology_cells(config, table, label_start, label_stop, chunks, chunk_callback):
     # paths to raw data, nucleus segmentation and chromatin segmentation
     raw_path = config['raw_path']
     cell_segmentation_path = config['cell_segmentation_path']
@@ -200,13 +273,20 @@ def _morphology_cells(config, table, label_start, label_stop):
     raw_scale = config['scale']
     nucleus_scale = raw_scale - 3
     cell_scale = raw_scale - 1
-    # all resolutions are hard-coded for now, it would be more clean to get them from the metadata
-    raw_resolution = [0.025, 0.01, 0.01]
-    nucleus_resolution = [0.1, 0.08, 0.08]
-    cell_resolution = [0.025, 0.02, 0.02]
+    raw_resolution = RAW_RESOLUTION
+    nucleus_resolution = NUCLEUS_RESOLUTION
+    cell_resolution = CELL_RESOLUTION
     # mapping from cells to nuclei and from cells to regions
     nucleus_mapping_path = config['nucleus_mapping_path']
     region_mapping_path = config['region_mapping_path']
+    # maximal size of the union bounding box of objects that are loaded together
+    max_batch_voxels = config.get('max_batch_voxels', DEFAULT_MAX_BATCH_VOXELS)
+    feature_families = config.get('feature_families', None)
+    surface_area_mode = config.get('surface_area_mode', 'marching_cubes')
+    batched_texture = config.get('batched_texture', True)
+    intensity_engine = config.get('intensity_engine', 'per_row')
+    # the label range is processed by threads_per_job worker processes
+    n_workers = config.get('threads_per_job', 1)
     stats = morphology_impl_cell(cell_segmentation_path, raw_path,
                                  nucleus_segmentation_path,
                                  table, nucleus_mapping_path,
@@ -214,10 +294,47 @@ def _morphology_cells(config, table, label_start, label_stop):
                                  min_size, max_size, max_bb,
                                  cell_resolution, nucleus_resolution, raw_resolution,
                                  cell_scale, raw_scale, nucleus_scale,
-                                 label_start, label_stop)
+                                 label_start, label_stop,
+                                 max_batch_voxels=max_batch_voxels,
+                                 feature_families=feature_families,
+                                 surface_area_mode=surface_area_mode,
+                                 batched_texture=batched_texture,
+                                 intensity_engine=intensity_engine,
+                                 n_workers=n_workers,
+                                 chunks=chunks, chunk_callback=chunk_callback)
     return stats
 
 
+def checkpoint_chunks(label_start, label_stop, chunk_size):
+    """ Split the label range [label_start, label_stop) into chunks for checkpointing.
+
+    The chunk boundaries are multiples of chunk_size, so the chunks don't depend
+    on how the labels were split into job ranges.
+    """
+    if not chunk_size:
+        return [(label_start, label_stop)]
+    starts = [label_start] + list(range((label_start // chunk_size + 1) * chunk_size,
+                                        label_stop, chunk_size))
+    stops = starts[1:] + [label_stop]
+    return list(zip(starts, stops))
+
+
+def checkpoint_config_hash(config):
+    """ Hash of the config values that change the features, so that checkpoints
+    computed with a different config are not re-used.
+    """
+    values = {key: config.get(key) for key in CHECKPOINT_CONFIG_KEYS}
+    values['feature_families'] = get_feature_families(values['feature_families'])
+    values['surface_area_mode'] = values['surface_area_mode'] or 'marching_cubes'
+    values['batched_texture'] = True if values['batched_texture'] is None else values['batched_texture']
+    values['intensity_engine'] = values['intensity_engine'] or 'per_row'
+    # a table that is regenerated at the same path invalidates the checkpoints
+    if values['in_table_path'] is not None:
+        with open(values['in_table_path'], 'rb') as f:
+            values['in_table_hash'] = hashlib.sha1(f.read()).hexdigest()
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+
 def morphology(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -233,30 +350,57 @@ def morphology(job_id, config_path):
 
     # determine the start and stop label for this job
     block_list = config['block_list']
-    block_len = config['block_len']
     assert len(block_list) == 1, "Expected a single block, got %i" % len(block_list)
-
-    # get the label range for this job
-    n_labels = table.shape[0]
-    blocking = nt.blocking([0], [n_labels], [block_len])
-    block = blocking.getBlock(block_list[0])
-    label_start, label_stop = block.begin[0], block.end[0]
+    label_start, label_stop = config['label_ranges'][block_list[0]]
 
     # do we compute cell or nucleus features ?
     compute_cell_features = config['compute_cell_features']
 
     if compute_cell_features:
         fu.log("Compute morphology features for cells")
-        stats = _morphology_cells(config, table, label_start, label_stop)
+        _morphology = _morphology_cells
     else:
         fu.log("Compute morphology features for nuclei")
-        stats = _morphology_nuclei(config, table, label_start, label_stop)
+        _morphology = _morphology_nuclei
 
-    # write the result
+    # compute the features chunk by chunk and write a checkpoint for each chunk,
+    # if the job is restarted we load the chunks that have already been computed
     output_prefix = config['output_prefix']
-    output_path = output_prefix + '_job%i.csv' % job_id
+    chunk_size = config.get('checkpoint_chunk_size', DEFAULT_CHECKPOINT_CHUNK_SIZE)
+    chunks = checkpoint_chunks(label_start, label_stop, chunk_size)
+    config_hash = checkpoint_config_hash(config)
+    checkpoint_paths = {chunk: output_prefix + '_%s_labels%i-%i.npz' % ((config_hash,) + chunk)
+                        for chunk in chunks}
+    fu.log("Processing labels %i to %i in %i chunks" % (label_start, label_stop, len(chunks)))
+
+    stats = {}
+    for chunk in chunks:
+        if os.path.exists(checkpoint_paths[chunk]):
+            fu.log("Load checkpoint for labels %i to %i" % chunk)
+            stats[chunk] = read_table(checkpoint_paths[chunk])
+
+    def write_checkpoint(chunk_start, chunk_stop, chunk_stats):
+        write_table(chunk_stats, checkpoint_paths[chunk_start, chunk_stop])
+        stats[chunk_start, chunk_stop] = chunk_stats
+
+    # the data and the worker processes are set up once for all chunks that are not done yet
+    missing_chunks = [chunk for chunk in chunks if chunk not in stats]
+    if missing_chunks:
+        _morphology(config, table, label_start, label_stop, missing_chunks, write_checkpoint)
+    stats = pd.concat([stats[chunk] for chunk in chunks])
+
+    # write the result as binary table, it is converted to csv after merging the jobs
+    output_path = output_prefix + '_job%i.npz' % job_id
     fu.log("Save result to %s" % output_path)
-    stats.to_csv(output_path, index=False, sep='\t')
+    write_table(stats, output_path)
+
+    # the checkpoints are contained in the job result now
+    for checkpoint_path in checkpoint_paths.values():
+        os.remove(checkpoint_path)
+
+    peak_self, peak_workers = peak_memory()
+    fu.log("Peak memory: %.1f MB in the job process, %.1f MB in a worker process" % (peak_self,
+                                                                                     peak_workers))
     fu.log_job_success(job_id)
 
 
@@ -1,4 +1,9 @@
 import os
+import resource
+import time
+from concurrent import futures
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 
 import vigra
@@ -16,6 +21,23 @@ from pybdv.metadata import get_key
 from elf.util import set_numpy_threads
 set_numpy_threads(1)
 import numpy as np
+from mmpb.extension.attributes.intensity_impl import intensity_statistics, INTENSITY_COLUMNS
+from mmpb.extension.attributes.texture_impl import BatchedTexture
+
+# maximal number of voxels in the union bounding box of a batch of objects
+DEFAULT_MAX_BATCH_VOXELS = 256 ** 3
+
+# the methods for computing the surface area
+SURFACE_AREA_MODES = ('marching_cubes', 'voxel_faces')
+# the area of the voxel faces overestimates the surface area of a smooth object
+# by a factor of 3/2 on average over all surface orientations
+VOXEL_FACE_WEIGHT = 2. / 3
+# the engines for the cell intensity features: per row from the bounding box of each object,
+# or blockwise for all objects of the label range in one sweep over the raw data.
+# 'per_row' is the default, because it reproduces the existing tables: if the segmentation and raw data
+# have different scales, 'per_row' resizes the mask of each bounding box and 'blockwise' maps each raw
+# voxel to the nearest segmentation voxel, so the voxels at the object boundaries can differ
+INTENSITY_ENGINES = ('per_row', 'blockwise')
 
 
 def log(msg):
@@ -123,55 +145,344 @@ def run_all_filters(table, min_size, max_size, max_bb, mapping_path, region_mapp
     return table
 
 
-def load_data(ds, row, scale):
+def compute_label_costs(table, scale):
+    """ Estimate the computational cost for the objects in the table.
+
+    The feature computation is dominated by operations on the bounding box
+    (marching cubes, distance transforms, texture), so we use the number of voxels
+    in the bounding box at the computation scale as cost estimate.
+    """
+    extents = [np.floor(table['bb_max_%s' % ax].values / sca) -
+               np.floor(table['bb_min_%s' % ax].values / sca) + 1
+               for ax, sca in zip('zyx', scale)]
+    return np.prod(extents, axis=0)
+
+
+def _pack_label_ranges(cumulative_costs, max_cost, max_ranges):
+    # greedily pack the labels into contiguous ranges with a cost of at most max_cost,
+    # return None if this needs more than max_ranges ranges
+    number_of_labels = len(cumulative_costs)
+    label_ranges = []
+    start = 0
+    while start < number_of_labels:
+        cost_before = cumulative_costs[start - 1] if start > 0 else 0.
+        stop = int(np.searchsorted(cumulative_costs, cost_before + max_cost, side='right'))
+        stop = max(stop, start + 1)
+        label_ranges.append([start, stop])
+        if len(label_ranges) > max_ranges:
+            return None
+        start = stop
+    return label_ranges
+
+
+def balanced_label_ranges(label_ids, costs, number_of_labels, n_jobs, n_iterations=64):
+    """ Split the label ids [0, number_of_labels) into at most n_jobs contiguous ranges
+    so that the cost of the most expensive range is minimal.
+    """
+    label_costs = np.zeros(number_of_labels, dtype='float64')
+    label_costs[np.array(label_ids, dtype='uint64')] = costs
+    cumulative_costs = np.cumsum(label_costs)
+    total_cost = cumulative_costs[-1]
+    if total_cost == 0 or n_jobs == 1:
+        return [[0, number_of_labels]]
+
+    # bisect the smallest maximal range cost for which the labels fit into n_jobs ranges
+    lower, upper = label_costs.max(), total_cost
+    label_ranges = _pack_label_ranges(cumulative_costs, upper, n_jobs)
+    for _ in range(n_iterations):
+        max_cost = (lower + upper) / 2
+        ranges = _pack_label_ranges(cumulative_costs, max_cost, n_jobs)
+        if ranges is None:
+            lower = max_cost
+        else:
+            upper, label_ranges = max_cost, ranges
+        if upper - lower <= 1e-6 * total_cost:
+            break
+    return label_ranges
+
+
+def get_bb(row, scale):
     # compute the bounding box from the row information
     mins = [row.bb_min_z, row.bb_min_y, row.bb_min_x]
     maxs = [row.bb_max_z, row.bb_max_y, row.bb_max_x]
     mins = [int(mi / sca) for mi, sca in zip(mins, scale)]
     maxs = [int(ma / sca) + 1 for ma, sca in zip(maxs, scale)]
-    bb = tuple(slice(mi, ma) for mi, ma in zip(mins, maxs))
-    # load the data from the bounding box
-    return ds[bb]
-
-
-def generate_column_names(raw_path, chromatin_path, exclude_path):
-    columns = ['label_id']
-    morph_columns = ['shape_volume_in_microns', 'shape_extent', 'shape_equiv_diameter',
-                     'shape_major_axis', 'shape_minor_axis', 'shape_surface_area', 'shape_sphericity',
-                     'shape_max_radius']
-
-    columns += morph_columns
+    return tuple(slice(mi, ma) for mi, ma in zip(mins, maxs))
 
-    if raw_path is not None:
-        intensity_columns = ['intensity_mean', 'intensity_st_dev', 'intensity_median', 'intensity_iqr',
-                             'intensity_total']
-        texture_columns = ['texture_hara%s' % x for x in range(1, 14)]
 
-        columns += intensity_columns
+def load_data(ds, row, scale):
+    # load the data from the bounding box
+    return ds[get_bb(row, scale)]
+
+
+def morton_codes(coords, n_bits=21):
+    """ Compute the z-order (morton) code for non-negative integer coordinates.
+    """
+    coords = coords.astype('uint64')
+    ndim = coords.shape[1]
+    codes = np.zeros(len(coords), dtype='uint64')
+    for bit in range(n_bits):
+        for d in range(ndim):
+            codes |= ((coords[:, d] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(ndim * bit + d)
+    return codes
+
+
+def make_batches(table, scale, chunks, max_batch_voxels):
+    """ Group the rows of the table into spatially clustered batches.
+
+    The rows are sorted along the z-order curve of their bounding box centers
+    (in units of the chunk shape) and grouped greedily into batches
+    whose union bounding box has at most max_batch_voxels voxels.
+    Rows with a bounding box that is larger than max_batch_voxels form a batch on their own.
+    """
+    rows = list(table.itertuples(index=False))
+    if not rows:
+        return []
+    bbs = [get_bb(row, scale) for row in rows]
+    begins = np.array([[b.start for b in bb] for bb in bbs])
+    ends = np.array([[b.stop for b in bb] for bb in bbs])
+
+    centers = (begins + ends) // 2 // np.array(chunks)
+    order = np.argsort(morton_codes(centers), kind='stable')
+
+    batches = []
+    batch, batch_begin, batch_end = [], None, None
+    for idx in order:
+        begin, end = begins[idx], ends[idx]
+        if batch:
+            new_begin, new_end = np.minimum(batch_begin, begin), np.maximum(batch_end, end)
+            if np.prod(new_end - new_begin) <= max_batch_voxels:
+                batch.append(rows[idx])
+                batch_begin, batch_end = new_begin, new_end
+                continue
+            batches.append(batch)
+        batch, batch_begin, batch_end = [rows[idx]], begin, end
+    batches.append(batch)
+    return batches
+
+
+class BatchLoader:
+    """ Load the union bounding box of a batch of rows from a dataset once
+    and serve the bounding boxes of the individual rows from memory.
+    """
+    def __init__(self, ds, scale):
+        self.ds = ds
+        self.scale = scale
+        self.shape = ds.shape
+        self.chunks = getattr(ds, 'chunks', None)
+        self.data = None
+        self.offset = None
+        # keep track of the loaded data for logging and benchmarking
+        self.n_voxels_loaded = 0
+        self.n_chunks_loaded = 0
+
+    def _clip(self, bb):
+        return tuple(slice(min(b.start, sh), min(b.stop, sh))
+                     for b, sh in zip(bb, self.shape))
+
+    def load_batch(self, rows):
+        bbs = [self._clip(get_bb(row, self.scale)) for row in rows]
+        begin = [min(bb[d].start for bb in bbs) for d in range(len(self.shape))]
+        end = [max(bb[d].stop for bb in bbs) for d in range(len(self.shape))]
+        self.offset = begin
+        self.data = self.ds[tuple(slice(b, e) for b, e in zip(begin, end))]
+
+        self.n_voxels_loaded += self.data.size
+        if self.chunks is not None:
+            self.n_chunks_loaded += int(np.prod([(e - 1) // ch - b // ch + 1
+                                                 for b, e, ch in zip(begin, end, self.chunks)]))
+
+    def load_data(self, row):
+        bb = self._clip(get_bb(row, self.scale))
+        bb = tuple(slice(b.start - off, b.stop - off) for b, off in zip(bb, self.offset))
+        # return a copy, so that in-place changes of the crop don't affect the batch
+        return self.data[bb].copy()
+
+
+class FeatureTimer:
+    """ Accumulate the computation time per feature family
+    and the time saved by computing arrays that are shared by several features only once.
+    """
+    def __init__(self):
+        self.family_times = defaultdict(float)
+        self.saved_times = defaultdict(float)
+
+    @contextmanager
+    def time_family(self, family):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.family_times[family] += time.time() - t0
+
+    @contextmanager
+    def time_shared(self, family, n_uses):
+        # the arrays computed in this context are used n_uses times,
+        # so computing them for each use would take n_uses - 1 times longer
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.saved_times[family] += (n_uses - 1) * (time.time() - t0)
+
+    def summary(self):
+        msgs = ["%s: %.2f s" % (family, t) for family, t in self.family_times.items()]
+        saved_msgs = ["%s: %.3f s" % (family, t) for family, t in self.saved_times.items()]
+        return "%s; saved by shared arrays: %s" % (", ".join(msgs), ", ".join(saved_msgs) or "none")
+
+
+def resize_to_shape(data, shape):
+    # nearest neighbor resizing that preserves the dtype
+    if data.shape == tuple(shape):
+        return data
+    dtype = data.dtype
+    data = vigra.sampling.resize(data.astype('float32'), shape=tuple(shape), order=0)
+    return data.astype(dtype)
+
+
+def clean_texture_mask(mask):
+    # haralick errors if there are small, isolated spots (because I'm using ignore zeros as true)
+    # so here remove components that are < 10 pixels
+    # may still error in some cases
+    labelled = label(mask)
+    if len(np.unique(labelled)) > 2:
+        labelled = remove_small_objects(labelled, min_size=10)
+        mask = labelled != 0
+        mask = mask.astype('uint8')
+    return mask
+
+
+SHAPE_COLUMNS = ['shape_volume_in_microns', 'shape_extent', 'shape_equiv_diameter',
+                 'shape_major_axis', 'shape_minor_axis', 'shape_surface_area', 'shape_sphericity',
+                 'shape_max_radius']
+RADIAL_INTENSITY_COLUMNS = ['%s_%s' % (var, val) for val in [25, 50, 75, 100] for var in INTENSITY_COLUMNS]
+TEXTURE_COLUMNS = ['texture_hara%s' % x for x in range(1, 14)]
+EDT_COLUMNS = ['shape_edt_mean', 'shape_edt_stdev', 'shape_edt_median', 'shape_edt_iqr']
+EDT_COLUMNS += ['shape_percent_%s' % var for var in [25, 50, 75, 100]]
+
+# a family of features:
+# columns - the column names
+# needs_raw - whether the features are computed from the raw data
+# per_object - whether the features are computed for the whole object
+FeatureFamily = namedtuple('FeatureFamily', ['columns', 'needs_raw', 'per_object'])
+
+# registry of the feature families, in the order of the output columns for the whole object
+FEATURE_FAMILIES = OrderedDict([
+    ('shape', FeatureFamily(SHAPE_COLUMNS, False, True)),
+    ('intensity', FeatureFamily(INTENSITY_COLUMNS, True, True)),
+    ('radial_intensity', FeatureFamily(RADIAL_INTENSITY_COLUMNS, True, True)),
+    ('texture', FeatureFamily(TEXTURE_COLUMNS, True, True)),
+    ('chromatin', FeatureFamily(EDT_COLUMNS, False, False))
+])
+# the feature families that are computed for the heterochromatin and euchromatin phases,
+# in the order of the output columns for each phase
+PHASE_ORDER = ('shape', 'chromatin', 'intensity', 'texture')
+
+
+def get_feature_families(feature_families=None):
+    """ Check the names of the selected feature families and return them in the registry order.
+    All feature families are selected if feature_families is None.
+    """
+    if feature_families is None:
+        return list(FEATURE_FAMILIES.keys())
+    invalid_families = set(feature_families) - set(FEATURE_FAMILIES.keys())
+    if invalid_families:
+        raise ValueError("Invalid feature families %s, expected names from %s" % (
+            ", ".join(sorted(invalid_families)), ", ".join(FEATURE_FAMILIES.keys())
+        ))
+    return [name for name in FEATURE_FAMILIES if name in feature_families]
+
+
+def needs_raw_data(feature_families):
+    return any(FEATURE_FAMILIES[name].needs_raw for name in feature_families)
+
+
+def phase_column_names(have_raw, feature_families):
+    # the column names for a chromatin phase, without the phase suffix
+    columns = []
+    for name in PHASE_ORDER:
+        family = FEATURE_FAMILIES[name]
+        if name not in feature_families or (family.needs_raw and not have_raw):
+            continue
+        columns += family.columns
+    return columns
 
-        if exclude_path is None:
-            # radial intensity columns
-            for val in [25, 50, 75, 100]:
-                columns += ['%s_%s' % (var, val) for var in intensity_columns]
 
-        columns += texture_columns
+def generate_column_names(raw_path, chromatin_path, exclude_path, feature_families=None):
+    feature_families = get_feature_families(feature_families)
+    columns = ['label_id']
 
-    if chromatin_path is not None:
-        edt_columns = ['shape_edt_mean', 'shape_edt_stdev', 'shape_edt_median', 'shape_edt_iqr']
-        edt_columns += ['shape_percent_%s' % var for var in [25, 50, 75, 100]]
+    for name in feature_families:
+        family = FEATURE_FAMILIES[name]
+        if not family.per_object or (family.needs_raw and raw_path is None):
+            continue
+        # we don't compute the radial intensity features if the nucleus area is excluded
+        if name == 'radial_intensity' and exclude_path is not None:
+            continue
+        columns += family.columns
 
+    if chromatin_path is not None and 'chromatin' in feature_families:
+        phase_columns = phase_column_names(raw_path is not None, feature_families)
         for phase in ['_het', '_eu']:
-            columns += [var + phase for var in morph_columns]
-            columns += [var + phase for var in edt_columns]
-
-            if raw_path is not None:
-                columns += [var + phase for var in intensity_columns]
-                columns += [var + phase for var in texture_columns]
+            columns += [var + phase for var in phase_columns]
 
     return columns
 
 
-def morphology_row_features(mask, scale):
+def write_table(table, path):
+    """ Write the numerical table to a binary columnar npz file.
+
+    The file is written to a temporary path first and moved afterwards,
+    so that a killed job never leaves a partially written table.
+    """
+    tmp_path = path + '.tmp'
+    # pass a file object, otherwise numpy appends '.npz' to the temporary path
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, columns=np.array(table.columns, dtype='U'),
+                 values=table.values.astype('float64').T)
+    os.replace(tmp_path, path)
+
+
+def read_table(path):
+    """ Read a table written by 'write_table'.
+    """
+    with np.load(path) as f:
+        columns, values = f['columns'], f['values']
+    return pd.DataFrame(OrderedDict(zip(columns, values)), columns=columns)
+
+
+def merge_tables(paths):
+    """ Merge the tables written by 'write_table' and sort them by label id.
+    """
+    columns, values = None, []
+    for path in paths:
+        with np.load(path) as f:
+            if columns is None:
+                columns = f['columns']
+            assert np.array_equal(columns, f['columns']), "Tables have different columns"
+            values.append(f['values'])
+    values = np.concatenate(values, axis=1)
+    values = values[:, np.argsort(values[0], kind='stable')]
+    return pd.DataFrame(OrderedDict(zip(columns, values)), columns=columns)
+
+
+def voxel_face_surface_area(mask, scale):
+    """ Estimate the surface area from the weighted number of boundary faces of the mask.
+    """
+    surface_area = 0.
+    for axis in range(mask.ndim):
+        # the number of faces between foreground and background along this axis,
+        # including the faces at the boundary of the mask array
+        first = np.take(mask, 0, axis=axis)
+        last = np.take(mask, -1, axis=axis)
+        n_faces = np.count_nonzero(np.diff(mask, axis=axis))
+        n_faces += np.count_nonzero(first) + np.count_nonzero(last)
+        face_area = np.prod([sca for ax, sca in enumerate(scale) if ax != axis])
+        surface_area += n_faces * face_area
+    return VOXEL_FACE_WEIGHT * surface_area
+
+
+def morphology_row_features(mask, scale, surface_area_mode='marching_cubes'):
     # Calculate stats from skimage
     ski_morph = regionprops(mask.astype('uint8'))
 
@@ -182,14 +493,22 @@ def morphology_row_features(mask, scale):
     major_axis = ski_morph[0]['major_axis_length']
     minor_axis = ski_morph[0]['minor_axis_length']
 
-    # The mesh calculation below fails if an edge of the segmentation is right up against the
-    # edge of the volume - gives an open, rather than a closed surface
-    # Pad by a few pixels to avoid this
-    mask = pad(mask, 10, mode='constant')
-
-    # surface area of mesh around object (other ways to calculate better?)
-    verts, faces, normals, values = marching_cubes_lewiner(mask, spacing=tuple(scale))
-    surface_area = mesh_surface_area(verts, faces)
+    if surface_area_mode == 'marching_cubes':
+        # The mesh calculation below fails if an edge of the segmentation is right up against the
+        # edge of the volume - gives an open, rather than a closed surface
+        # Pad by a few pixels to avoid this
+        mask = pad(mask, 10, mode='constant')
+
+        # surface area of mesh around object (other ways to calculate better?)
+        verts, faces, normals, values = marching_cubes_lewiner(mask, spacing=tuple(scale))
+        surface_area = mesh_surface_area(verts, faces)
+    elif surface_area_mode == 'voxel_faces':
+        surface_area = voxel_face_surface_area(mask, scale)
+        # padding by a single pixel is sufficient for the distance transform
+        mask = pad(mask, 1, mode='constant')
+    else:
+        raise ValueError("Invalid surface area mode %s, expected one of %s" % (surface_area_mode,
+                                                                               ", ".join(SURFACE_AREA_MODES)))
 
     # sphericity (as in morpholibj)
     # Should run from zero to one
@@ -224,26 +543,19 @@ def radial_intensity_row_features(raw, mask, scale, stops=(0.0, 0.25, 0.5, 0.75,
     edt = distance_transform_edt(mask, sampling=scale, return_distances=True)
     edt = edt / np.max(edt)
 
-    bottoms = stops[0:len(stops) - 1]
-    tops = stops[1:]
-
-    radial_masks = [np.logical_and(edt > b, edt <= t) for b, t in zip(bottoms, tops)]
-
-    for m in radial_masks:
+    for m in radial_zones(edt, stops):
         result += intensity_row_features(raw, m)
 
     return result
 
 
-def texture_row_features(raw, mask):
-    # errors if there are small, isolated spots (because I'm using ignore zeros as true)
-    # so here remove components that are < 10 pixels
-    # may still error in some cases
-    labelled = label(mask)
-    if len(np.unique(labelled)) > 2:
-        labelled = remove_small_objects(labelled, min_size=10)
-        mask = labelled != 0
-        mask = mask.astype('uint8')
+def texture_row_features(raw, mask, texture_engine=None):
+    mask = clean_texture_mask(mask)
+
+    # defer the computation to the batched texture engine; it returns a placeholder
+    # that is replaced by the features once they are computed for the whole batch
+    if texture_engine is not None:
+        return (texture_engine.add(raw, mask),)
 
     # set regions outside mask to zero
     raw_copy = raw.copy()
@@ -259,13 +571,18 @@ def texture_row_features(raw, mask):
     return tuple(hara)
 
 
-def radial_distribution(edt, mask, stops=(0.0, 0.25, 0.5, 0.75, 1.0)):
-    result = ()
-
+def radial_zones(edt, stops=(0.0, 0.25, 0.5, 0.75, 1.0)):
+    # masks of the zones between the stops of the normalized distance transform
     bottoms = stops[0:len(stops) - 1]
     tops = stops[1:]
+    return [np.logical_and(edt > b, edt <= t) for b, t in zip(bottoms, tops)]
+
 
-    radial_masks = [np.logical_and(edt > b, edt <= t) for b, t in zip(bottoms, tops)]
+def radial_distribution(edt, mask, stops=(0.0, 0.25, 0.5, 0.75, 1.0), zones=None):
+    result = ()
+
+    # the zones can be passed if they are shared with other masks
+    radial_masks = radial_zones(edt, stops) if zones is None else zones
 
     for m in radial_masks:
         # percent of that zone that is covered by the mask
@@ -274,136 +591,361 @@ def radial_distribution(edt, mask, stops=(0.0, 0.25, 0.5, 0.75, 1.0)):
     return result
 
 
-def chromatin_row_features(chromatin, edt, raw, scale_chromatin):
+def chromatin_row_features(chromatin, edt, raw, scale_chromatin, feature_families=None,
+                           surface_area_mode='marching_cubes', texture_engine=None,
+                           zones=None, raw_chromatin=None):
+    # the radial zones of the edt and the chromatin mask resized to the raw data
+    # can be passed if they were computed from arrays shared with the other chromatin phase
+    feature_families = get_feature_families(feature_families)
     result = ()
 
-    result += morphology_row_features(chromatin, scale_chromatin)
+    if 'shape' in feature_families:
+        result += morphology_row_features(chromatin, scale_chromatin, surface_area_mode)
 
     # edt stats i.e. stats on distribution of chromatin, dropping the total value
     result += intensity_row_features(edt, chromatin)[:-1]
-    result += radial_distribution(edt, chromatin)
+    result += radial_distribution(edt, chromatin, zones=zones)
 
     if raw is not None:
         # resize the chromatin masks if not same size as raw
-        chromatin_type = chromatin.dtype
-        if chromatin.shape != raw.shape:
-            chromatin = chromatin.astype('float32')
-            chromatin = vigra.sampling.resize(chromatin, shape=raw.shape, order=0)
-            chromatin = chromatin.astype(chromatin_type)
+        chromatin = resize_to_shape(chromatin, raw.shape) if raw_chromatin is None else raw_chromatin
 
-        result += intensity_row_features(raw, chromatin)
-        result += texture_row_features(raw, chromatin)
+        if 'intensity' in feature_families:
+            result += intensity_row_features(raw, chromatin)
+        if 'texture' in feature_families:
+            result += texture_row_features(raw, chromatin, texture_engine)
 
     return result
 
 
-# compute morphology (and intensity features) for label range
-def morphology_features_for_label_range(table, ds, ds_raw,
-                                        ds_chromatin,
-                                        ds_exclude,
-                                        scale_factor_seg, scale_factor_raw,
-                                        scale_factor_chromatin,
-                                        scale_factor_exclude,
-                                        label_begin, label_end):
-    label_range = np.logical_and(table['label_id'] >= label_begin, table['label_id'] < label_end)
-    sub_table = table.loc[label_range, :]
-    stats = []
-    for row in sub_table.itertuples(index=False):
-        label_id = int(row.label_id)
-        log("Processing id %i" % label_id)
-
-        # load the segmentation data from the bounding box corresponding
-        # to this row
-        seg = load_data(ds, row, scale_factor_seg)
-
-        # compute the segmentation mask and check that we have
-        # foreground in the mask
-        seg_mask = seg == label_id
-        if seg_mask.sum() == 0:
-            # if the seg mask is empty, we simply skip this label-id
-            log("Skip empty id %i" % label_id)
-            continue
-
-        # compute the morphology features from the segmentation mask
-        result = (float(label_id),) + morphology_row_features(seg_mask, scale_factor_seg)
-
-        if ds_exclude is not None:
-            exclude = load_data(ds_exclude, row, scale_factor_exclude)
-            exclude_type = exclude.dtype
-
-            # resize to fit seg
-            if exclude.shape != seg_mask.shape:
-                exclude = exclude.astype('float32')
-                exclude = vigra.sampling.resize(exclude, shape=seg_mask.shape, order=0)
-                exclude = exclude.astype(exclude_type)
-
-            # binary for correct nucleus
-            exclude = exclude == int(row.nucleus_id)
-
-            # remove nucleus area form seg_mask
-            seg_mask[exclude] = False
-
-        # compute the intensity features from raw data and segmentation mask
-        if ds_raw is not None:
-            raw = load_data(ds_raw, row, scale_factor_raw)
-
-            # resize the segmentation mask if it does not fit the raw data
-            seg_mask_type = seg_mask.dtype
-
-            if seg_mask.shape != raw.shape:
-                seg_mask = seg_mask.astype('float32')
-                seg_mask = vigra.sampling.resize(seg_mask, shape=raw.shape, order=0)
-                seg_mask = seg_mask.astype(seg_mask_type)
-
-            result += intensity_row_features(raw, seg_mask)
-            # doesn't make sense to run the radial intensity if the nucleus area is being excluded, as the euclidean
-            # distance transform then gives distance from the outside & nuclear surface - hard to interpret
-            if ds_exclude is None:
+# compute morphology (and intensity features) for a single row
+def morphology_features_for_row(row, seg_loader, raw_loader,
+                                chromatin_loader, exclude_loader,
+                                scale_factor_seg, scale_factor_raw,
+                                scale_factor_chromatin, timer=None,
+                                feature_families=None, surface_area_mode='marching_cubes',
+                                texture_engine=None):
+    label_id = int(row.label_id)
+    log("Processing id %i" % label_id)
+
+    timer = FeatureTimer() if timer is None else timer
+    feature_families = get_feature_families(feature_families)
+
+    # load the segmentation data from the bounding box corresponding
+    # to this row
+    seg = seg_loader.load_data(row)
+
+    # compute the segmentation mask and check that we have
+    # foreground in the mask
+    seg_mask = seg == label_id
+    if seg_mask.sum() == 0:
+        # if the seg mask is empty, we simply skip this label-id
+        log("Skip empty id %i" % label_id)
+        return None
+
+    result = (float(label_id),)
+
+    # compute the morphology features from the segmentation mask
+    if 'shape' in feature_families:
+        with timer.time_family('shape'):
+            result += morphology_row_features(seg_mask, scale_factor_seg, surface_area_mode)
+
+    if exclude_loader is not None:
+        # resize to fit seg
+        exclude = resize_to_shape(exclude_loader.load_data(row), seg_mask.shape)
+
+        # binary for correct nucleus
+        exclude = exclude == int(row.nucleus_id)
+
+        # remove nucleus area form seg_mask
+        seg_mask[exclude] = False
+
+    # compute the intensity features from raw data and segmentation mask
+    if raw_loader is not None:
+        raw = raw_loader.load_data(row)
+
+        # resize the segmentation mask if it does not fit the raw data
+        seg_mask = resize_to_shape(seg_mask, raw.shape)
+
+        if 'intensity' in feature_families:
+            with timer.time_family('intensity'):
+                result += intensity_row_features(raw, seg_mask)
+        # doesn't make sense to run the radial intensity if the nucleus area is being excluded,
+        # as the euclidean distance transform then gives distance from the outside & nuclear surface
+        # - hard to interpret
+        if exclude_loader is None and 'radial_intensity' in feature_families:
+            with timer.time_family('radial_intensity'):
                 result += radial_intensity_row_features(raw, seg_mask, scale_factor_raw)
-            result += texture_row_features(raw, seg_mask)
+        if 'texture' in feature_families:
+            with timer.time_family('texture'):
+                result += texture_row_features(raw, seg_mask, texture_engine)
 
-        if ds_chromatin is not None:
-            chromatin = load_data(ds_chromatin, row, scale_factor_chromatin)
+    if chromatin_loader is not None:
+        chromatin = chromatin_loader.load_data(row)
 
-            # set to 1 (heterochromatin), 2 (euchromatin)
-            heterochromatin = chromatin == label_id + 12000
-            euchromatin = chromatin == label_id
+        # set to 1 (heterochromatin), 2 (euchromatin)
+        heterochromatin = chromatin == label_id + 12000
+        euchromatin = chromatin == label_id
 
-            # skip if no chromatin segmentation
-            total_heterochromatin = heterochromatin.sum()
-            total_euchromatin = euchromatin.sum()
-            if total_heterochromatin == 0 and total_euchromatin.sum() == 0:
-                continue
+        # skip if no chromatin segmentation
+        total_heterochromatin = heterochromatin.sum()
+        total_euchromatin = euchromatin.sum()
+        if total_heterochromatin == 0 and total_euchromatin.sum() == 0:
+            return None
+
+        # we also use the chromatin segmentation to skip nuclei if the chromatin features are not computed
+        if 'chromatin' not in feature_families:
+            return result
 
+        with timer.time_family('chromatin'):
             # euclidean distance transform for whole nucleus, normalised to run from 0 to 1
             whole_nucleus = np.logical_or(heterochromatin, euchromatin)
-            edt = distance_transform_edt(whole_nucleus, sampling=scale_factor_chromatin, return_distances=True)
+            edt = distance_transform_edt(whole_nucleus, sampling=scale_factor_chromatin,
+                                         return_distances=True)
             edt = edt / np.max(edt)
 
-            if ds_raw is None:
+            if raw_loader is None:
                 raw = None
+            n_phase_columns = len(phase_column_names(raw is not None, feature_families))
+
+            # the radial zones of the nucleus are the same for both phases and resizing the chromatin
+            # labels to the raw data once is the same as resizing the mask of each phase,
+            # because the resizing uses nearest neighbor interpolation
+            n_phases = int(total_heterochromatin != 0) + int(total_euchromatin != 0)
+            with timer.time_shared('chromatin', n_phases):
+                zones = radial_zones(edt)
+                raw_chromatin = None if raw is None else resize_to_shape(chromatin, raw.shape)
 
             if total_heterochromatin != 0:
-                result += chromatin_row_features(heterochromatin, edt, raw, scale_factor_chromatin)
+                raw_heterochromatin = None if raw is None else raw_chromatin == label_id + 12000
+                result += chromatin_row_features(heterochromatin, edt, raw, scale_factor_chromatin,
+                                                 feature_families, surface_area_mode, texture_engine,
+                                                 zones, raw_heterochromatin)
             else:
-                result += (0.,) * 36
+                result += (0.,) * n_phase_columns
 
             if total_euchromatin != 0:
-                result += chromatin_row_features(euchromatin, edt, raw, scale_factor_chromatin)
+                raw_euchromatin = None if raw is None else raw_chromatin == label_id
+                result += chromatin_row_features(euchromatin, edt, raw, scale_factor_chromatin,
+                                                 feature_families, surface_area_mode, texture_engine,
+                                                 zones, raw_euchromatin)
             else:
-                result += (0.,) * 36
+                result += (0.,) * n_phase_columns
+
+    return result
 
-        stats.append(result)
+
+# compute morphology (and intensity features) for label range
+def morphology_features_for_label_range(table, ds, ds_raw,
+                                        ds_chromatin,
+                                        ds_exclude,
+                                        scale_factor_seg, scale_factor_raw,
+                                        scale_factor_chromatin,
+                                        scale_factor_exclude,
+                                        label_begin, label_end,
+                                        max_batch_voxels=DEFAULT_MAX_BATCH_VOXELS,
+                                        feature_families=None,
+                                        surface_area_mode='marching_cubes',
+                                        batched_texture=True):
+    label_range = np.logical_and(table['label_id'] >= label_begin, table['label_id'] < label_end)
+    sub_table = table.loc[label_range, :]
+
+    # we process the labels in spatially clustered batches and load the data
+    # for the union bounding box of each batch only once, because neighboring
+    # objects share most of their chunks
+    seg_loader = BatchLoader(ds, scale_factor_seg)
+    raw_loader = None if ds_raw is None else BatchLoader(ds_raw, scale_factor_raw)
+    chromatin_loader = None if ds_chromatin is None else BatchLoader(ds_chromatin,
+                                                                     scale_factor_chromatin)
+    exclude_loader = None if ds_exclude is None else BatchLoader(ds_exclude, scale_factor_exclude)
+    loaders = [loader for loader in (seg_loader, raw_loader, chromatin_loader, exclude_loader)
+               if loader is not None]
+
+    chunks = seg_loader.chunks
+    if chunks is None:
+        chunks = (64, 64, 64)
+    batches = make_batches(sub_table, scale_factor_seg, chunks, max_batch_voxels)
+    log("Processing %i labels in %i batches" % (len(sub_table), len(batches)))
+
+    # compute the texture features for all objects of a batch at once
+    batched_texture = batched_texture and raw_loader is not None and\
+        'texture' in get_feature_families(feature_families)
+
+    stats = []
+    timer = FeatureTimer()
+    for batch in batches:
+        for loader in loaders:
+            loader.load_batch(batch)
+        texture_engine = BatchedTexture() if batched_texture else None
+
+        batch_stats = []
+        for row in batch:
+            result = morphology_features_for_row(row, seg_loader, raw_loader,
+                                                 chromatin_loader, exclude_loader,
+                                                 scale_factor_seg, scale_factor_raw,
+                                                 scale_factor_chromatin, timer=timer,
+                                                 feature_families=feature_families,
+                                                 surface_area_mode=surface_area_mode,
+                                                 texture_engine=texture_engine)
+            if result is not None:
+                batch_stats.append(result)
+
+        if batched_texture:
+            with timer.time_family('texture'):
+                texture_engine.compute()
+            batch_stats = [texture_engine.fill(result) for result in batch_stats]
+        stats.extend(batch_stats)
+
+    log("Loaded %i chunks (%i voxels) of segmentation data" % (seg_loader.n_chunks_loaded,
+                                                               seg_loader.n_voxels_loaded))
+    log("Feature timings: %s" % timer.summary())
+    # restore the label order
+    stats.sort(key=lambda result: result[0])
     return stats
 
 
+def _open_datasets(paths, keys):
+    files = [None if path is None else open_file(path, 'r') for path in paths]
+    datasets = [None if f is None else f[key] for f, key in zip(files, keys)]
+    return files, datasets
+
+
+def _features_for_datasets(datasets, scale_factors, table, label_start, label_stop, kwargs):
+    ds, ds_raw, ds_chromatin, ds_exclude = datasets
+    scale_factor_seg, scale_factor_raw, scale_factor_chromatin, scale_factor_exclude = scale_factors
+    return morphology_features_for_label_range(table, ds, ds_raw, ds_chromatin, ds_exclude,
+                                               scale_factor_seg, scale_factor_raw,
+                                               scale_factor_chromatin, scale_factor_exclude,
+                                               label_start, label_stop, **kwargs)
+
+
+# the dataset handles of a worker process, they can't be shared between processes
+_worker_datasets = None
+
+
+def _init_worker(paths, keys):
+    global _worker_datasets
+    # the files stay open for the lifetime of the worker process
+    _worker_datasets = _open_datasets(paths, keys)[1]
+
+
+def _worker_features(scale_factors, table, label_start, label_stop, kwargs):
+    return _features_for_datasets(_worker_datasets, scale_factors, table, label_start, label_stop, kwargs)
+
+
+def features_for_label_chunks(paths, keys, scale_factors, table, chunks, n_workers=1, **kwargs):
+    """ Compute the features for the label ranges in chunks with n_workers processes
+    and yield the features of each chunk in the order of the chunks.
+
+    The datasets are opened and the worker processes are started once for all chunks.
+    Each chunk is split into sub-ranges of similar cost, which are processed
+    by the worker processes. The results of a chunk are merged in label order.
+
+    Arguments:
+        paths [listlike] - paths to the segmentation, raw data, chromatin segmentation
+            and exclusion segmentation. Pass None for the data that is not used.
+        keys [listlike] - keys of the datasets, in the same order as paths
+        scale_factors [listlike] - scale factors of the datasets, in the same order as paths
+        table [pd.DataFrame] - table with default attributes
+        chunks [listlike] - label ranges (label_start, label_stop)
+        n_workers [int] - number of worker processes (default: 1)
+        kwargs - keyword arguments for 'morphology_features_for_label_range'
+    """
+    if n_workers <= 1:
+        files, datasets = _open_datasets(paths, keys)
+        try:
+            for label_start, label_stop in chunks:
+                yield label_start, label_stop, _features_for_datasets(datasets, scale_factors, table,
+                                                                      label_start, label_stop, kwargs)
+        finally:
+            for f in files:
+                if f is not None:
+                    f.close()
+        return
+
+    with futures.ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(paths, keys)) as pp:
+        # submit the sub-ranges of all chunks at once, so that the workers don't wait for the slowest
+        # sub-range of a chunk before starting on the next one
+        chunk_tasks = []
+        for label_start, label_stop in chunks:
+            label_range = np.logical_and(table['label_id'] >= label_start, table['label_id'] < label_stop)
+            chunk_table = table.loc[label_range, :]
+            label_ids = (chunk_table['label_id'].values - label_start).astype('uint64')
+            costs = compute_label_costs(chunk_table, scale_factors[0])
+            sub_ranges = balanced_label_ranges(label_ids, costs, int(label_stop - label_start), n_workers)
+            sub_ranges = [(start + label_start, stop + label_start) for start, stop in sub_ranges]
+            log("Split label range %i to %i into %i sub-ranges for %i workers" % (label_start, label_stop,
+                                                                                  len(sub_ranges), n_workers))
+
+            tasks = []
+            for start, stop in sub_ranges:
+                # only send the rows of the sub-range to the worker
+                sub_table = chunk_table.loc[np.logical_and(chunk_table['label_id'] >= start,
+                                                           chunk_table['label_id'] < stop), :]
+                tasks.append(pp.submit(_worker_features, scale_factors, sub_table, start, stop, kwargs))
+            chunk_tasks.append((label_start, label_stop, tasks))
+
+        for label_start, label_stop, tasks in chunk_tasks:
+            # the sub-ranges are ordered, so concatenating the results keeps the label order
+            yield label_start, label_stop, [stat for t in tasks for stat in t.result()]
+
+
+def features_for_label_range(paths, keys, scale_factors, table,
+                             label_start, label_stop, n_workers=1, **kwargs):
+    """ Compute the features for the label range [label_start, label_stop) with n_workers processes.
+
+    See 'features_for_label_chunks' for the arguments.
+    """
+    return [stat for _, _, chunk_stats in features_for_label_chunks(paths, keys, scale_factors, table,
+                                                                    [(label_start, label_stop)],
+                                                                    n_workers=n_workers, **kwargs)
+            for stat in chunk_stats]
+
+
+def blockwise_intensity_features(table, seg_path, seg_key, raw_path, raw_key, scale_factor_raw,
+                                 exclude_path, exclude_key, label_start, label_stop, n_threads=1):
+    """ Compute the intensity features for the label range [label_start, label_stop)
+    in one blockwise sweep over the blocks of the raw data that overlap the objects.
+    """
+    label_range = np.logical_and(table['label_id'] >= label_start, table['label_id'] < label_stop)
+    table = table.loc[label_range, :]
+    if len(table) == 0:
+        columns = ['label_id'] + INTENSITY_COLUMNS
+        return pd.DataFrame(np.zeros((0, len(columns))), columns=columns)
+
+    with open_file(raw_path, 'r') as f:
+        shape = f[raw_key].shape
+    bounding_boxes = [tuple(slice(min(b.start, sh), min(b.stop, sh))
+                            for b, sh in zip(get_bb(row, scale_factor_raw), shape))
+                      for row in table.itertuples(index=False)]
+    exclude_ids = None if exclude_path is None else table['nucleus_id'].values.astype('uint64')
+    return intensity_statistics(seg_path, seg_key, raw_path, raw_key, table['label_id'].values,
+                                exclude_path=exclude_path, exclude_key=exclude_key,
+                                exclude_ids=exclude_ids, bounding_boxes=bounding_boxes,
+                                n_threads=n_threads)
+
+
+def peak_memory():
+    """ Peak resident memory in MB of this process and of the largest finished child process.
+    """
+    # ru_maxrss is given in kilobytes on linux
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.
+    return peak_self, peak_children
+
+
 def morphology_impl_nucleus(nucleus_segmentation_path, raw_path, chromatin_path,
                             table,
                             min_size, max_size,
                             max_bb,
                             nucleus_resolution, chromatin_resolution, raw_resolution,
                             nucleus_seg_scale, raw_scale, chromatin_scale,
-                            label_start, label_stop):
+                            label_start, label_stop,
+                            max_batch_voxels=DEFAULT_MAX_BATCH_VOXELS,
+                            feature_families=None,
+                            surface_area_mode='marching_cubes',
+                            batched_texture=True, n_workers=1,
+                            chunks=None, chunk_callback=None):
     """ Compute morphology features for nucleus segmentation.
 
        Can compute features for multiple label ranges. If you want to
@@ -415,6 +957,8 @@ def morphology_impl_nucleus(nucleus_segmentation_path, raw_path, chromatin_path,
            raw_path [str] - path to raw data stored as h5.
                Pass 'None' if you don't want to compute features based on raw data.
            chromatin_path [str] - path to chromatin segmentation data stored as h5.
+               Nuclei without chromatin segmentation are skipped, also if the chromatin features
+               are not computed.
            table [pd.DataFrame] - table with default attributes
                (sizes, center of mass and bounding boxes) for segmentation
            min_size [int] - minimal size for objects used in calculation
@@ -431,6 +975,20 @@ def morphology_impl_nucleus(nucleus_segmentation_path, raw_path, chromatin_path,
            chromatin_scale [int] - scale level of the segmentation.
            label_start [int] - label start position
            label_stop [int] - label stop position
+           max_batch_voxels [int] - maximal size of the union bounding box of
+               a batch of objects that is loaded at once (default: 256**3)
+           feature_families [listlike] - names of the feature families to compute,
+               see FEATURE_FAMILIES for the available families (default: None = all families)
+           surface_area_mode [str] - method for computing the surface area, either 'marching_cubes'
+               or the faster 'voxel_faces' (default: 'marching_cubes')
+           batched_texture [bool] - compute the texture features for all objects of a batch
+               at once instead of calling mahotas for each object (default: True)
+           n_workers [int] - number of worker processes for the label range (default: 1)
+           chunks [listlike] - label ranges within [label_start, label_stop) to compute instead of
+               the full range; the data and the worker processes are set up once for all chunks
+               (default: None)
+           chunk_callback [callable] - called with label start, label stop and the features
+               of each chunk once it is computed, e.g. to write a checkpoint (default: None)
        """
 
     # keys for the different scales
@@ -440,55 +998,58 @@ def morphology_impl_nucleus(nucleus_segmentation_path, raw_path, chromatin_path,
     # filter table
     table = run_all_filters(table, min_size, max_size, max_bb, None, None)
 
+    # only load the data needed for the selected feature families
+    feature_families = get_feature_families(feature_families)
+    log("Computing feature families %s" % ", ".join(feature_families))
+    if not needs_raw_data(feature_families):
+        raw_path = None
+
     # get scale factors
     if raw_path is not None:
         raw_key_full, raw_key = get_keys(raw_path, raw_scale)
         log("Have raw data @ %s:%s; compute intensity features" % (raw_path, raw_key))
         scale_factor_raw = get_scale_factor(raw_path, raw_key_full, raw_key, raw_resolution)
-        f_raw = open_file(raw_path, 'r')
-        ds_raw = f_raw[raw_key]
     else:
         log("Don't have raw path; do not compute intensity features")
-        scale_factor_raw = f_raw = ds_raw = None
+        scale_factor_raw = raw_key = None
 
     if chromatin_path is not None:
         chromatin_key_full, chromatin_key = get_keys(chromatin_path, chromatin_scale)
-        log("Have chromatin data @ %s:%s compute chromatin features" % (chromatin_path, chromatin_key))
+        log("Have chromatin data @ %s:%s; skip nuclei without chromatin" % (chromatin_path, chromatin_key))
         scale_factor_chromatin = get_scale_factor(chromatin_path, chromatin_key_full, chromatin_key,
                                                   chromatin_resolution)
-        f_chromatin = open_file(chromatin_path, 'r')
-        ds_chromatin = f_chromatin[chromatin_key]
     else:
         log("Don't have chromatin path; do not compute chromatin features")
-        scale_factor_chromatin = f_chromatin = ds_chromatin = None
+        scale_factor_chromatin = chromatin_key = None
 
     log("Computing nucleus morphology features")
     scale_factor_nucleus_seg = get_scale_factor(nucleus_segmentation_path, nucleus_seg_key_full, nucleus_seg_key,
                                                 nucleus_resolution)
-    with open_file(nucleus_segmentation_path, 'r') as f:
-        ds = f[nucleus_seg_key]
-
-        stats = []
-        log("Computing features from label-id %i to %i" % (label_start, label_stop))
-        stats = morphology_features_for_label_range(table, ds, ds_raw,
-                                                    ds_chromatin,
-                                                    None,
-                                                    scale_factor_nucleus_seg, scale_factor_raw,
-                                                    scale_factor_chromatin,
-                                                    None,
-                                                    label_start, label_stop)
-
-    for var in f_raw, f_chromatin:
-        if var is not None:
-            var.close()
-
-    # convert to pandas table and add column names
-    stats = pd.DataFrame(stats)
-    # FIXME in the corner case that we don't have any valid cells for this range,
-    # this will fail
-    stats.columns = generate_column_names(raw_path, chromatin_path, None)
 
-    return stats
+    if chunks is None:
+        chunks = [(label_start, label_stop)]
+    columns = generate_column_names(raw_path, chromatin_path, None, feature_families)
+
+    log("Computing features from label-id %i to %i in %i chunks" % (label_start, label_stop, len(chunks)))
+    chunk_features = features_for_label_chunks([nucleus_segmentation_path, raw_path, chromatin_path, None],
+                                               [nucleus_seg_key, raw_key, chromatin_key, None],
+                                               [scale_factor_nucleus_seg, scale_factor_raw,
+                                                scale_factor_chromatin, None],
+                                               table, chunks, n_workers=n_workers,
+                                               max_batch_voxels=max_batch_voxels,
+                                               feature_families=feature_families,
+                                               surface_area_mode=surface_area_mode,
+                                               batched_texture=batched_texture)
+    stats = []
+    for chunk_start, chunk_stop, chunk_stats in chunk_features:
+        # convert to pandas table and add column names,
+        # passing the columns directly also works if we don't have any valid objects in this range
+        chunk_stats = pd.DataFrame(chunk_stats, columns=columns)
+        if chunk_callback is not None:
+            chunk_callback(chunk_start, chunk_stop, chunk_stats)
+        stats.append(chunk_stats)
+
+    return pd.concat(stats, ignore_index=True)
 
 
 def morphology_impl_cell(cell_segmentation_path, raw_path,
@@ -499,7 +1060,12 @@ def morphology_impl_cell(cell_segmentation_path, raw_path,
                          max_bb,
                          cell_resolution, nucleus_resolution, raw_resolution,
                          cell_seg_scale, raw_scale, nucleus_seg_scale,
-                         label_start, label_stop):
+                         label_start, label_stop,
+                         max_batch_voxels=DEFAULT_MAX_BATCH_VOXELS,
+                         feature_families=None,
+                         surface_area_mode='marching_cubes',
+                         batched_texture=True, intensity_engine='per_row', n_workers=1,
+                         chunks=None, chunk_callback=None):
     """ Compute morphology features for cell segmentation.
 
        Can compute features for multiple label ranges. If you want to
@@ -533,7 +1099,27 @@ def morphology_impl_cell(cell_segmentation_path, raw_path,
            nucleus_seg_scale [int] - scale level of the segmentation.
            label_start [int] - label start position
            label_stop [int] - label stop position
+           max_batch_voxels [int] - maximal size of the union bounding box of
+               a batch of objects that is loaded at once (default: 256**3)
+           feature_families [listlike] - names of the feature families to compute,
+               see FEATURE_FAMILIES for the available families (default: None = all families)
+           surface_area_mode [str] - method for computing the surface area, either 'marching_cubes'
+               or the faster 'voxel_faces' (default: 'marching_cubes')
+           batched_texture [bool] - compute the texture features for all objects of a batch
+               at once instead of calling mahotas for each object (default: True)
+           intensity_engine [str] - engine for the intensity features, either 'per_row' or 'blockwise',
+               which computes them for all objects in one sweep over the raw data. If the scales of the
+               segmentation and raw data differ, the two engines sample different voxels at the object
+               boundaries, see INTENSITY_ENGINES (default: 'per_row')
+           n_workers [int] - number of worker processes for the label range (default: 1)
+           chunks [listlike] - label ranges within [label_start, label_stop) to compute instead of
+               the full range; the data and the worker processes are set up once for all chunks
+               (default: None)
+           chunk_callback [callable] - called with label start, label stop and the features
+               of each chunk once it is computed, e.g. to write a checkpoint (default: None)
        """
+    assert intensity_engine in INTENSITY_ENGINES, "Invalid intensity engine %s, expected one of %s" % (
+        intensity_engine, ", ".join(INTENSITY_ENGINES))
 
     # keys for the different scales
     cell_seg_key_full, cell_seg_key = get_keys(cell_segmentation_path, cell_seg_scale)
@@ -542,50 +1128,84 @@ def morphology_impl_cell(cell_segmentation_path, raw_path,
     # filter table
     table = run_all_filters(table, min_size, max_size, max_bb, mapping_path, region_mapping_path)
 
+    # only load the data needed for the selected feature families,
+    # the nucleus segmentation is only used to exclude the nucleus from the intensity features
+    feature_families = get_feature_families(feature_families)
+    log("Computing feature families %s" % ", ".join(feature_families))
+    if not needs_raw_data(feature_families):
+        raw_path = nucleus_segmentation_path = None
+
     # get scale factors
     if raw_path is not None:
         log("Have raw path; compute intensity features")
         raw_key_full, raw_key = get_keys(raw_path, raw_scale)
         scale_factor_raw = get_scale_factor(raw_path, raw_key_full, raw_key, raw_resolution)
-        f_raw = open_file(raw_path, 'r')
-        ds_raw = f_raw[raw_key]
     else:
         log("Don't have raw path; do not compute intensity features")
-        scale_factor_raw = f_raw = ds_raw = None
+        scale_factor_raw = raw_key = None
 
     if nucleus_segmentation_path is not None:
         log("Have nucleus path; exclude nucleus for intensity measures")
         scale_factor_nucleus = get_scale_factor(nucleus_segmentation_path, nucleus_seg_key_full, nucleus_seg_key,
                                                 nucleus_resolution)
-        f_nucleus = open_file(nucleus_segmentation_path, 'r')
-        ds_nucleus = f_nucleus[nucleus_seg_key]
     else:
         log("Don't have exclude path; don't exclude nucleus area for intensity measures")
-        scale_factor_nucleus = f_nucleus = ds_nucleus = None
+        scale_factor_nucleus = nucleus_seg_key = None
 
     log("Computing morphology features")
     scale_factor_cell_seg = get_scale_factor(cell_segmentation_path, cell_seg_key_full, cell_seg_key, cell_resolution)
-    with open_file(cell_segmentation_path, 'r') as f:
-        ds = f[cell_seg_key]
-
-        log("Computing features from label-id %i to %i" % (label_start, label_stop))
-        stats = morphology_features_for_label_range(table, ds, ds_raw,
-                                                    None,
-                                                    ds_nucleus,
-                                                    scale_factor_cell_seg, scale_factor_raw,
-                                                    None,
-                                                    scale_factor_nucleus,
-                                                    label_start, label_stop)
-
-    for var in f_raw, f_nucleus:
-        if var is not None:
-            var.close()
-
-    # convert to pandas table and add column names
-    stats = pd.DataFrame(stats)
-    stats.columns = generate_column_names(raw_path, None, nucleus_segmentation_path)
 
-    return stats
+    # with the blockwise engine, the intensity features are not computed per row
+    blockwise_intensity = intensity_engine == 'blockwise' and raw_path is not None and\
+        'intensity' in feature_families
+    if blockwise_intensity:
+        row_families = [name for name in feature_families if name != 'intensity']
+    else:
+        row_families = feature_families
+    row_paths = [cell_segmentation_path, raw_path, None, nucleus_segmentation_path]
+    if not needs_raw_data(row_families):
+        row_paths[1] = row_paths[3] = None
+
+    if chunks is None:
+        chunks = [(label_start, label_stop)]
+    row_columns = generate_column_names(row_paths[1], None, row_paths[3], row_families)
+    columns = generate_column_names(raw_path, None, nucleus_segmentation_path, feature_families)
+
+    if blockwise_intensity:
+        # one sweep over the raw data for the labels of all chunks
+        log("Computing intensity features blockwise")
+        in_chunks = np.zeros(len(table), dtype='bool')
+        for chunk_start, chunk_stop in chunks:
+            in_chunks |= np.logical_and(table['label_id'] >= chunk_start, table['label_id'] < chunk_stop)
+        intensity_stats = blockwise_intensity_features(table.loc[in_chunks, :],
+                                                       cell_segmentation_path, cell_seg_key,
+                                                       raw_path, raw_key, scale_factor_raw,
+                                                       nucleus_segmentation_path, nucleus_seg_key,
+                                                       label_start, label_stop, n_threads=n_workers)
+
+    log("Computing features from label-id %i to %i in %i chunks" % (label_start, label_stop, len(chunks)))
+    chunk_features = features_for_label_chunks(row_paths,
+                                               [cell_seg_key, raw_key, None, nucleus_seg_key],
+                                               [scale_factor_cell_seg, scale_factor_raw,
+                                                None, scale_factor_nucleus],
+                                               table, chunks, n_workers=n_workers,
+                                               max_batch_voxels=max_batch_voxels,
+                                               feature_families=row_families,
+                                               surface_area_mode=surface_area_mode,
+                                               batched_texture=batched_texture)
+    stats = []
+    for chunk_start, chunk_stop, chunk_stats in chunk_features:
+        # convert to pandas table and add column names
+        chunk_stats = pd.DataFrame(chunk_stats, columns=row_columns)
+        if blockwise_intensity:
+            # only keep the labels that have features per row, i.e. the labels with a non-empty mask
+            chunk_stats = chunk_stats.merge(intensity_stats, on='label_id', how='left')
+            chunk_stats = chunk_stats[columns]
+        if chunk_callback is not None:
+            chunk_callback(chunk_start, chunk_stop, chunk_stats)
+        stats.append(chunk_stats)
+
+    return pd.concat(stats, ignore_index=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+#! /bin/python
+
+import os
+import sys
+import json
+
+import luigi
+
+import cluster_tools.utils.volume_utils as vu
+import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.task_utils import DummyTask
+from cluster_tools.cluster_tasks import SlurmTask, LocalTask
+from mmpb.extension.attributes.region_overlaps_impl import region_overlaps, write_overlaps
+
+#
+# Region Overlap Tasks
+#
+
+
+class RegionOverlapsBase(luigi.Task):
+    """ RegionOverlaps base class
+    """
+
+    task_name = 'region_overlaps'
+    src_file = os.path.abspath(__file__)
+    allow_retry = False
+
+    # the segmentation
+    segmentation_path = luigi.Parameter()
+    segmentation_key = luigi.Parameter()
+    # the region volumes, each block of the segmentation is overlapped with all of them
+    input_paths = luigi.ListParameter()
+    input_keys = luigi.ListParameter()
+    # prefix for the per job results
+    output_prefix = luigi.Parameter()
+    prefix = luigi.Parameter(default='regions')
+    #
+    dependency = luigi.TaskParameter(default=DummyTask())
+
+    def requires(self):
+        return self.dependency
+
+    def run_impl(self):
+        assert len(self.input_paths) == len(self.input_keys)
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        # load the task config
+        config = self.get_task_config()
+
+        with vu.file_reader(self.segmentation_path, 'r') as f:
+            shape = f[self.segmentation_key].shape
+        block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+
+        config.update({'segmentation_path': self.segmentation_path,
+                       'segmentation_key': self.segmentation_key,
+                       'input_paths': list(self.input_paths),
+                       'input_keys': list(self.input_keys),
+                       'output_prefix': self.output_prefix,
+                       'block_shape': block_shape})
+
+        # prime and run the jobs
+        n_jobs = min(len(block_list), self.max_jobs)
+        # list the job results of this run, the tmp folder can contain more
+        # job results from a previous run with a larger number of jobs
+        with open(self.output_prefix + '_jobs.json', 'w') as f:
+            json.dump([self.output_prefix + '_job%i.npz' % job_id for job_id in range(n_jobs)], f)
+        self.prepare_jobs(n_jobs, block_list, config, self.prefix)
+        self.submit_jobs(n_jobs, self.prefix)
+
+        # wait till jobs finish and check for job success
+        self.wait_for_jobs()
+        self.check_jobs(n_jobs, self.prefix)
+
+    def output(self):
+        out_path = os.path.join(self.tmp_folder,
+                                '%s_%s.log' % (self.task_name, self.prefix))
+        return luigi.LocalTarget(out_path)
+
+
+class RegionOverlapsLocal(RegionOverlapsBase, LocalTask):
+    """ RegionOverlaps on local machine
+    """
+    pass
+
+
+class RegionOverlapsSlurm(RegionOverlapsBase, SlurmTask):
+    """ RegionOverlaps on slurm cluster
+    """
+    pass
+
+
+#
+# Implementation
+#
+
+def region_overlaps_job(job_id, config_path):
+
+    fu.log("start processing job %i" % job_id)
+    fu.log("reading config from %s" % config_path)
+
+    # get the config
+    with open(config_path) as f:
+        config = json.load(f)
+    block_list = config['block_list']
+    input_paths = config['input_paths']
+    n_threads = config.get('threads_per_job', 1)
+
+    fu.log("Compute overlaps with %i inputs for %i blocks" % (len(input_paths), len(block_list)))
+    overlaps = region_overlaps(config['segmentation_path'], config['segmentation_key'],
+                               input_paths, config['input_keys'], config['block_shape'],
+                               block_ids=block_list, n_threads=n_threads)
+
+    output_path = config['output_prefix'] + '_job%i.npz' % job_id
+    fu.log("Save result to %s" % output_path)
+    write_overlaps(output_path, overlaps)
+    fu.log_job_success(job_id)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    assert os.path.exists(path), path
+    job_id = int(os.path.split(path)[1].split('.')[0].split('_')[-1])
+    region_overlaps_job(job_id, path)
@@ -0,0 +1,153 @@
+# computation of the overlaps of a segmentation with many region volumes in one pass, can be called standalone
+from concurrent import futures
+
+import numpy as np
+import nifty.tools as nt
+from elf.io import open_file
+from mmpb.extension.attributes.intensity_impl import load_to_shape
+
+
+def count_pairs(seg_ids, region_ids):
+    """ Count the occurences of the (segment id, region id) pairs.
+    """
+    seg_ids, region_ids = seg_ids.astype('uint64'), region_ids.astype('uint64')
+    n_regions = int(region_ids.max()) + 1 if region_ids.size > 0 else 1
+    keys, counts = np.unique(seg_ids * n_regions + region_ids, return_counts=True)
+    return keys // n_regions, keys % n_regions, counts.astype('uint64')
+
+
+def reduce_pairs(seg_ids, region_ids, counts):
+    """ Sum the counts of identical (segment id, region id) pairs.
+    """
+    if len(seg_ids) == 0:
+        return seg_ids, region_ids, counts
+    n_regions = int(region_ids.max()) + 1
+    keys, inverse = np.unique(seg_ids * n_regions + region_ids, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(keys)).astype('uint64')
+    return keys // n_regions, keys % n_regions, counts
+
+
+def _empty_pairs():
+    return (np.zeros(0, dtype='uint64'),) * 3
+
+
+def region_overlaps(seg_path, seg_key, input_paths, input_keys,
+                    block_shape, block_ids=None, n_threads=1):
+    """ Compute the overlaps of the segmentation with all input volumes in one pass.
+
+    Each block of the segmentation is loaded once and the overlaps with all inputs
+    are computed for it. The inputs are resampled to the shape of the segmentation
+    with nearest neighbor interpolation if their shapes differ.
+
+    Arguments:
+        seg_path [str] - path to the segmentation
+        seg_key [str] - key of the segmentation
+        input_paths [listlike] - paths to the input volumes, e.g. region masks
+        input_keys [listlike] - keys of the input volumes
+        block_shape [tuple] - shape of the blocks processed at once
+        block_ids [listlike] - ids of the blocks to process, all blocks if None (default: None)
+        n_threads [int] - number of threads (default: 1)
+    Returns:
+        list[tuple] - segment ids, region ids and overlap counts for each input
+    """
+    assert len(input_paths) == len(input_keys)
+    f_seg = open_file(seg_path, 'r')
+    ds_seg = f_seg[seg_key]
+    files = [open_file(path, 'r') for path in input_paths]
+    datasets = [f[key] for f, key in zip(files, input_keys)]
+
+    shape = ds_seg.shape
+    blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
+    if block_ids is None:
+        block_ids = range(blocking.numberOfBlocks)
+
+    def overlaps_for_block(block_id):
+        block = blocking.getBlock(block_id)
+        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+        seg = ds_seg[bb].ravel()
+        return [count_pairs(seg, load_to_shape(ds, bb, shape).ravel()) for ds in datasets]
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(overlaps_for_block, block_id) for block_id in block_ids]
+        block_overlaps = [t.result() for t in tasks]
+
+    for f in [f_seg] + files:
+        f.close()
+
+    overlaps = []
+    for input_id in range(len(datasets)):
+        pairs = [block_overlap[input_id] for block_overlap in block_overlaps]
+        if len(pairs) == 0:
+            overlaps.append(_empty_pairs())
+            continue
+        overlaps.append(reduce_pairs(*[np.concatenate(values) for values in zip(*pairs)]))
+    return overlaps
+
+
+def write_overlaps(path, overlaps):
+    """ Write the overlaps computed by 'region_overlaps' to npz.
+    """
+    data = {}
+    for input_id, (seg_ids, region_ids, counts) in enumerate(overlaps):
+        data.update({'seg_ids%i' % input_id: seg_ids,
+                     'region_ids%i' % input_id: region_ids,
+                     'counts%i' % input_id: counts})
+    with open(path, 'wb') as f:
+        np.savez(f, n_inputs=len(overlaps), **data)
+
+
+def merge_overlaps(paths):
+    """ Merge the overlaps written by 'write_overlaps'.
+    """
+    merged = None
+    for path in paths:
+        with np.load(path) as f:
+            n_inputs = int(f['n_inputs'])
+            overlaps = [(f['seg_ids%i' % ii], f['region_ids%i' % ii], f['counts%i' % ii])
+                        for ii in range(n_inputs)]
+        if merged is None:
+            merged = [[] for _ in range(n_inputs)]
+        assert len(merged) == n_inputs
+        for input_id, pairs in enumerate(overlaps):
+            merged[input_id].append(pairs)
+    assert merged is not None, "No overlaps to merge"
+    return [reduce_pairs(*[np.concatenate(values) for values in zip(*pairs)])
+            for pairs in merged]
+
+
+def max_overlap_labels(seg_ids, region_ids, counts, n_labels, ignore_label=None):
+    """ Map each segment id to the region id with the largest overlap.
+
+    Segment ids without overlap are mapped to 0. For ties, the smaller region id is chosen.
+
+    Arguments:
+        seg_ids [np.ndarray] - segment ids of the overlap pairs
+        region_ids [np.ndarray] - region ids of the overlap pairs
+        counts [np.ndarray] - counts of the overlap pairs
+        n_labels [int] - number of segment ids
+        ignore_label [int] - region id that is ignored (default: None)
+    """
+    if ignore_label is not None:
+        keep = region_ids != ignore_label
+        seg_ids, region_ids, counts = seg_ids[keep], region_ids[keep], counts[keep]
+    labels = np.zeros(n_labels, dtype='uint64')
+    if len(seg_ids) == 0:
+        return labels
+    # sort by segment id, then by descending count, then by region id
+    order = np.lexsort((region_ids, -counts.astype('int64'), seg_ids))
+    seg_ids, region_ids = seg_ids[order], region_ids[order]
+    is_first = np.ones(len(seg_ids), dtype='bool')
+    is_first[1:] = seg_ids[1:] != seg_ids[:-1]
+    labels[seg_ids[is_first]] = region_ids[is_first]
+    return labels
+
+
+def overlap_dict(seg_ids, region_ids, counts, ignore_label=None):
+    """ Convert the overlap pairs to a dictionary {segment id: {region id: count}}.
+    """
+    result = {}
+    for seg_id, region_id, count in zip(seg_ids.tolist(), region_ids.tolist(), counts.tolist()):
+        if region_id == ignore_label:
+            continue
+        result.setdefault(seg_id, {})[region_id] = count
+    return result
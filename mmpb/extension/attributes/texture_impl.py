@@ -0,0 +1,284 @@
+# batched computation of the haralick texture features for many objects,
+# reproduces 'mahotas.features.haralick(..., ignore_zeros=True, return_mean=True)'
+import numpy as np
+
+N_HARALICK_FEATURES = 13
+# the 13 directions for 3d co-occurrence matrices, same as in mahotas
+DELTAS_3D = [(1, 0, 0), (1, 1, 0), (0, 1, 0), (1, -1, 0),
+             (0, 0, 1), (1, 0, 1), (0, 1, 1), (1, 1, 1), (1, -1, 1),
+             (1, 0, -1), (0, 1, -1), (1, 1, -1), (1, -1, -1)]
+
+
+def _stack_objects(crops, distance):
+    # stack the objects along the first axis, separated and padded by distance zeros,
+    # so that no voxel pair at this distance connects non-zero voxels of different objects
+    shape = (sum(crop.shape[0] + distance for crop in crops) + distance,
+             max(crop.shape[1] for crop in crops) + 2 * distance,
+             max(crop.shape[2] for crop in crops) + 2 * distance)
+    values = np.zeros(shape, dtype=crops[0].dtype)
+    object_ids = np.zeros(shape[0], dtype='int64')
+    z = distance
+    for obj_id, crop in enumerate(crops):
+        bb = (slice(z, z + crop.shape[0]),
+              slice(distance, distance + crop.shape[1]),
+              slice(distance, distance + crop.shape[2]))
+        values[bb] = crop
+        object_ids[z:z + crop.shape[0]] = obj_id
+        z += crop.shape[0] + distance
+    return values, object_ids
+
+
+def cooccurrence_entries(crops, n_values, distance=2):
+    """ Compute the non-zero entries of the symmetric co-occurrence matrices
+    for all objects and directions in one pass over the stacked objects.
+
+    Pairs that contain a zero value are not counted, like with 'ignore_zeros' in mahotas.
+
+    Arguments:
+        crops [list[np.ndarray]] - 3d integer data for the objects, must be smaller than n_values
+        n_values [int] - number of values, i.e. size of the co-occurrence matrices
+        distance [int] - distance of the voxel pairs (default: 2)
+    Returns:
+        np.ndarray - matrix index (object index * 13 + direction) of the entries
+        np.ndarray - row of the entries
+        np.ndarray - column of the entries
+        np.ndarray - counts of the entries
+    """
+    n_objects, n_directions = len(crops), len(DELTAS_3D)
+
+    values, object_ids = _stack_objects(crops, distance)
+    strides = (values.shape[1] * values.shape[2], values.shape[2], 1)
+    values = values.ravel()
+
+    # map the values to the index of the values that occur to keep the matrices small
+    present_values = np.flatnonzero(np.bincount(values, minlength=n_values))
+    n_present = len(present_values)
+    value_index = np.zeros(n_values, dtype='int64')
+    value_index[present_values] = np.arange(n_present)
+    values = value_index[values]
+    matrix_size = n_present * n_present
+
+    # the key of the co-occurrence matrix entry is given by the object, the value of the
+    # non-zero source voxel and the value of the target voxel
+    sources = np.flatnonzero(values)
+    source_keys = object_ids[sources // strides[0]] * matrix_size + values[sources] * n_present
+
+    entries = []
+    for dir_id, delta in enumerate(DELTAS_3D):
+        offset = distance * sum(d * stride for d, stride in zip(delta, strides))
+        counts = np.bincount(source_keys + values[sources + offset], minlength=n_objects * matrix_size)
+        # ignore the pairs with a zero target value (the source values are non-zero)
+        counts.reshape((n_objects, n_present, n_present))[:, :, 0] = 0
+
+        # symmetrize the matrix: the entry (row, col) is the sum of the pair counts
+        # for (row, col) and (col, row); entries (col, row) that only have counts
+        # for (row, col) must be added separately
+        keys = np.flatnonzero(counts)
+        obj_ids, matrix_keys = np.divmod(keys, matrix_size)
+        rows, cols = np.divmod(matrix_keys, n_present)
+        pair_counts = counts[keys]
+        transposed_counts = counts[obj_ids * matrix_size + cols * n_present + rows]
+        only_one_order = transposed_counts == 0
+        matrix_ids = obj_ids * n_directions + dir_id
+        rows, cols = present_values[rows], present_values[cols]
+        entries.append((matrix_ids, rows, cols, (pair_counts + transposed_counts).astype('float64')))
+        entries.append((matrix_ids[only_one_order], cols[only_one_order], rows[only_one_order],
+                        pair_counts[only_one_order].astype('float64')))
+
+    return [np.concatenate(entry) for entry in zip(*entries)]
+
+
+def _sum_per_matrix(index, weights, n_matrices, n_bins=1):
+    return np.bincount(index, weights=weights, minlength=n_matrices * n_bins).reshape((n_matrices, n_bins))
+
+
+def _entropy(p):
+    return -(np.log2(p + (p == 0)) * p)
+
+
+def haralick_features(matrix_ids, rows, cols, counts, n_matrices, n_values, lengths):
+    """ Compute the 13 haralick features from the non-zero entries of co-occurrence matrices.
+
+    Follows 'mahotas.features.texture.haralick_features', but only iterates
+    over the non-zero entries instead of the full matrices.
+
+    Arguments:
+        matrix_ids [np.ndarray] - matrix index of the entries
+        rows [np.ndarray] - row of the entries
+        cols [np.ndarray] - column of the entries
+        counts [np.ndarray] - counts of the entries
+        n_matrices [int] - number of matrices, all matrices must be non-empty
+        n_values [int] - size of the matrices
+        lengths [np.ndarray] - the size of the co-occurrence matrix mahotas would use
+            for each matrix, i.e. the maximal value of the object + 1
+    Returns:
+        np.ndarray - features of shape (n_matrices, 13)
+    """
+    feats = np.zeros((n_matrices, N_HARALICK_FEATURES), dtype='float64')
+    k = np.arange(n_values, dtype='float64')
+    k2 = k ** 2
+    tk = np.arange(2 * n_values, dtype='float64')
+    tk2 = tk ** 2
+
+    totals = _sum_per_matrix(matrix_ids, counts, n_matrices)[:, 0]
+    p = counts / totals[matrix_ids]
+    rows_f, cols_f = rows.astype('float64'), cols.astype('float64')
+
+    # marginals, px sums over the rows and py over the columns
+    px = _sum_per_matrix(matrix_ids * n_values + cols, p, n_matrices, n_values)
+    py = _sum_per_matrix(matrix_ids * n_values + rows, p, n_matrices, n_values)
+    px_plus_y = _sum_per_matrix(matrix_ids * 2 * n_values + rows + cols, p, n_matrices, 2 * n_values)
+    px_minus_y = _sum_per_matrix(matrix_ids * n_values + np.abs(rows - cols), p, n_matrices, n_values)
+
+    ux = px.dot(k)
+    uy = py.dot(k)
+    vx = px.dot(k2) - ux ** 2
+    vy = py.dot(k2) - uy ** 2
+    sx = np.sqrt(vx)
+    sy = np.sqrt(vy)
+
+    feats[:, 0] = _sum_per_matrix(matrix_ids, p * p, n_matrices)[:, 0]
+    feats[:, 1] = px_minus_y.dot(k2)
+
+    correlated = np.logical_and(sx != 0, sy != 0)
+    sum_ij = _sum_per_matrix(matrix_ids, rows_f * cols_f * p, n_matrices)[:, 0]
+    feats[:, 2] = 1.
+    feats[correlated, 2] = (sum_ij[correlated] - ux[correlated] * uy[correlated]) /\
+        (sx[correlated] * sy[correlated])
+
+    feats[:, 3] = vx
+    feats[:, 4] = _sum_per_matrix(matrix_ids, p / ((rows_f - cols_f) ** 2 + 1), n_matrices)[:, 0]
+    feats[:, 5] = px_plus_y.dot(tk)
+    feats[:, 7] = _entropy(px_plus_y).sum(axis=1)
+    feats[:, 6] = px_plus_y.dot(tk2) - feats[:, 5] ** 2
+    feats[:, 8] = _sum_per_matrix(matrix_ids, _entropy(p), n_matrices)[:, 0]
+
+    # the variance of px_minus_y depends on the length mahotas uses for it;
+    # the entries beyond this length are zero
+    lengths = np.asarray(lengths, dtype='float64')
+    mean_minus = px_minus_y.sum(axis=1) / lengths
+    sq_dev = ((px_minus_y - mean_minus[:, None]) ** 2).sum(axis=1) - (n_values - lengths) * mean_minus ** 2
+    feats[:, 9] = sq_dev / lengths
+    feats[:, 10] = _entropy(px_minus_y).sum(axis=1)
+
+    hx = _entropy(px).sum(axis=1)
+    hy = _entropy(py).sum(axis=1)
+    # px[i] * py[j] is non-zero for all non-zero entries (i, j), because the matrices are symmetric
+    cross = px[matrix_ids, rows] * py[matrix_ids, cols]
+    hxy1 = -_sum_per_matrix(matrix_ids, p * np.log2(cross), n_matrices)[:, 0]
+    # entropy of the outer product of px and py
+    hxy2 = hx * py.sum(axis=1) + hy * px.sum(axis=1)
+
+    max_hxy = np.maximum(hx, hy)
+    feats[:, 11] = feats[:, 8] - hxy1
+    feats[max_hxy != 0, 11] /= max_hxy[max_hxy != 0]
+    feats[:, 12] = np.sqrt(np.maximum(0, 1 - np.exp(-2. * (hxy2 - feats[:, 8]))))
+
+    return feats
+
+
+def _group_objects(crops, max_matrix_elements, max_waste=2.):
+    # group objects with a similar shape in the yx-plane, so that the stacked array is
+    # at most max_waste times larger than the objects and the number of co-occurrence matrix
+    # elements for one direction is at most max_matrix_elements
+    max_values = [int(crop.max()) for crop in crops]
+    order = sorted(range(len(crops)), key=lambda obj_id: crops[obj_id].shape[1] * crops[obj_id].shape[2],
+                   reverse=True)
+    groups = []
+    for obj_id in order:
+        shape = crops[obj_id].shape
+        if groups:
+            group, max_y, max_x, max_value = groups[-1]
+            max_value = max(max_value, max_values[obj_id])
+            n_elements = (len(group) + 1) * (max_value + 1) ** 2
+            if max_waste * shape[1] * shape[2] >= max_y * max_x and n_elements <= max_matrix_elements:
+                group.append(obj_id)
+                groups[-1][1:] = max(max_y, shape[1]), max(max_x, shape[2]), max_value
+                continue
+        groups.append([[obj_id], shape[1], shape[2], max_values[obj_id]])
+    return [(group[0], group[3] + 1) for group in groups]
+
+
+def batched_haralick(crops, distance=2, max_matrix_elements=2 ** 22):
+    """ Compute the mean haralick features over all directions for many objects.
+
+    The results agree with
+    'mahotas.features.haralick(crop, ignore_zeros=True, return_mean=True, distance=distance)'
+    up to floating point precision; objects that have an empty co-occurrence matrix
+    (for which mahotas raises a ValueError) get zero features.
+
+    Arguments:
+        crops [list[np.ndarray]] - 3d integer data for the objects, zero values are ignored
+        distance [int] - distance of the voxel pairs (default: 2)
+        max_matrix_elements [int] - maximal number of co-occurrence matrix elements
+            per direction for the objects that are processed together (default: 2**22)
+    Returns:
+        np.ndarray - features of shape (n_objects, 13)
+    """
+    features = np.zeros((len(crops), N_HARALICK_FEATURES), dtype='float64')
+    for object_ids, n_values in _group_objects(crops, max_matrix_elements):
+        features[object_ids] = _batched_haralick(crops, object_ids, n_values, distance)
+    return features
+
+
+def _batched_haralick(crops, object_ids, n_values, distance):
+    n_objects, n_directions = len(object_ids), len(DELTAS_3D)
+    features = np.zeros((n_objects, N_HARALICK_FEATURES), dtype='float64')
+    max_values = np.array([int(crops[obj_id].max()) for obj_id in object_ids])
+    matrix_ids, rows, cols, counts = cooccurrence_entries([crops[obj_id] for obj_id in object_ids],
+                                                          n_values, distance)
+
+    # mahotas fails if the matrix for any direction is empty
+    n_matrices = n_objects * n_directions
+    non_empty = np.bincount(matrix_ids, minlength=n_matrices) > 0
+    valid = non_empty.reshape((n_objects, n_directions)).all(axis=1)
+    if not valid.any():
+        return features
+
+    # compute the features only for the matrices of valid objects
+    valid_matrices = np.repeat(valid, n_directions)
+    new_ids = np.cumsum(valid_matrices) - 1
+    keep = valid_matrices[matrix_ids]
+    matrix_ids = new_ids[matrix_ids[keep]]
+    lengths = np.repeat(max_values[valid] + 1, n_directions)
+
+    feats = haralick_features(matrix_ids, rows[keep], cols[keep], counts[keep],
+                              int(valid_matrices.sum()), n_values, lengths)
+    features[valid] = feats.reshape((-1, n_directions, N_HARALICK_FEATURES)).mean(axis=1)
+    return features
+
+
+class TextureHandle:
+    """ Placeholder for the texture features of an object in a result tuple.
+    """
+    def __init__(self, index):
+        self.index = index
+
+
+class BatchedTexture:
+    """ Collect the objects for the texture computation and compute the haralick
+    features for all of them at once.
+    """
+    def __init__(self, distance=2):
+        self.distance = distance
+        self.crops = []
+        self.features = None
+
+    def add(self, raw, mask):
+        # set regions outside mask to zero
+        crop = raw.copy()
+        crop[mask == 0] = 0
+        self.crops.append(crop)
+        return TextureHandle(len(self.crops) - 1)
+
+    def compute(self):
+        self.features = batched_haralick(self.crops, distance=self.distance)
+        self.crops = []
+
+    def fill(self, result):
+        """ Replace the placeholders in the result by the texture features.
+        """
+        filled = ()
+        for val in result:
+            filled += tuple(self.features[val.index]) if isinstance(val, TextureHandle) else (val,)
+        return filled
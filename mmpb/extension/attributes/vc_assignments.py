@@ -38,6 +38,14 @@ class VCAssignmentsBase(luigi.Task):
     def requires(self):
         return self.dependency
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        # engine for finding the vcs close to the cells, 'candidates' or 'per_vc'
+        config.update({'distance_engine': 'candidates'})
+        return config
+
     def run_impl(self):
         # get the global config and init configs
         shebang = self.global_config_values()[0]
@@ -99,11 +107,13 @@ def vc_assignments(job_id, config_path):
 
     output_path = config['output_path']
     n_threads = config.get('threads_per_job', 1)
+    engine = config.get('distance_engine', 'candidates')
 
     vc_assignments_impl(segmentation_path, segmentation_key,
                         vc_volume_path, vc_key,
                         vc_expression_path,
-                        med_expression_path, output_path, n_threads)
+                        med_expression_path, output_path, n_threads,
+                        engine=engine)
     fu.log_job_success(job_id)
 
 
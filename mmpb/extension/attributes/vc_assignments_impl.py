@@ -73,8 +73,8 @@ def get_bbs(data, offset):
     return cell_bbs
 
 
-def get_distances(em_data, vc_data, cells_expression, vc_expression, n_threads,
-                  offset=10):
+def _distances_per_vc(em_data, vc_data, cells_expression, vc_expression, n_threads, offset):
+    # check the distance to each vc in the bounding box of the cell separately
     num_cells = cells_expression.shape[0]
     # some labels might be lost due to downsampling
     avail_cells = np.unique(em_data)
@@ -105,15 +105,107 @@ def get_distances(em_data, vc_data, cells_expression, vc_expression, n_threads,
         tasks = [tp.submit(get_distance, cell_id) for cell_id in avail_cells]
         [t.result() for t in tasks]
 
-    return distance_matrix
+    # this engine needs the dense matrix, we only convert the result to the candidate lists
+    cells, vcs = np.where(~np.isnan(distance_matrix))
+    return cells, vcs, distance_matrix[cells, vcs]
+
+
+def get_candidates(em_data, vc_data, offset, n_threads=1):
+    """ Find the vcs that are within offset of each cell.
+
+    The background vc 0 is a candidate for all cells.
+
+    Returns:
+        np.ndarray - cell ids of the candidates
+        np.ndarray - vc ids of the candidates, sorted for each cell
+    """
+    # some labels might be lost due to downsampling
+    avail_cells = np.unique(em_data)
+    avail_cells = avail_cells[avail_cells != 0]
+    bbs = get_bbs(em_data, offset)
+
+    def candidates_for_cell(cell):
+        bb = bbs[cell]
+        cell_mask = (em_data[bb] == cell).astype("uint32")
+        dist = distanceTransform(cell_mask)
+        # all vcs with a voxel within offset of the cell, in a single pass over the bounding box
+        vcs = np.unique(np.concatenate([[0], vc_data[bb][dist <= offset]])).astype('uint64')
+        return np.full(len(vcs), cell, dtype='uint64'), vcs
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        tasks = [tp.submit(candidates_for_cell, cell_id) for cell_id in avail_cells]
+        candidates = [t.result() for t in tasks]
+
+    if len(candidates) == 0:
+        return np.zeros(0, dtype='uint64'), np.zeros(0, dtype='uint64')
+    cells = np.concatenate([cand[0] for cand in candidates])
+    vcs = np.concatenate([cand[1] for cand in candidates])
+    return cells, vcs
+
+
+def candidate_distances(cells, vcs, cells_expression, vc_expression, chunk_size=100000):
+    """ Compute the L1 distances of the gene expression of the candidate cells and vcs.
+    """
+    distances = np.zeros(len(cells), dtype='float64')
+    for start in range(0, len(cells), chunk_size):
+        stop = min(start + chunk_size, len(cells))
+        distances[start:stop] = np.sum(np.abs(cells_expression[cells[start:stop]] -
+                                              vc_expression[vcs[start:stop]]), axis=1)
+    return distances
+
+
+def _distances_candidates(em_data, vc_data, cells_expression, vc_expression, n_threads, offset):
+    # find the candidate vcs of all cells first and then compute all distances at once
+    cells, vcs = get_candidates(em_data, vc_data, offset, n_threads)
+    return cells, vcs, candidate_distances(cells, vcs, cells_expression, vc_expression)
+
+
+DISTANCE_ENGINES = {'candidates': _distances_candidates, 'per_vc': _distances_per_vc}
+
+
+def get_distances(em_data, vc_data, cells_expression, vc_expression, n_threads,
+                  offset=10, engine='candidates'):
+    """ Compute the genetic distance from the cells to the vcs within offset.
+
+    The distances are returned as candidate lists, i.e. only for the (cell, vc) pairs
+    with the vc within offset of the cell.
+
+    Arguments:
+        em_data [np.ndarray] - the cell segmentation in vc space
+        vc_data [np.ndarray] - the vc volume
+        cells_expression [np.ndarray] - the gene expression of the cells
+        vc_expression [np.ndarray] - the gene expression of the vcs
+        n_threads [int] - number of threads
+        offset [int] - maximal distance of vcs to the cell (default: 10)
+        engine [str] - engine for computing the distances, 'candidates' finds the close vcs
+            of all cells first and computes the distances vectorized, 'per_vc' checks the vcs
+            for each cell one by one (default: 'candidates')
+    Returns:
+        np.ndarray - cell ids of the candidates
+        np.ndarray - vc ids of the candidates
+        np.ndarray - genetic distances of the candidates
+    """
+    if engine not in DISTANCE_ENGINES:
+        raise ValueError("Invalid engine %s, expected one of %s" % (engine, list(DISTANCE_ENGINES)))
+    return DISTANCE_ENGINES[engine](em_data, vc_data, cells_expression, vc_expression, n_threads, offset)
+
 
+def assign_vc(cells, vcs, distances, num_cells, vc_expression):
+    """ Assign each cell to the candidate vc with the smallest genetic distance.
 
-def assign_vc(distances, vc_expression):
-    num_cells = distances.shape[0]
+    For ties, the smaller vc id is chosen. Cells without candidates are assigned to 0.
+    """
     # assign to 0 if no vcs were found at all
-    assignments = [0 if np.all(np.isnan(distances[cell]))
-                   else np.nanargmin(distances[cell])
-                   for cell in range(num_cells)]
+    assignments = np.zeros(num_cells, dtype='int64')
+    valid = ~np.isnan(distances)
+    cells, vcs, distances = cells[valid], vcs[valid], distances[valid]
+    if len(cells) > 0:
+        # sort by cell id, then by distance, then by vc id and take the first candidate of each cell
+        order = np.lexsort((vcs, distances, cells))
+        cells, vcs = cells[order], vcs[order]
+        is_first = np.ones(len(cells), dtype='bool')
+        is_first[1:] = cells[1:] != cells[:-1]
+        assignments[cells[is_first]] = vcs[is_first]
     cells_expr = vc_expression[assignments]
     expr_sum = np.sum(cells_expr, axis=1)
     assign_and_sum = np.column_stack((assignments, expr_sum))
@@ -124,7 +216,8 @@ def assign_vc(distances, vc_expression):
 
 def vc_assignments(segm_volume_file, em_dset,
                    vc_volume_file, cm_dset, vc_expr_file,
-                   cells_med_expr_table, output_gene_table, n_threads):
+                   cells_med_expr_table, output_gene_table, n_threads,
+                   engine='candidates'):
     # volume file for vc's (generated from CellModels_coordinates)
     with open_file(vc_volume_file, 'r') as f:
         vc_data = f[cm_dset][:]
@@ -140,12 +233,14 @@ def vc_assignments(segm_volume_file, em_dset,
         get_common_genes(vc_expr_file, cells_med_expr_table)
 
     # get the genetic distance from cells to surrounding vcs
-    dist_matrix = get_distances(downsampled_segm_data, vc_data,
-                                cells_expression_subset,
-                                vc_expression_subset, n_threads)
+    cells, vcs, distances = get_distances(downsampled_segm_data, vc_data,
+                                          cells_expression_subset,
+                                          vc_expression_subset, n_threads,
+                                          engine=engine)
 
     # assign the cells to the genetically closest vcs
-    cell_assign = assign_vc(dist_matrix, vc_expression_subset)
+    cell_assign = assign_vc(cells, vcs, distances, cells_expression_subset.shape[0],
+                            vc_expression_subset)
     # write down a new table
     col_names = ['label_id'] + common_gene_names + ['VC', 'expression_sum']
     assert cell_assign.shape[1] == len(col_names)
@@ -1,9 +1,9 @@
 import os
-import pandas as pd
 import luigi
 from cluster_tools.cluster_tasks import WorkflowBase
 
 from . import morphology as morpho_tasks
+from .morphology_impl import merge_tables
 
 
 class MergeTables(luigi.Task):
@@ -17,18 +17,13 @@ class MergeTables(luigi.Task):
 
     def run(self):
         # load all job sub results
-        tables = []
-        for job_id in range(self.max_jobs):
-            path = self.output_prefix + '_job%i.csv' % job_id
-            # NOTE: not all jobs might have been scheduled, so
-            # we neeed to check if the result actually exists
-            if not os.path.exists(path):
-                continue
-            sub_table = pd.read_csv(path, sep='\t')
-            tables.append(sub_table)
-
-        table = pd.concat(tables)
-        table.sort_values('label_id', inplace=True)
+        paths = [self.output_prefix + '_job%i.npz' % job_id for job_id in range(self.max_jobs)]
+        # NOTE: not all jobs might have been scheduled, so
+        # we neeed to check if the result actually exists
+        paths = [path for path in paths if os.path.exists(path)]
+
+        # the job results are binary tables, we only write the csv for the merged table
+        table = merge_tables(paths)
         table.to_csv(self.output_path, index=False, sep='\t')
 
     def output(self):
@@ -64,6 +59,11 @@ class MorphologyWorkflow(WorkflowBase):
     max_size = luigi.IntParameter(default=None)
     max_bb = luigi.IntParameter()
 
+    # names of the feature families to compute, compute all families if None
+    feature_families = luigi.ListParameter(default=None)
+    # method for computing the surface area, 'marching_cubes' or 'voxel_faces'
+    surface_area_mode = luigi.Parameter(default='marching_cubes')
+
     output_path = luigi.Parameter()
 
     def requires(self):
@@ -81,7 +81,9 @@ class MorphologyWorkflow(WorkflowBase):
                           in_table_path=self.in_table_path, output_prefix=out_prefix,
                           nucleus_mapping_path=self.nucleus_mapping_path,
                           region_mapping_path=self.region_mapping_path,
-                          min_size=self.min_size, max_size=self.max_size, max_bb=self.max_bb)
+                          min_size=self.min_size, max_size=self.max_size, max_bb=self.max_bb,
+                          feature_families=self.feature_families,
+                          surface_area_mode=self.surface_area_mode)
         dep = MergeTables(output_prefix=out_prefix, output_path=self.output_path,
                           max_jobs=self.max_jobs, dependency=dep)
 
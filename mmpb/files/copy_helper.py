@@ -69,14 +69,16 @@ def copy_tables(src_folder, dst_folder, table_folder=None):
 def link_id_lut(src_folder, dst_folder, name):
     # for local storage:
     # make link to the previous id look-up-table (if present)
-    lut_name = 'new_id_lut_%s.json' % name
-    lut_in = os.path.join(src_folder, 'misc', lut_name)
-    if not os.path.exists(lut_in):
-        return
-    lut_out = os.path.join(dst_folder, 'misc', lut_name)
-    if not os.path.exists(lut_out):
-        rel_path = os.path.relpath(lut_in, os.path.split(lut_out)[0])
-        os.symlink(rel_path, lut_out)
+    # and to the binary id look-up-table that is stored next to it
+    for ext in ('.json', '.npy'):
+        lut_name = 'new_id_lut_%s%s' % (name, ext)
+        lut_in = os.path.join(src_folder, 'misc', lut_name)
+        if not os.path.exists(lut_in):
+            continue
+        lut_out = os.path.join(dst_folder, 'misc', lut_name)
+        if not os.path.exists(lut_out):
+            rel_path = os.path.relpath(lut_in, os.path.split(lut_out)[0])
+            os.symlink(rel_path, lut_out)
 
 
 def copy_image_data(src_folder, dst_folder, exclude_prefixes=[]):
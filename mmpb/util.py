@@ -1,8 +1,8 @@
 import os
 import json
+import hashlib
 
 import numpy as np
-import nifty.tools as nt
 from elf.io import open_file
 
 
@@ -34,18 +34,143 @@ def read_resolution(paintera_path, paintera_key, to_um=True):
     return resolution
 
 
-def propagate_lut(lut_path, ids):
+def binary_id_lut_path(lut_path):
+    """ Path of the dense binary id look-up table that is stored next to the json table.
+
+    The path of the json table is resolved first, so versions that link to the same
+    json table also share the binary table.
+    """
+    return os.path.splitext(os.path.realpath(lut_path))[0] + '.npy'
+
+
+def binary_id_lut_is_current(lut_path):
+    """ Check that the binary table exists and is not older than the json table.
+    """
+    binary_path = binary_id_lut_path(lut_path)
+    if not os.path.exists(binary_path):
+        return False
+    return os.stat(binary_path).st_mtime_ns >= os.stat(lut_path).st_mtime_ns
+
+
+def _save_binary_id_lut(lut, lut_path):
+    # write to a temporary file and move it, so that concurrent processes never read a partial table
+    binary_path = binary_id_lut_path(lut_path)
+    tmp_path = os.path.splitext(binary_path)[0] + '.tmp%i.npy' % os.getpid()
+    np.save(tmp_path, lut)
+    os.replace(tmp_path, binary_path)
+
+
+def write_id_lut(lut, lut_path):
+    """ Write the id look-up table as json and as dense binary table.
+
+    Arguments:
+        lut [np.ndarray] - the new id and mapped count for each previous id,
+            either of shape (n_ids, 2) or of shape (n_ids,) if we don't have counts
+        lut_path [str] - path to the json table, the binary table is written next to it
+    """
+    lut = np.asarray(lut, dtype='uint64')
+    assert lut.ndim in (1, 2), lut.ndim
+    with open(lut_path, 'w') as f:
+        json.dump(dict(zip(range(len(lut)), lut.tolist())), f)
+    _save_binary_id_lut(lut, lut_path)
+
+
+def convert_id_lut(lut_path):
+    """ Write the dense binary table for an existing json id look-up table.
+
+    Also use this to rebuild a binary table that is older than the json table.
+    """
+    old_ids, new_ids, mapping_counts = load_id_lut(lut_path, prefer_binary=False)
+    if not np.array_equal(old_ids, np.arange(len(old_ids))):
+        raise ValueError("Can only convert dense id look-up tables, %s is not dense" % lut_path)
+    lut = new_ids if mapping_counts is None else np.stack([new_ids, mapping_counts], axis=1)
+    _save_binary_id_lut(lut.astype('uint64'), lut_path)
+
+
+def load_id_lut(lut_path, prefer_binary=True):
+    """ Load the id look-up table that maps the ids of the previous version to the new ids.
+
+    We have two different versions of the look-up table: the old one that only saves
+    the mapped ids and the new one that also saves the mapped counts.
+    If the dense binary table exists next to the json table, it is memory-mapped instead
+    of parsing the json. If the binary table is older than the json table, the json is parsed;
+    the binary table is only written by 'write_id_lut' and 'convert_id_lut'.
+    The mapped counts are returned as uint64 for both tables.
+
+    Returns:
+        np.ndarray - the previous ids, sorted
+        np.ndarray - the new ids for the previous ids
+        np.ndarray - the mapped counts for the previous ids, None for the old version
+    """
+    if prefer_binary and binary_id_lut_is_current(lut_path):
+        lut = np.load(binary_id_lut_path(lut_path), mmap_mode='r')
+        old_ids = np.arange(lut.shape[0], dtype='uint64')
+        if lut.ndim == 1:
+            return old_ids, lut, None
+        return old_ids, lut[:, 0], lut[:, 1]
+
     with open(lut_path) as f:
         lut = json.load(f)
-    lut = {int(k): v for k, v in lut.items()}
-    if isinstance(lut[0], list):
-        lut = {k: v[0] for k, v in lut.items()}
-    return nt.takeDict(lut, np.array(ids, dtype='uint32')).tolist()
+    old_ids = np.array([int(k) for k in lut.keys()], dtype='uint64')
+    values = list(lut.values())
+    if len(values) > 0 and isinstance(values[0], list):
+        new_ids = np.array([v[0] for v in values], dtype='uint64')
+        counts = np.array([v[1] for v in values], dtype='uint64')
+    else:
+        new_ids = np.array(values, dtype='uint64')
+        counts = None
 
+    order = np.argsort(old_ids, kind='stable')
+    old_ids, new_ids = old_ids[order], new_ids[order]
+    if counts is not None:
+        counts = counts[order]
+    return old_ids, new_ids, counts
 
-def propagate_ids(root, src_version, trgt_version, seg_name, ids):
-    """ Propagate list of ids from source version to target version.
+
+def lut_index(old_ids, ids):
+    """ Find the index of the ids in the previous ids of a look-up table loaded with 'load_id_lut'.
     """
+    ids = np.asarray(ids, dtype='uint64')
+    if len(old_ids) == 0:
+        index = np.zeros(ids.shape, dtype='int64')
+        missing = np.ones(ids.shape, dtype='bool')
+    else:
+        index = np.minimum(np.searchsorted(old_ids, ids), len(old_ids) - 1)
+        missing = old_ids[index] != ids
+    if missing.any():
+        raise KeyError("%i ids are not in the id look-up table, e.g. %s" % (missing.sum(),
+                                                                            str(ids[missing][:10])))
+    return index
+
+
+def apply_id_lut(old_ids, new_ids, ids):
+    """ Map the ids with a look-up table loaded with 'load_id_lut'.
+    """
+    return new_ids[lut_index(old_ids, ids)]
+
+
+def propagate_lut(lut_path, ids):
+    old_ids, new_ids, _ = load_id_lut(lut_path)
+    return apply_id_lut(old_ids, new_ids, ids).tolist()
+
+
+# marks the ids that can't be propagated through all look-up tables
+INVALID_ID = np.iinfo('uint64').max
+
+
+def get_cache_folder():
+    """ Get the folder for caching intermediate results, e.g. composed id look-up tables.
+
+    Can be set with the environment variable PLATYBROWSER_CACHE_DIR, defaults to ~/.cache/mmpb.
+    """
+    cache_folder = os.environ.get('PLATYBROWSER_CACHE_DIR',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'mmpb'))
+    os.makedirs(cache_folder, exist_ok=True)
+    return cache_folder
+
+
+def _id_lut_chain(root, src_version, trgt_version, seg_name):
+    # find all look-up tables needed to propagate ids from the source to the target version
     version_file = os.path.join(root, 'versions.json')
     with open(version_file) as f:
         versions = json.load(f)
@@ -83,19 +208,91 @@ def propagate_ids(root, src_version, trgt_version, seg_name, ids):
             if abs_lut not in luts:
                 luts.append(abs_lut)
             break
+    return luts
+
 
-    def load_lut(lut_path):
-        with open(lut_path) as f:
-            lut = json.load(f)
-        lut = {int(k): v for k, v in lut.items()}
-        return lut
+def compose_id_luts(lut_paths):
+    """ Compose the id look-up tables, so that ids can be propagated through all of them at once.
+
+    Ids that can't be propagated, because an intermediate id is missing in one of the
+    look-up tables, are mapped to INVALID_ID.
+
+    Returns:
+        np.ndarray - the ids of the first look-up table, sorted
+        np.ndarray - the propagated ids
+    """
+    old_ids, new_ids, _ = load_id_lut(lut_paths[0])
+    old_ids, new_ids = np.array(old_ids), np.array(new_ids)
+    valid = np.ones(len(new_ids), dtype='bool')
+    for lut_path in lut_paths[1:]:
+        lut_old_ids, lut_new_ids, _ = load_id_lut(lut_path)
+        if len(lut_old_ids) == 0:
+            valid[:] = False
+            continue
+        index = np.minimum(np.searchsorted(lut_old_ids, new_ids), len(lut_old_ids) - 1)
+        valid = np.logical_and(valid, lut_old_ids[index] == new_ids)
+        new_ids = np.array(lut_new_ids[index])
+    new_ids[~valid] = INVALID_ID
+    return old_ids, new_ids
 
-    luts = [load_lut(lut) for lut in luts]
+
+def _lut_fingerprint(lut_paths):
+    # the fingerprint changes if any of the look-up tables is changed
+    stats = []
+    for lut_path in lut_paths:
+        for path in (lut_path, binary_id_lut_path(lut_path)):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stats.append([path, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(stats).encode('utf-8')).hexdigest()
+
+
+def get_composed_id_lut(root, src_version, trgt_version, seg_name, use_cache=True):
+    """ Get the composed id look-up table from the source to the target version.
+
+    The composed table is cached in the cache folder (see 'get_cache_folder')
+    and recomputed if any of the look-up tables between the versions changes.
+
+    Returns:
+        np.ndarray - the ids in the source version, sorted
+        np.ndarray - the ids in the target version, INVALID_ID for ids that can't be propagated
+    """
+    lut_paths = _id_lut_chain(root, src_version, trgt_version, seg_name)
+    if len(lut_paths) == 0:
+        return None, None
+
+    if use_cache:
+        cache_name = 'id_lut_%s_%s_to_%s_%s.npz' % (seg_name, src_version, trgt_version,
+                                                    _lut_fingerprint(lut_paths))
+        cache_path = os.path.join(get_cache_folder(), cache_name)
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as f:
+                return f['old_ids'], f['new_ids']
+
+    old_ids, new_ids = compose_id_luts(lut_paths)
+
+    if use_cache:
+        # write to a temporary file and move it, so that concurrent processes never read a partial cache
+        tmp_path = cache_path + '.tmp%i' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, old_ids=old_ids, new_ids=new_ids)
+        os.replace(tmp_path, cache_path)
+    return old_ids, new_ids
+
+
+def propagate_ids(root, src_version, trgt_version, seg_name, ids, use_cache=True):
+    """ Propagate list of ids from source version to target version.
+    """
+    old_ids, new_ids = get_composed_id_lut(root, src_version, trgt_version, seg_name, use_cache=use_cache)
+    if old_ids is None:
+        return list(ids)
 
     # propagate ids through all luts
-    propagated = np.array(ids, dtype='uint64')
-    for lut in luts:
-        propagated = nt.takeDict(lut, propagated)
+    propagated = apply_id_lut(old_ids, new_ids, ids)
+    invalid = propagated == INVALID_ID
+    if invalid.any():
+        raise KeyError("Can't propagate the ids %s from %s to %s" % (str(np.array(ids)[invalid]),
+                                                                     src_version, trgt_version))
     return propagated.tolist()
 
 
@@ -0,0 +1,63 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from elf.io import open_file
+from mmpb.attributes.base_attributes import (correct_anchors_for_outliers, n5_attributes,
+                                             run_correction, values_at_points)
+from mmpb.default_config import write_default_global_config
+
+
+def fraction_inside(ds, attributes, anchors, n_threads):
+    # check which anchors are inside of their object at full resolution
+    valid = np.logical_and(attributes[:, 0] != 0, attributes[:, 1] > 0)
+    invalid_anchors = np.isclose(anchors, 0.).all(axis=1)
+    anchors = anchors.copy()
+    anchors[invalid_anchors] = attributes[invalid_anchors, 2:5]
+    points = np.clip(np.round(anchors[valid]).astype('int64'), 0, np.array(ds.shape) - 1)
+    labels = values_at_points(ds, points, n_threads)
+    return np.mean(labels == attributes[valid, 0])
+
+
+# compare run-time and quality (= fraction of anchors inside of their object)
+# of the region center workflow and the correction of outlier anchors
+def benchmark_anchors(input_path, input_key, resolution, tmp_folder, target, max_jobs, n_threads):
+    write_default_global_config(os.path.join(tmp_folder, 'configs'))
+    tmp_path, tmp_key = n5_attributes(input_path, input_key, tmp_folder, target, max_jobs)
+    with open_file(tmp_path, 'r') as f:
+        attributes = f[tmp_key][:]
+
+    t0 = time.time()
+    anchors_region_centers = run_correction(input_path, input_key, tmp_folder, target, max_jobs)
+    t_region_centers = time.time() - t0
+    print("Region centers computed in", t_region_centers, "s")
+
+    t0 = time.time()
+    anchors_outliers = correct_anchors_for_outliers(input_path, input_key, attributes, resolution,
+                                                    n_threads=n_threads)
+    t_outliers = time.time() - t0
+    print("Outlier anchors corrected in", t_outliers, "s")
+    print("Speed-up:", t_region_centers / t_outliers)
+
+    with open_file(input_path, 'r') as f:
+        ds = f[input_key]
+        for name, anchors in (('center of mass', attributes[:, 2:5]),
+                              ('region centers', anchors_region_centers),
+                              ('corrected outliers', anchors_outliers)):
+            print(name, ": fraction of anchors inside of their object",
+                  fraction_inside(ds, attributes, anchors, n_threads))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str,
+                        default='../../data/1.0.1/images/local/sbem-6dpf-1-whole-segmented-cells.n5')
+    parser.add_argument('--input_key', type=str, default='setup0/timepoint0/s0')
+    parser.add_argument('--tmp_folder', type=str, default='tmp_anchors')
+    parser.add_argument('--target', type=str, default='local')
+    parser.add_argument('--max_jobs', type=int, default=32)
+    parser.add_argument('--n_threads', type=int, default=32)
+    args = parser.parse_args()
+    benchmark_anchors(args.input_path, args.input_key, [0.025, 0.02, 0.02],
+                      args.tmp_folder, args.target, args.max_jobs, args.n_threads)
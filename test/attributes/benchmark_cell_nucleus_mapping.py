@@ -0,0 +1,55 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from mmpb.attributes.util import node_labels, region_overlaps, OverlapMatrix
+from mmpb.default_config import write_default_global_config
+
+
+# compare the run-time of computing the cell to nucleus and nucleus to cell overlaps
+# with two node label workflows (as done in 'map_cells_to_nuclei' before)
+# and with the joint contingency table computed in a single pass
+def benchmark_cell_nucleus_mapping(seg_path, seg_key, nuc_path, nuc_key, tmp_folder, target, max_jobs,
+                                   overlap_threshold=.25):
+    write_default_global_config(os.path.join(tmp_folder, 'configs'))
+
+    t0 = time.time()
+    cids_to_nids = node_labels(seg_path, seg_key, nuc_path, nuc_key, 'bench_nuc_to_cells',
+                               tmp_folder, target, max_jobs, max_overlap=False, ignore_label=0)
+    nids_to_cids = node_labels(nuc_path, nuc_key, seg_path, seg_key, 'bench_cells_to_nuc',
+                               tmp_folder, target, max_jobs, max_overlap=False, ignore_label=0)
+    t_node_labels = time.time() - t0
+    print("Overlaps computed with two node label workflows in", t_node_labels, "s")
+
+    t0 = time.time()
+    overlaps = region_overlaps(seg_path, seg_key, [nuc_path], [nuc_key], 'bench_cells_and_nuclei',
+                               tmp_folder, target, max_jobs)[0]
+    overlaps = OverlapMatrix.from_pairs(*overlaps)
+    t_single_pass = time.time() - t0
+    print("Overlaps computed with the joint contingency table in", t_single_pass, "s")
+    print("Speed-up:", t_node_labels / t_single_pass)
+
+    for name, expected, result in (('cells to nuclei', cids_to_nids, overlaps),
+                                   ('nuclei to cells', nids_to_cids, overlaps.transpose())):
+        expected = expected.unique_overlap(overlap_threshold, ignore_label=0)
+        result = result.unique_overlap(overlap_threshold, ignore_label=0)
+        n_labels = min(len(expected), len(result))
+        print(name, ": number of differing assignments",
+              np.sum(expected[:n_labels] != result[:n_labels]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seg_path', type=str,
+                        default='../../data/1.0.1/images/local/sbem-6dpf-1-whole-segmented-cells.n5')
+    parser.add_argument('--seg_key', type=str, default='setup0/timepoint0/s2')
+    parser.add_argument('--nuc_path', type=str,
+                        default='../../data/1.0.1/images/local/sbem-6dpf-1-whole-segmented-nuclei.n5')
+    parser.add_argument('--nuc_key', type=str, default='setup0/timepoint0/s0')
+    parser.add_argument('--tmp_folder', type=str, default='tmp_cell_nucleus_mapping')
+    parser.add_argument('--target', type=str, default='local')
+    parser.add_argument('--max_jobs', type=int, default=32)
+    args = parser.parse_args()
+    benchmark_cell_nucleus_mapping(args.seg_path, args.seg_key, args.nuc_path, args.nuc_key,
+                                   args.tmp_folder, args.target, args.max_jobs)
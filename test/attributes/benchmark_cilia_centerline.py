@@ -0,0 +1,90 @@
+import argparse
+import time
+
+import h5py
+import nifty
+import numpy as np
+import pandas as pd
+from elf.skeleton import skeletonize
+from mmpb.attributes.cilia_attributes import load_seg, longest_path
+
+
+# the previous centerline extraction: shortest paths from every terminal to all other terminals
+def longest_path_all_terminals(nodes, edges, resolution):
+    graph = nifty.graph.undirectedGraph(len(nodes))
+    graph.insertEdges(edges)
+
+    physical_coords = nodes.astype('float32') * np.array(list(resolution))
+    edge_lens = physical_coords[edges[:, 0]] - physical_coords[edges[:, 1]]
+    edge_lens = np.linalg.norm(edge_lens, axis=1)
+
+    degrees = np.array([len([adj for adj in graph.nodeAdjacency(u)])
+                       for u in range(graph.numberOfNodes)])
+    terminals = np.where(degrees == 1)[0]
+    if len(terminals) < 2:
+        raise ValueError("Did not find terminals.")
+
+    max_plen = 0.
+    sp = nifty.graph.ShortestPathDijkstra(graph)
+    for ii, t in enumerate(terminals[:-1]):
+        targets = terminals[ii+1:]
+        paths = sp.runSingleSourceMultiTarget(edge_lens, t, targets,
+                                              returnNodes=False)
+        for target, p in zip(targets, paths):
+            if not p:
+                continue
+            plen = edge_lens[np.array(p)].sum()
+            if plen > max_plen:
+                max_plen = plen
+    return max_plen
+
+
+# compare the run-time of the centerline extraction for each cilium
+# and check that the lengths agree with the previous all-terminals implementation
+def benchmark_cilia_centerline(seg_path, seg_key, table_path, resolution):
+    base_table = pd.read_csv(table_path, sep='\t')
+    skel_res = [res * 1000 for res in resolution]
+
+    results = []
+    with h5py.File(seg_path, 'r') as f:
+        ds = f[seg_key]
+        for cid in base_table['label_id'].values.astype('uint64')[1:]:
+            if cid in (1, 2):
+                continue
+            obj = load_seg(ds, base_table, cid, resolution)
+            if obj.sum() == 0:
+                continue
+            nodes, edges = skeletonize(obj)
+            n_terminals = int((np.bincount(edges.ravel(), minlength=len(nodes)) == 1).sum())
+            try:
+                t0 = time.time()
+                len_terminals = longest_path_all_terminals(nodes, edges, skel_res)
+                t_terminals = time.time() - t0
+
+                t0 = time.time()
+                _, len_sweeps = longest_path(nodes, edges, skel_res)
+                t_sweeps = time.time() - t0
+            except ValueError:
+                print("Centerline computation for", cid, "failed")
+                continue
+            print("cilium", cid, "with", len(nodes), "nodes and", n_terminals, "terminals: all terminals",
+                  t_terminals, "s, two sweeps", t_sweeps, "s, lengths", len_terminals, len_sweeps)
+            results.append([t_terminals, t_sweeps, len_terminals, len_sweeps])
+
+    results = np.array(results)
+    print("Total time: all terminals", results[:, 0].sum(), "s, two sweeps", results[:, 1].sum(), "s")
+    print("Max time per cilium: all terminals", results[:, 0].max(), "s, two sweeps",
+          results[:, 1].max(), "s")
+    print("Lengths agree for all cilia:", np.allclose(results[:, 2], results[:, 3], rtol=1e-5))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seg_path', type=str,
+                        default='../../data/0.5.1/segmentations/sbem-6dpf-1-whole-segmented-cilia-labels.h5')
+    parser.add_argument('--seg_key', type=str, default='t00000/s00/0/cells')
+    parser.add_argument('--table_path', type=str,
+                        default=('../../data/0.5.1/tables/sbem-6dpf-1-whole-segmented-cilia-labels/'
+                                 'default.csv'))
+    args = parser.parse_args()
+    benchmark_cilia_centerline(args.seg_path, args.seg_key, args.table_path, [0.025, 0.01, 0.01])
@@ -0,0 +1,48 @@
+import argparse
+import time
+
+import numpy as np
+from elf.io import open_file
+from pybdv.metadata import get_data_path
+from vigra.sampling import resize
+from mmpb.extension.attributes.genes_impl import get_cell_expression, open_genes
+
+
+# compare the run-time of the expression engines on the prospr gene stack
+def benchmark_gene_expression(seg_path, seg_key, genes_xml, n_threads, n_genes):
+    genes_path = get_data_path(genes_xml, return_absolute_path=True)
+    with open_file(seg_path, 'r') as f:
+        segmentation = f[seg_key][:]
+    with open_file(genes_path, 'r') as f:
+        ds = open_genes(f)
+        gene_shape = ds.shape[1:]
+        n_genes = ds.shape[0] if n_genes is None else n_genes
+        all_genes = ds[:n_genes]
+    segmentation = resize(segmentation.astype('float32'), shape=gene_shape, order=0).astype('uint16')
+    print("Computing expression of", n_genes, "genes for", len(np.unique(segmentation)), "cells")
+
+    results = {}
+    for engine in ('per_cell', 'bincount'):
+        t0 = time.time()
+        results[engine] = get_cell_expression(segmentation, all_genes, n_threads, engine=engine)
+        results[engine + '_time'] = time.time() - t0
+        print(engine, ": computed in", results[engine + '_time'], "s")
+    print("Speed-up:", results['per_cell_time'] / results['bincount_time'])
+
+    labels, expression = results['per_cell']
+    labels_bincount, expression_bincount = results['bincount']
+    print("Results are identical:", np.array_equal(labels, labels_bincount) and
+          np.array_equal(expression, expression_bincount))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seg_path', type=str,
+                        default='../../data/1.0.1/images/local/sbem-6dpf-1-whole-segmented-cells.n5')
+    parser.add_argument('--seg_key', type=str, default='setup0/timepoint0/s4')
+    parser.add_argument('--genes_xml', type=str,
+                        default='../../data/1.0.1/misc/prospr-6dpf-1-whole_meds_all_genes.xml')
+    parser.add_argument('--n_threads', type=int, default=8)
+    parser.add_argument('--n_genes', type=int, default=None)
+    args = parser.parse_args()
+    benchmark_gene_expression(args.seg_path, args.seg_key, args.genes_xml, args.n_threads, args.n_genes)
@@ -0,0 +1,48 @@
+import argparse
+import os
+import time
+from shutil import rmtree
+
+import numpy as np
+from elf.io import open_file
+from mmpb.attributes.genes import create_auxiliary_gene_file
+from mmpb.extension.attributes.genes_impl import open_genes
+
+
+def _file_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+# compare file size, build time and read throughput of the boolean and the bit-packed gene layout
+def benchmark_gene_layout(meds_root, tmp_folder, n_threads):
+    os.makedirs(tmp_folder, exist_ok=True)
+    results = {}
+    for name, packed in (('bool', False), ('packed', True)):
+        out_file = os.path.join(tmp_folder, 'genes_%s.h5' % name)
+        t0 = time.time()
+        create_auxiliary_gene_file(meds_root, out_file, packed=packed, n_threads=n_threads)
+        t_build = time.time() - t0
+
+        t0 = time.time()
+        with open_file(out_file, 'r') as f:
+            genes = open_genes(f)[:]
+        t_read = time.time() - t0
+        size = _file_size(out_file) / 1e6
+        print(name, ": build", t_build, "s, file size", size, "MB, read", t_read, "s, throughput",
+              genes.size / 1e6 / t_read, "Mvoxel / s")
+        results[name] = genes
+
+    print("Genes are identical:", np.array_equal(results['bool'], results['packed']))
+    rmtree(tmp_folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--meds_root', type=str, default='../../data/1.0.1/images/local')
+    parser.add_argument('--tmp_folder', type=str, default='tmp_gene_layout')
+    parser.add_argument('--n_threads', type=int, default=8)
+    args = parser.parse_args()
+    benchmark_gene_layout(args.meds_root, args.tmp_folder, args.n_threads)
@@ -0,0 +1,86 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import vigra
+from elf.io import open_file
+from mmpb.extension.attributes.intensity_impl import intensity_statistics, INTENSITY_COLUMNS
+from mmpb.extension.attributes.morphology_impl import (get_keys, get_scale_factor, intensity_row_features,
+                                                       load_data, run_all_filters)
+
+
+def resize_to(data, shape):
+    if data.shape == shape:
+        return data
+    dtype = data.dtype
+    return vigra.sampling.resize(data.astype('float32'), shape=shape, order=0).astype(dtype)
+
+
+# the per-row computation, as done in 'morphology_impl_cell'
+def per_row_statistics(table, seg_path, seg_key, raw_path, raw_key, nuc_path, nuc_key,
+                       scale_seg, scale_raw, scale_nuc):
+    stats = []
+    with open_file(seg_path, 'r') as f_seg, open_file(raw_path, 'r') as f_raw, \
+            open_file(nuc_path, 'r') as f_nuc:
+        ds_seg, ds_raw, ds_nuc = f_seg[seg_key], f_raw[raw_key], f_nuc[nuc_key]
+        for row in table.itertuples(index=False):
+            seg_mask = load_data(ds_seg, row, scale_seg) == row.label_id
+            exclude = resize_to(load_data(ds_nuc, row, scale_nuc), seg_mask.shape)
+            seg_mask[exclude == int(row.nucleus_id)] = False
+            raw = load_data(ds_raw, row, scale_raw)
+            seg_mask = resize_to(seg_mask, raw.shape)
+            stats.append((row.label_id,) + intensity_row_features(raw, seg_mask))
+    return pd.DataFrame(stats, columns=['label_id'] + INTENSITY_COLUMNS)
+
+
+def benchmark_intensity_statistics(folder, n_threads, n_rows):
+    name = 'sbem-6dpf-1-whole-segmented-cells'
+    table = pd.read_csv('%s/tables/%s/default.csv' % (folder, name), sep='\t')
+    mapping_path = '%s/tables/%s/cells_to_nuclei.csv' % (folder, name)
+    region_path = '%s/tables/%s/regions.csv' % (folder, name)
+    # the values used in 'write_morphology_cells'
+    table = run_all_filters(table, 88741, 600000000, 454000, mapping_path, region_path)
+    if n_rows is not None:
+        table = table.iloc[:n_rows]
+    label_ids = table['label_id'].values.astype('uint64')
+    nucleus_ids = table['nucleus_id'].values.astype('uint64')
+
+    seg_path = '%s/images/local/%s.n5' % (folder, name)
+    raw_path = '%s/images/local/sbem-6dpf-1-whole-raw.n5' % folder
+    nuc_path = '%s/images/local/sbem-6dpf-1-whole-segmented-nuclei.n5' % folder
+    seg_key_full, seg_key = get_keys(seg_path, 2)
+    raw_key_full, raw_key = get_keys(raw_path, 3)
+    nuc_key_full, nuc_key = get_keys(nuc_path, 0)
+    scale_seg = get_scale_factor(seg_path, seg_key_full, seg_key, [0.025, 0.02, 0.02])
+    scale_raw = get_scale_factor(raw_path, raw_key_full, raw_key, [0.025, 0.01, 0.01])
+    scale_nuc = get_scale_factor(nuc_path, nuc_key_full, nuc_key, [0.1, 0.08, 0.08])
+
+    t0 = time.time()
+    stats_row = per_row_statistics(table, seg_path, seg_key, raw_path, raw_key, nuc_path, nuc_key,
+                                   scale_seg, scale_raw, scale_nuc)
+    t_row = time.time() - t0
+    print("Per-row computation for", len(table), "labels in", t_row, "s")
+
+    t0 = time.time()
+    stats_sweep = intensity_statistics(seg_path, seg_key, raw_path, raw_key, label_ids,
+                                       exclude_path=nuc_path, exclude_key=nuc_key,
+                                       exclude_ids=nucleus_ids, n_threads=n_threads)
+    t_sweep = time.time() - t0
+    print("Blockwise computation for", len(table), "labels in", t_sweep, "s")
+    print("Speed-up:", t_row / t_sweep)
+
+    # the statistics can deviate slightly for voxels at the mask boundaries,
+    # because the per-row computation resamples each bounding box individually
+    for col in INTENSITY_COLUMNS:
+        diff = np.abs(stats_row[col].values - stats_sweep[col].values)
+        print(col, ": mean absolute difference", np.nanmean(diff), "max", np.nanmax(diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', type=str, default='../../data/1.0.1')
+    parser.add_argument('--n_threads', type=int, default=16)
+    parser.add_argument('--n_rows', type=int, default=None)
+    args = parser.parse_args()
+    benchmark_intensity_statistics(args.folder, args.n_threads, args.n_rows)
@@ -0,0 +1,67 @@
+import argparse
+import os
+import time
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+from mmpb.extension.attributes.morphology_impl import merge_tables, write_table
+
+
+# the merge for csv job results, as done in 'MergeTables' before
+def merge_csv_tables(paths):
+    table = pd.concat([pd.read_csv(path, sep='\t') for path in paths])
+    table.sort_values('label_id', inplace=True)
+    return table
+
+
+# compare the time for merging the per-job morphology results stored as csv and as npz,
+# using random tables of the size of the cell morphology table
+def benchmark_merge_tables(n_rows, n_columns, n_jobs, tmp_folder):
+    os.makedirs(tmp_folder, exist_ok=True)
+    np.random.seed(42)
+    columns = ['label_id'] + ['feature%i' % ii for ii in range(n_columns - 1)]
+    label_ids = np.arange(1, n_rows + 1, dtype='float64')
+
+    csv_paths, npz_paths = [], []
+    for job_id, job_labels in enumerate(np.array_split(label_ids, n_jobs)):
+        values = np.random.rand(len(job_labels), n_columns - 1) * 1000
+        table = pd.DataFrame(np.concatenate([job_labels[:, None], values], axis=1), columns=columns)
+        csv_path = os.path.join(tmp_folder, 'job%i.csv' % job_id)
+        npz_path = os.path.join(tmp_folder, 'job%i.npz' % job_id)
+        table.to_csv(csv_path, index=False, sep='\t')
+        write_table(table, npz_path)
+        csv_paths.append(csv_path)
+        npz_paths.append(npz_path)
+
+    # the csv for the final table is written in both cases
+    output_path = os.path.join(tmp_folder, 'merged.csv')
+    t0 = time.time()
+    table_csv = merge_csv_tables(csv_paths)
+    t_csv = time.time() - t0
+    table_csv.to_csv(output_path, index=False, sep='\t')
+    t_csv_total = time.time() - t0
+    print("Merge csv tables in", t_csv, "s, including writing the final csv", t_csv_total, "s")
+
+    t0 = time.time()
+    table_npz = merge_tables(npz_paths)
+    t_npz = time.time() - t0
+    table_npz.to_csv(output_path, index=False, sep='\t')
+    t_npz_total = time.time() - t0
+    print("Merge npz tables in", t_npz, "s, including writing the final csv", t_npz_total, "s")
+    print("Speed-up merge:", t_csv / t_npz, "total:", t_csv_total / t_npz_total)
+
+    # the csv round-trip is not exact, the binary tables are
+    diff = np.abs(table_csv.values - table_npz.values)
+    print("Max absolute difference between csv and npz results", diff.max())
+    rmtree(tmp_folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, default=120000)
+    parser.add_argument('--n_columns', type=int, default=40)
+    parser.add_argument('--n_jobs', type=int, default=100)
+    parser.add_argument('--tmp_folder', type=str, default='tmp_merge_tables')
+    args = parser.parse_args()
+    benchmark_merge_tables(args.n_rows, args.n_columns, args.n_jobs, args.tmp_folder)
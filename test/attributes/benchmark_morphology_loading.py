@@ -0,0 +1,69 @@
+import argparse
+import numpy as np
+import pandas as pd
+from elf.io import open_file
+from mmpb.extension.attributes.morphology_impl import (get_bb, get_keys, get_scale_factor,
+                                                       make_batches, DEFAULT_MAX_BATCH_VOXELS)
+
+
+def n_chunks(bb, chunks, shape):
+    return int(np.prod([(min(b.stop, sh) - 1) // ch - b.start // ch + 1
+                        for b, ch, sh in zip(bb, chunks, shape)]))
+
+
+def union_bb(rows, scale):
+    bbs = [get_bb(row, scale) for row in rows]
+    return tuple(slice(min(bb[d].start for bb in bbs), max(bb[d].stop for bb in bbs))
+                 for d in range(3))
+
+
+# compare the number of chunks that are decompressed per job when loading each object individually
+# and when loading spatially clustered batches of objects
+def benchmark_loading(table_path, seg_path, scale, resolution, n_jobs, max_batch_voxels):
+    table = pd.read_csv(table_path, sep='\t')
+    table = table.loc[table['label_id'] != 0, :]
+
+    key_full, key = get_keys(seg_path, scale)
+    scale_factor = get_scale_factor(seg_path, key_full, key, resolution)
+    with open_file(seg_path, 'r') as f:
+        ds = f[key]
+        shape, chunks = ds.shape, ds.chunks
+
+    n_labels = int(table['label_id'].max()) + 1
+    job_len = int(np.ceil(float(n_labels) / n_jobs))
+    chunks_per_row, chunks_batched = [], []
+    for job_id in range(n_jobs):
+        label_begin, label_end = job_id * job_len, (job_id + 1) * job_len
+        sub_table = table.loc[np.logical_and(table['label_id'] >= label_begin,
+                                             table['label_id'] < label_end), :]
+        if len(sub_table) == 0:
+            continue
+
+        chunks_per_row.append(sum(n_chunks(get_bb(row, scale_factor), chunks, shape)
+                                  for row in sub_table.itertuples(index=False)))
+        batches = make_batches(sub_table, scale_factor, chunks, max_batch_voxels)
+        chunks_batched.append(sum(n_chunks(union_bb(batch, scale_factor), chunks, shape)
+                                  for batch in batches))
+
+    chunks_per_row, chunks_batched = np.array(chunks_per_row), np.array(chunks_batched)
+    print("Decompressed chunks per job, loading objects one by one:")
+    print("mean:", chunks_per_row.mean(), "max:", chunks_per_row.max())
+    print("Decompressed chunks per job, loading objects in batches:")
+    print("mean:", chunks_batched.mean(), "max:", chunks_batched.max())
+    print("Reduction:", chunks_per_row.sum() / float(chunks_batched.sum()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table_path', type=str,
+                        default='../../data/1.0.1/tables/sbem-6dpf-1-whole-segmented-cells/default.csv')
+    parser.add_argument('--seg_path', type=str,
+                        default='../../data/1.0.1/images/local/sbem-6dpf-1-whole-segmented-cells.n5')
+    parser.add_argument('--scale', type=int, default=2)
+    parser.add_argument('--n_jobs', type=int, default=100)
+    parser.add_argument('--max_batch_voxels', type=int, default=DEFAULT_MAX_BATCH_VOXELS)
+    args = parser.parse_args()
+
+    resolution = [0.025, 0.02, 0.02]
+    benchmark_loading(args.table_path, args.seg_path, args.scale, resolution,
+                      args.n_jobs, args.max_batch_voxels)
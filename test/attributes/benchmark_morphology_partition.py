@@ -0,0 +1,60 @@
+import argparse
+import numpy as np
+import pandas as pd
+from mmpb.extension.attributes.morphology_impl import (balanced_label_ranges, compute_label_costs,
+                                                       get_keys, get_scale_factor, run_all_filters)
+
+
+def job_costs(label_ranges, label_ids, costs, number_of_labels):
+    label_costs = np.zeros(number_of_labels)
+    label_costs[label_ids] = costs
+    return np.array([label_costs[start:stop].sum() for start, stop in label_ranges])
+
+
+# compare the estimated job costs for the split into label ranges of equal length
+# and the split into label ranges of equal cost
+def benchmark_partition(table_path, seg_path, scale, resolution, n_jobs,
+                        min_size, max_size, max_bb, mapping_path, region_path):
+    table = pd.read_csv(table_path, sep='\t')
+    number_of_labels = int(table['label_id'].max()) + 1
+    table = run_all_filters(table, min_size, max_size, max_bb, mapping_path, region_path)
+
+    key_full, key = get_keys(seg_path, scale)
+    scale_factor = get_scale_factor(seg_path, key_full, key, resolution)
+    label_ids = table['label_id'].values.astype('uint64')
+    costs = compute_label_costs(table, scale_factor)
+
+    ids_per_job = int(np.ceil(float(number_of_labels) / n_jobs))
+    equal_ranges = [[start, min(start + ids_per_job, number_of_labels)]
+                    for start in range(0, number_of_labels, ids_per_job)]
+    balanced_ranges = balanced_label_ranges(label_ids, costs, number_of_labels, n_jobs)
+
+    for name, label_ranges in (('equal number of labels', equal_ranges),
+                               ('balanced cost', balanced_ranges)):
+        costs_per_job = job_costs(label_ranges, label_ids, costs, number_of_labels)
+        print("Split into", len(label_ranges), "jobs with", name)
+        print("Estimated cost: mean", costs_per_job.mean(), "max", costs_per_job.max())
+        print("Tail latency (max / mean):", costs_per_job.max() / costs_per_job.mean())
+    print("Largest single object cost:", costs.max())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    folder = '../../data/1.0.1'
+    parser.add_argument('--table_path', type=str,
+                        default='%s/tables/sbem-6dpf-1-whole-segmented-cells/default.csv' % folder)
+    parser.add_argument('--seg_path', type=str,
+                        default='%s/images/local/sbem-6dpf-1-whole-segmented-cells.n5' % folder)
+    parser.add_argument('--mapping_path', type=str,
+                        default='%s/tables/sbem-6dpf-1-whole-segmented-cells/cells_to_nuclei.csv' % folder)
+    parser.add_argument('--region_path', type=str,
+                        default='%s/tables/sbem-6dpf-1-whole-segmented-cells/regions.csv' % folder)
+    parser.add_argument('--scale', type=int, default=2)
+    parser.add_argument('--n_jobs', type=int, default=100)
+    args = parser.parse_args()
+
+    # the values used in 'write_morphology_cells'
+    resolution = [0.025, 0.02, 0.02]
+    min_size, max_size, max_bb = 88741, 600000000, 454000
+    benchmark_partition(args.table_path, args.seg_path, args.scale, resolution, args.n_jobs,
+                        min_size, max_size, max_bb, args.mapping_path, args.region_path)
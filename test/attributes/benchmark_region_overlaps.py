@@ -0,0 +1,53 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+from mmpb.attributes.region_attributes import _region_input
+from mmpb.attributes.util import node_labels, region_overlaps
+from mmpb.default_config import write_default_global_config
+from mmpb.extension.attributes.region_overlaps_impl import max_overlap_labels
+
+
+# compare the run-time of computing the region overlaps with one node labels workflow
+# per region volume (as done in 'region_attributes' before) and with a single sweep
+def benchmark_region_overlaps(seg_path, seg_key, segmentation_folder, tmp_folder, target, max_jobs):
+    write_default_global_config(os.path.join(tmp_folder, 'configs'))
+    xml_names = ['sbem-6dpf-1-whole-segmented-%s.xml' % name for name in ('tissue', 'midgut', 'nephridia')]
+    xml_names += [os.path.basename(pp)
+                  for pp in glob.glob(os.path.join(segmentation_folder, 'prospr-6dpf-1-whole-segmented-*'))]
+    inputs = [_region_input(segmentation_folder, name) for name in xml_names]
+    print("Computing overlaps with", len(inputs), "region volumes")
+
+    t0 = time.time()
+    labels_node_labels = [node_labels(seg_path, seg_key, path, key, 'bench%i' % ii,
+                                      tmp_folder, target, max_jobs)
+                          for ii, (path, key) in enumerate(inputs)]
+    t_node_labels = time.time() - t0
+    print("Node labels for each region volume computed in", t_node_labels, "s")
+
+    t0 = time.time()
+    overlaps = region_overlaps(seg_path, seg_key, [path for path, _ in inputs], [key for _, key in inputs],
+                               'bench', tmp_folder, target, max_jobs)
+    t_single_sweep = time.time() - t0
+    print("Overlaps with all region volumes computed in", t_single_sweep, "s")
+    print("Speed-up:", t_node_labels / t_single_sweep)
+
+    for name, labels, overlap in zip(xml_names, labels_node_labels, overlaps):
+        labels_single_sweep = max_overlap_labels(*overlap, len(labels))
+        print(name, ": number of differing labels", np.sum(labels != labels_single_sweep))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seg_path', type=str,
+                        default='../../data/1.0.1/images/local/sbem-6dpf-1-whole-segmented-cells.n5')
+    parser.add_argument('--seg_key', type=str, default='setup0/timepoint0/s2')
+    parser.add_argument('--segmentation_folder', type=str, default='../../data/1.0.1/images/local')
+    parser.add_argument('--tmp_folder', type=str, default='tmp_region_overlaps')
+    parser.add_argument('--target', type=str, default='local')
+    parser.add_argument('--max_jobs', type=int, default=32)
+    args = parser.parse_args()
+    benchmark_region_overlaps(args.seg_path, args.seg_key, args.segmentation_folder,
+                              args.tmp_folder, args.target, args.max_jobs)
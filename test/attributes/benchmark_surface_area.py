@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from elf.io import open_file
+from mmpb.extension.attributes.morphology_impl import (get_keys, get_scale_factor, load_data,
+                                                       morphology_row_features, run_all_filters)
+
+
+# compare run-time and values of the surface area computed with marching cubes
+# and estimated from the voxel faces
+def benchmark_surface_area(table_path, seg_path, scale, resolution, n_objects, mapping_path=None):
+    table = pd.read_csv(table_path, sep='\t')
+    table = run_all_filters(table, None, None, None, mapping_path, None)
+    if n_objects is not None and n_objects < len(table):
+        table = table.sample(n=n_objects, random_state=42)
+
+    key_full, key = get_keys(seg_path, scale)
+    scale_factor = get_scale_factor(seg_path, key_full, key, resolution)
+
+    results = {'marching_cubes': [], 'voxel_faces': []}
+    times = {'marching_cubes': 0., 'voxel_faces': 0.}
+    with open_file(seg_path, 'r') as f:
+        ds = f[key]
+        for row in table.itertuples(index=False):
+            mask = load_data(ds, row, scale_factor) == row.label_id
+            if mask.sum() == 0:
+                continue
+            for mode in results:
+                t0 = time.time()
+                features = morphology_row_features(mask, scale_factor, surface_area_mode=mode)
+                times[mode] += time.time() - t0
+                # surface area and sphericity
+                results[mode].append(features[5:7])
+
+    print("Computed surface areas for", len(results['marching_cubes']), "objects")
+    for mode, t in times.items():
+        print(mode, ": morphology features in", t, "s")
+    print("Speed-up:", times['marching_cubes'] / times['voxel_faces'])
+
+    reference, estimate = np.array(results['marching_cubes']), np.array(results['voxel_faces'])
+    for ii, name in enumerate(('surface_area', 'sphericity')):
+        rel_err = (estimate[:, ii] - reference[:, ii]) / reference[:, ii]
+        print(name, ": relative difference mean", rel_err.mean(), "std", rel_err.std(),
+              "max abs", np.abs(rel_err).max())
+        print(name, ": correlation", np.corrcoef(reference[:, ii], estimate[:, ii])[0, 1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', type=str, default='../../data/1.0.1')
+    parser.add_argument('--n_objects', type=int, default=500)
+    args = parser.parse_args()
+
+    folder = args.folder
+    print("Nuclei:")
+    name = 'sbem-6dpf-1-whole-segmented-nuclei'
+    benchmark_surface_area('%s/tables/%s/default.csv' % (folder, name),
+                           '%s/images/local/%s.n5' % (folder, name),
+                           0, [0.1, 0.08, 0.08], args.n_objects)
+
+    print("Cells:")
+    name = 'sbem-6dpf-1-whole-segmented-cells'
+    benchmark_surface_area('%s/tables/%s/default.csv' % (folder, name),
+                           '%s/images/local/%s.n5' % (folder, name),
+                           2, [0.025, 0.02, 0.02], args.n_objects,
+                           mapping_path='%s/tables/%s/cells_to_nuclei.csv' % (folder, name))
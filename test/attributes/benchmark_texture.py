@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from elf.io import open_file
+from mmpb.extension.attributes.morphology_impl import (clean_texture_mask, get_keys, get_scale_factor,
+                                                       load_data, resize_to_shape, run_all_filters,
+                                                       texture_row_features)
+from mmpb.extension.attributes.texture_impl import batched_haralick
+
+
+# compare run-time and values of the per-object (mahotas) and batched
+# haralick texture features for the nuclei
+def benchmark_texture(folder, n_objects):
+    name = 'sbem-6dpf-1-whole-segmented-nuclei'
+    table = pd.read_csv('%s/tables/%s/default.csv' % (folder, name), sep='\t')
+    # the values used in 'write_morphology_nuclei'
+    table = run_all_filters(table, 18313, None, None, None, None)
+    if n_objects is not None and n_objects < len(table):
+        table = table.sample(n=n_objects, random_state=42)
+
+    seg_path = '%s/images/local/%s.n5' % (folder, name)
+    raw_path = '%s/images/local/sbem-6dpf-1-whole-raw.n5' % folder
+    seg_key_full, seg_key = get_keys(seg_path, 0)
+    raw_key_full, raw_key = get_keys(raw_path, 3)
+    scale_seg = get_scale_factor(seg_path, seg_key_full, seg_key, [0.1, 0.08, 0.08])
+    scale_raw = get_scale_factor(raw_path, raw_key_full, raw_key, [0.025, 0.02, 0.02])
+
+    # load the data for all objects up-front, so that we only time the texture computation
+    raws, masks = [], []
+    with open_file(seg_path, 'r') as f_seg, open_file(raw_path, 'r') as f_raw:
+        ds_seg, ds_raw = f_seg[seg_key], f_raw[raw_key]
+        for row in table.itertuples(index=False):
+            raw = load_data(ds_raw, row, scale_raw)
+            mask = load_data(ds_seg, row, scale_seg) == row.label_id
+            mask = clean_texture_mask(resize_to_shape(mask, raw.shape))
+            raws.append(raw)
+            masks.append(mask)
+    print("Loaded data for", len(raws), "nuclei")
+
+    t0 = time.time()
+    features_row = np.array([texture_row_features(raw, mask) for raw, mask in zip(raws, masks)])
+    t_row = time.time() - t0
+    print("Per-object computation in", t_row, "s")
+
+    t0 = time.time()
+    crops = []
+    for raw, mask in zip(raws, masks):
+        crop = raw.copy()
+        crop[mask == 0] = 0
+        crops.append(crop)
+    features_batched = batched_haralick(crops)
+    t_batched = time.time() - t0
+    print("Batched computation in", t_batched, "s")
+    print("Speed-up:", t_row / t_batched)
+
+    diff = np.abs(features_row - features_batched)
+    print("Max absolute difference", diff.max(), "max relative difference",
+          (diff / np.maximum(np.abs(features_row), 1e-12)).max())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', type=str, default='../../data/1.0.1')
+    parser.add_argument('--n_objects', type=int, default=2000)
+    args = parser.parse_args()
+    benchmark_texture(args.folder, args.n_objects)
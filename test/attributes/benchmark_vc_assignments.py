@@ -0,0 +1,70 @@
+import argparse
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+from elf.io import open_file
+from pybdv.metadata import get_data_path
+from vigra.sampling import resize
+from mmpb.extension.attributes.vc_assignments_impl import assign_vc, get_common_genes, get_distances
+
+
+def _assign(seg_xml, seg_key, vc_xml, vc_key, vc_expression_path, med_expression_path,
+            n_threads, engine, queue):
+    with open_file(get_data_path(vc_xml, return_absolute_path=True), 'r') as f:
+        vc_data = f[vc_key][:]
+    with open_file(get_data_path(seg_xml, return_absolute_path=True), 'r') as f:
+        segmentation = f[seg_key][:]
+    segmentation = resize(segmentation.astype('float32'), shape=vc_data.shape, order=0).astype('uint16')
+    cells_expression, vc_expression, _ = get_common_genes(vc_expression_path, med_expression_path)
+    # ru_maxrss is given in kilobytes on linux
+    rss_inputs = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    t0 = time.time()
+    cells, vcs, distances = get_distances(segmentation, vc_data, cells_expression, vc_expression,
+                                          n_threads, engine=engine)
+    assignments = assign_vc(cells, vcs, distances, cells_expression.shape[0], vc_expression)
+    t_assign = time.time() - t0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((assignments, len(cells), t_assign, rss / 1024., (rss - rss_inputs) / 1024.))
+
+
+# compare run-time and peak memory of the distance engines for the assignment of cells to virtual cells,
+# each engine is run in a new process so that the memory peaks don't influence each other
+def benchmark_vc_assignments(seg_xml, seg_key, vc_xml, vc_key, vc_expression_path,
+                             med_expression_path, n_threads):
+    results = {}
+    for engine in ('per_vc', 'candidates'):
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_assign, args=(seg_xml, seg_key, vc_xml, vc_key,
+                                                          vc_expression_path, med_expression_path,
+                                                          n_threads, engine, queue))
+        p.start()
+        assignments, n_candidates, t_assign, rss, rss_increase = queue.get()
+        p.join()
+        results[engine] = assignments
+        results[engine + '_time'] = t_assign
+        print(engine, ": assigned", assignments.shape[0], "cells with", n_candidates, "candidates in",
+              t_assign, "s, peak memory", rss, "MB, increase after loading the inputs", rss_increase, "MB")
+    print("Speed-up:", results['per_vc_time'] / results['candidates_time'])
+    print("Assignments are identical:", np.array_equal(results['per_vc'], results['candidates']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seg_xml', type=str,
+                        default='../../data/0.6.2/images/local/sbem-6dpf-1-whole-segmented-cells.xml')
+    parser.add_argument('--seg_key', type=str, default='setup0/timepoint0/s4')
+    parser.add_argument('--vc_xml', type=str,
+                        default='../../data/0.6.2/images/local/prospr-6dpf-1-whole-virtual-cells.xml')
+    parser.add_argument('--vc_key', type=str, default='setup0/timepoint0/s0')
+    parser.add_argument('--vc_expression_path', type=str,
+                        default=('../../data/0.6.2/tables/prospr-6dpf-1-whole-virtual-cells/'
+                                 'profile_clust_curated.csv'))
+    parser.add_argument('--med_expression_path', type=str,
+                        default='../../data/0.6.2/tables/sbem-6dpf-1-whole-segmented-cells/genes.csv')
+    parser.add_argument('--n_threads', type=int, default=8)
+    args = parser.parse_args()
+    benchmark_vc_assignments(args.seg_xml, args.seg_key, args.vc_xml, args.vc_key,
+                             args.vc_expression_path, args.med_expression_path, args.n_threads)
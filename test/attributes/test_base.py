@@ -69,6 +69,32 @@ class TestBaseAttributes(unittest.TestCase):
                 pixel_size = int(row.n_pixels)
                 self.assertEqual(pixel_size, n_pixels)
 
+    def test_propagate_tables(self):
+        import json
+        import numpy as np
+        from mmpb.attributes.base_attributes import propagate_tables
+        os.makedirs(self.tmp_folder, exist_ok=True)
+
+        # ids 2 and 3 are merged into 2, 3 has the larger count and is kept; 4 is mapped to background
+        lut = {0: [0, 10], 1: [1, 5], 2: [2, 3], 3: [2, 7], 4: [0, 1], 5: [3, 4]}
+        lut_path = os.path.join(self.tmp_folder, 'lut.json')
+        with open(lut_path, 'w') as f:
+            json.dump(lut, f)
+
+        tables = []
+        for ii, column_name in enumerate(('label_id', 'cell_id')):
+            table_path = os.path.join(self.tmp_folder, 'table%i.csv' % ii)
+            output_path = os.path.join(self.tmp_folder, 'table%i_out.csv' % ii)
+            pandas.DataFrame({column_name: [0, 1, 2, 3, 4, 5, np.nan],
+                              'value': np.arange(7)}).to_csv(table_path, sep='\t', index=False)
+            tables.append((table_path, output_path, column_name))
+        propagate_tables(lut_path, tables, override=True)
+
+        for _, output_path, column_name in tables:
+            table = pandas.read_csv(output_path, sep='\t')
+            self.assertEqual(table['value'].tolist(), [0, 1, 3, 4, 5, 6])
+            self.assertEqual(table[column_name].tolist(), [0, 1, 2, 0, 3, 0])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -59,6 +59,63 @@ class TestCellNucleusMapping(unittest.TestCase):
         nucleus_ids, id_counts = nucleus_ids[1:], id_counts[1:]
         self.assertEqual(id_counts.sum(), id_counts.size)
 
+    @staticmethod
+    def overlap_dict(seg, values):
+        # the overlaps of all non-zero segment ids, as computed by 'node_labels' with ignore_label=0
+        overlaps = {}
+        for seg_id in np.unique(seg)[1:]:
+            ids, counts = np.unique(values[seg == seg_id], return_counts=True)
+            overlaps[int(seg_id)] = dict(zip(ids.tolist(), counts.tolist()))
+        return overlaps
+
+    @staticmethod
+    def dict_mapping(cids_to_nids, nids_to_cids, label_ids, overlap_threshold):
+        # the mapping of 'map_cells_to_nuclei' before the overlaps were computed in a single pass
+        def overlaps_to_ids(overlaps):
+            overlap_counts = {label_id: float(sum(ovlps.values())) for label_id, ovlps in overlaps.items()}
+            return {label_id: [ovlp_id for ovlp_id, ovlp in ovlps.items()
+                               if ((ovlp / overlap_counts[label_id]) > overlap_threshold) and (ovlp_id != 0)]
+                    for label_id, ovlps in overlaps.items()}
+
+        cids_to_nids = {label_id: ovlp_ids[0] for label_id, ovlp_ids in overlaps_to_ids(cids_to_nids).items()
+                        if len(ovlp_ids) == 1}
+        nids_to_cids = {label_id: ovlp_ids[0] for label_id, ovlp_ids in overlaps_to_ids(nids_to_cids).items()
+                        if len(ovlp_ids) == 1}
+        cids_to_nids = {label_id: ovlp_id for label_id, ovlp_id in cids_to_nids.items()
+                        if nids_to_cids.get(ovlp_id, 0) == label_id}
+        return np.array([cids_to_nids.get(label_id, 0) for label_id in label_ids])
+
+    def test_overlaps_to_nucleus_ids(self):
+        from mmpb.attributes.cell_nucleus_mapping import overlaps_to_nucleus_ids
+        from mmpb.attributes.util import OverlapMatrix
+        from mmpb.extension.attributes.region_overlaps_impl import region_overlaps
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        path = os.path.join(self.tmp_folder, 'data.h5')
+
+        # cells on a grid of 8x8x8 voxels, some of them are removed
+        shape = (32, 64, 64)
+        np.random.seed(42)
+        grid = np.indices(shape)
+        cells = (grid[0] // 8) * 64 + (grid[1] // 8) * 8 + grid[2] // 8 + 1
+        cells[np.isin(cells, np.random.choice(cells.max(), 40, replace=False) + 1)] = 0
+        # nuclei on a shifted grid of 7x7x7 voxels, so that they overlap with one or several cells
+        # and partially with the cell background, some of them are removed
+        nuclei = ((grid[0] + 1) // 7) * 121 + ((grid[1] + 2) // 7) * 11 + (grid[2] + 3) // 7 + 1
+        nuclei[np.isin(nuclei, np.random.choice(nuclei.max(), nuclei.max() // 4, replace=False) + 1)] = 0
+        with h5py.File(path, 'a') as f:
+            f.create_dataset('cells', data=cells.astype('uint32'), chunks=(16, 32, 32))
+            f.create_dataset('nuclei', data=nuclei.astype('uint32'), chunks=(16, 32, 32))
+        label_ids = np.arange(cells.max() + 1, dtype='uint64')
+
+        overlaps = region_overlaps(path, 'cells', [path], ['nuclei'], block_shape=(16, 32, 32))[0]
+        overlaps = OverlapMatrix.from_pairs(*overlaps)
+        for overlap_threshold in (.1, .25, .5):
+            expected = self.dict_mapping(self.overlap_dict(cells, nuclei), self.overlap_dict(nuclei, cells),
+                                         label_ids, overlap_threshold)
+            result = overlaps_to_nucleus_ids(overlaps, label_ids, overlap_threshold)
+            self.assertGreater((expected != 0).sum(), 0)
+            self.assertTrue(np.array_equal(result, expected))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 import pandas as pd
 
 
@@ -17,6 +18,34 @@ class TestCilaAttributes(unittest.TestCase):
         out, _ = measure_cilia_attributes(input_path, input_key, base, resolution)
         self.assertEqual(len(out), len(base))
 
+    def test_longest_path(self):
+        from mmpb.attributes.cilia_attributes import longest_path
+
+        # synthetic tree: a line along x with a branch along y at x = 5 and a branch along z at x = 12
+        nodes = [(0, 0, x) for x in range(20)]
+        nodes += [(0, y, 5) for y in range(1, 9)]
+        nodes += [(z, 0, 12) for z in range(1, 4)]
+        node_ids = {node: node_id for node_id, node in enumerate(nodes)}
+        edges = [(node_ids[(0, 0, x)], node_ids[(0, 0, x + 1)]) for x in range(19)]
+        edges += [(node_ids[(0, y - 1, 5)], node_ids[(0, y, 5)]) for y in range(1, 9)]
+        edges += [(node_ids[(z - 1, 0, 12)], node_ids[(z, 0, 12)]) for z in range(1, 4)]
+        # a second, shorter tree that is not connected to the first one
+        offset = len(nodes)
+        nodes += [(10, 10, x) for x in range(10)]
+        edges += [(offset + x, offset + x + 1) for x in range(9)]
+        nodes, edges = np.array(nodes), np.array(edges)
+
+        # the longest path goes from the tip of the z branch to the tip of the y branch
+        resolution = [25, 10, 10]
+        path, length = longest_path(nodes, edges, resolution)
+        self.assertAlmostEqual(length, 3 * 25 + 7 * 10 + 8 * 10, places=3)
+        self.assertEqual(sorted([path[0], path[-1]]), sorted([node_ids[(3, 0, 12)], node_ids[(0, 8, 5)]]))
+
+        # closing a cycle in the second tree must not change the result
+        edges = np.concatenate([edges, [[offset, offset + 9]]])
+        _, length = longest_path(nodes, edges, resolution)
+        self.assertAlmostEqual(length, 3 * 25 + 7 * 10 + 8 * 10, places=3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -58,6 +58,78 @@ class TestGeneAttributes(unittest.TestCase):
         self.assertEqual(table.shape, original_table.shape)
         self.assertTrue(np.allclose(table, original_table))
 
+    def test_streamed_expression(self):
+        from mmpb.extension.attributes.genes_impl import get_cell_expression
+        shape = (32, 32, 32)
+        segmentation = np.random.randint(0, 50, size=shape).astype('uint16')
+        all_genes = np.random.rand(10, *shape) > .5
+
+        labels, expression = get_cell_expression(segmentation, all_genes, 4)
+        # load 3 genes at once
+        max_memory = 3 * all_genes[0].nbytes
+        labels_streamed, expression_streamed = get_cell_expression(segmentation, all_genes, 4,
+                                                                   max_memory=max_memory)
+        self.assertTrue(np.array_equal(labels, labels_streamed))
+        self.assertEqual(expression.dtype, expression_streamed.dtype)
+        self.assertTrue(np.array_equal(expression, expression_streamed))
+
+    def test_expression_engines(self):
+        from mmpb.extension.attributes.genes_impl import get_cell_expression
+        shape = (32, 32, 32)
+        segmentation = np.random.randint(0, 50, size=shape).astype('uint16')
+        all_genes = np.random.rand(10, *shape) > .5
+
+        labels, expression = get_cell_expression(segmentation, all_genes, 4, engine='per_cell')
+        labels_bincount, expression_bincount = get_cell_expression(segmentation, all_genes, 4,
+                                                                   engine='bincount')
+        self.assertTrue(np.array_equal(labels, labels_bincount))
+        self.assertTrue(np.array_equal(expression, expression_bincount))
+
+    def test_packed_genes(self):
+        import h5py
+        from mmpb.extension.attributes.genes_impl import open_genes
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        n_genes = 13
+        all_genes = np.random.rand(n_genes, 16, 16, 16) > .5
+        path = os.path.join(self.tmp_folder, 'genes.h5')
+        with h5py.File(path, 'a') as f:
+            ds = f.create_dataset('genes_packed', data=np.packbits(all_genes, axis=0))
+            ds.attrs['n_genes'] = n_genes
+
+        with h5py.File(path, 'r') as f:
+            genes = open_genes(f)
+            self.assertEqual(genes.shape, all_genes.shape)
+            self.assertTrue(np.array_equal(genes[:], all_genes))
+            self.assertTrue(np.array_equal(genes[3:11], all_genes[3:11]))
+            # single genes, also with numpy integers, e.g. from iterating over an index array
+            for gene_id in np.arange(n_genes):
+                self.assertTrue(np.array_equal(genes[gene_id], all_genes[gene_id]))
+            self.assertTrue(np.array_equal(genes[-1], all_genes[-1]))
+            with self.assertRaises(IndexError):
+                genes[n_genes]
+
+    def test_gene_index(self):
+        import pandas as pd
+        from mmpb.analysis.expression import _cells_from_table, GeneIndex
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        n_cells, gene_names = 1000, ['a', 'b', 'c']
+        expression = np.random.rand(n_cells, len(gene_names))
+        expression[expression < .5] = 0
+        table = pd.DataFrame(expression, columns=gene_names)
+        table.insert(0, 'label_id', np.arange(n_cells))
+        table_path = os.path.join(self.tmp_folder, 'genes.csv')
+        table.to_csv(table_path, sep='\t', index=False)
+
+        index = GeneIndex.from_table(table_path)
+        for threshold in (0., .6, .9):
+            expected = _cells_from_table(table_path, threshold, ['a', 'b'])
+            self.assertTrue(np.array_equal(index.query(['a', 'b'], expression_threshold=threshold), expected))
+
+        # cells expressing a and b, but not c, with gene specific thresholds
+        table = pd.read_csv(table_path, sep='\t')
+        expected = table['label_id'][(table['a'] > .6) & (table['b'] > .7) & ~(table['c'] > .8)].values
+        self.assertTrue(np.array_equal(index.query({'a': .6, 'b': .7}, {'c': .8}), expected))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -30,6 +30,276 @@ class TestMorphologyAttributes(unittest.TestCase):
         with open(os.path.join(config_folder, 'global.config'), 'w') as f:
             json.dump(conf, f)
 
+    def test_balanced_label_ranges(self):
+        from mmpb.extension.attributes.morphology_impl import balanced_label_ranges
+        number_of_labels = 1000
+        label_ids = np.arange(1, number_of_labels)
+        costs = np.random.lognormal(0, 3, size=len(label_ids))
+
+        n_jobs = 25
+        label_ranges = balanced_label_ranges(label_ids, costs, number_of_labels, n_jobs)
+        self.assertLessEqual(len(label_ranges), n_jobs)
+
+        # the ranges must cover all labels without gaps
+        self.assertEqual(label_ranges[0][0], 0)
+        self.assertEqual(label_ranges[-1][1], number_of_labels)
+        for (_, stop), (start, _) in zip(label_ranges[:-1], label_ranges[1:]):
+            self.assertEqual(stop, start)
+
+        # the most expensive job must not be more expensive than the most
+        # expensive job when splitting into ranges with the same number of labels
+        label_costs = np.zeros(number_of_labels)
+        label_costs[label_ids] = costs
+        max_cost = max(label_costs[start:stop].sum() for start, stop in label_ranges)
+        ids_per_job = number_of_labels // n_jobs
+        max_cost_equal = max(label_costs[start:start + ids_per_job].sum()
+                             for start in range(0, number_of_labels, ids_per_job))
+        self.assertLessEqual(max_cost, max_cost_equal)
+
+    def test_generate_column_names(self):
+        from mmpb.extension.attributes.morphology_impl import generate_column_names, INTENSITY_COLUMNS
+
+        # all feature families for nuclei: 1 id, 8 shape, 5 intensity, 20 radial intensity,
+        # 13 texture and 34 columns for each of the two chromatin phases
+        columns = generate_column_names('raw.n5', 'chromatin.n5', None)
+        self.assertEqual(len(columns), 115)
+        self.assertEqual(columns[:2], ['label_id', 'shape_volume_in_microns'])
+        self.assertEqual(columns[-1], 'texture_hara13_eu')
+
+        # all feature families for cells, no radial intensity because the nucleus is excluded
+        columns = generate_column_names('raw.n5', None, 'nuclei.n5')
+        self.assertEqual(len(columns), 27)
+
+        columns = generate_column_names('raw.n5', 'chromatin.n5', None,
+                                        feature_families=['intensity'])
+        self.assertEqual(columns, ['label_id'] + INTENSITY_COLUMNS)
+
+        columns = generate_column_names('raw.n5', 'chromatin.n5', None,
+                                        feature_families=['chromatin', 'intensity'])
+        self.assertEqual(len(columns), 1 + 5 + 2 * (8 + 5))
+
+        with self.assertRaises(ValueError):
+            generate_column_names('raw.n5', None, None, feature_families=['volume'])
+
+    def test_voxel_face_surface_area(self):
+        from mmpb.extension.attributes.morphology_impl import voxel_face_surface_area
+
+        # sphere with a radius of 20 micron at an anisotropic resolution
+        radius = 20
+        z, y, x = np.mgrid[-12:13, -25:26, -25:26]
+        sphere = ((2 * z) ** 2 + y ** 2 + x ** 2) <= radius ** 2
+        surface_area = voxel_face_surface_area(sphere, [2., 1., 1.])
+        expected = 4 * np.pi * radius ** 2
+        self.assertLess(abs(surface_area - expected) / expected, 0.02)
+
+    def test_checkpoint_chunks(self):
+        from mmpb.extension.attributes.morphology import checkpoint_chunks
+        self.assertEqual(checkpoint_chunks(0, 2500, 1000), [(0, 1000), (1000, 2000), (2000, 2500)])
+        self.assertEqual(checkpoint_chunks(1500, 3000, 1000), [(1500, 2000), (2000, 3000)])
+        self.assertEqual(checkpoint_chunks(1500, 3000, None), [(1500, 3000)])
+
+    def test_checkpoint_config_hash(self):
+        from mmpb.extension.attributes.morphology import checkpoint_config_hash
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        table_path = os.path.join(self.tmp_folder, 'table.csv')
+        config = {'in_table_path': table_path, 'scale': 3}
+
+        with open(table_path, 'w') as f:
+            f.write('label_id\tn_pixels\n1\t100\n')
+        config_hash = checkpoint_config_hash(config)
+        self.assertEqual(checkpoint_config_hash(config), config_hash)
+        self.assertNotEqual(checkpoint_config_hash(dict(config, scale=4)), config_hash)
+
+        # a regenerated table at the same path must not re-use the checkpoints
+        with open(table_path, 'w') as f:
+            f.write('label_id\tn_pixels\n1\t200\n')
+        self.assertNotEqual(checkpoint_config_hash(config), config_hash)
+
+    def test_batched_haralick(self):
+        from mahotas.features import haralick
+        from mmpb.extension.attributes.texture_impl import batched_haralick
+
+        # random objects of different sizes, including one that is too small for
+        # the texture features, which are set to zero in this case
+        np.random.seed(42)
+        crops = []
+        for size in (8, 12, 16, 20, 24):
+            crop = np.random.randint(0, 64, size=(size, size + 3, size + 5)).astype('uint8')
+            crop[:size // 4] = 0
+            crops.append(crop)
+        crops.append(np.ones((1, 1, 1), dtype='uint8'))
+
+        features = batched_haralick(crops)
+        self.assertEqual(features.shape, (len(crops), 13))
+        for crop, feats in zip(crops[:-1], features[:-1]):
+            expected = haralick(crop, ignore_zeros=True, return_mean=True, distance=2)
+            self.assertTrue(np.allclose(feats, expected))
+        self.assertTrue(np.allclose(features[-1], 0))
+
+    def make_synthetic_cells(self):
+        # synthetic cells made of boxes with random raw data and nuclei inside of the cells
+        import h5py
+        import pandas as pd
+        from mmpb.extension.attributes.morphology_impl import get_keys
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        np.random.seed(42)
+
+        shape = (48, 96, 96)
+        seg = np.zeros(shape, dtype='uint32')
+        nuclei = np.zeros(shape, dtype='uint32')
+        raw = np.random.randint(0, 256, size=shape).astype('uint8')
+        mapping = []
+        for label_id, (z, y, x) in enumerate([(0, 0, 0), (0, 0, 48), (0, 48, 0),
+                                              (24, 48, 48), (24, 0, 48)], 1):
+            seg[z:z + 20, y:y + 40, x:x + 44] = label_id
+            # the last cell does not have a nucleus and is filtered by the nucleus mapping
+            if label_id < 5:
+                nuclei[z + 5:z + 15, y + 10:y + 30, x + 10:x + 30] = label_id + 100
+                mapping.append([label_id, label_id + 100])
+        # the bounding box of the second cell contains a part of the last cell
+        seg[20:28, 0:40, 48:60] = 2
+
+        rows = []
+        for label_id in range(1, 6):
+            coords = np.where(seg == label_id)
+            rows.append([label_id, len(coords[0])] + [c.min() for c in coords] + [c.max() for c in coords])
+
+        paths = {}
+        for name, data in (('cells', seg), ('raw', raw), ('nuclei', nuclei)):
+            path = os.path.join(self.tmp_folder, '%s.h5' % name)
+            with h5py.File(path, 'w') as f:
+                f.create_dataset(get_keys(path, 0)[1], data=data, chunks=(16, 32, 32))
+            paths[name] = path
+
+        columns = ['label_id', 'n_pixels', 'bb_min_z', 'bb_min_y', 'bb_min_x',
+                   'bb_max_z', 'bb_max_y', 'bb_max_x']
+        table = pd.DataFrame(np.array(rows, dtype='float64'), columns=columns)
+        paths['mapping'] = os.path.join(self.tmp_folder, 'mapping.csv')
+        mapping = pd.DataFrame(mapping, columns=['label_id', 'nucleus_id'])
+        mapping.to_csv(paths['mapping'], sep='\t', index=False)
+        return seg, raw, nuclei, table, paths
+
+    def test_intensity_statistics(self):
+        from mmpb.extension.attributes.intensity_impl import intensity_statistics
+        from mmpb.extension.attributes.morphology_impl import get_keys, intensity_row_features
+        seg, raw, nuclei, _, paths = self.make_synthetic_cells()
+        key = get_keys(paths['cells'], 0)[1]
+        label_ids = np.arange(1, 6)
+        nucleus_ids = np.array([101, 102, 103, 104, 0])
+
+        for exclude in (False, True):
+            exclude_path = paths['nuclei'] if exclude else None
+            table = intensity_statistics(paths['cells'], key, paths['raw'], key, label_ids,
+                                         exclude_path=exclude_path, exclude_key=key,
+                                         exclude_ids=nucleus_ids if exclude else None,
+                                         block_shape=(16, 32, 32), n_threads=4)
+            self.assertTrue(np.array_equal(table['label_id'].values, label_ids))
+            for label_id, nucleus_id, stats in zip(label_ids, nucleus_ids, table.values[:, 1:]):
+                mask = seg == label_id
+                if exclude and nucleus_id != 0:
+                    mask[nuclei == nucleus_id] = False
+                self.assertTrue(np.allclose(stats, intensity_row_features(raw, mask)))
+
+        # the segmentation is resampled with nearest neighbor if its shape does not agree with the raw data
+        key_low = get_keys(paths['cells'], 1)[1]
+        seg_low = seg[::2, ::2, ::2]
+        import h5py
+        with h5py.File(paths['cells'], 'a') as f:
+            f.create_dataset(key_low, data=seg_low)
+        table = intensity_statistics(paths['cells'], key_low, paths['raw'], key, label_ids,
+                                     block_shape=(16, 32, 32), n_threads=4)
+        seg_up = seg_low.repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+        for label_id, stats in zip(label_ids, table.values[:, 1:]):
+            self.assertTrue(np.allclose(stats, intensity_row_features(raw, seg_up == label_id)))
+
+    def test_batched_loading(self):
+        import h5py
+        from mmpb.extension.attributes.morphology_impl import (filter_table_from_mapping, get_keys,
+                                                               load_data, make_batches,
+                                                               morphology_features_for_label_range,
+                                                               morphology_features_for_row)
+        _, _, _, table, paths = self.make_synthetic_cells()
+        table = filter_table_from_mapping(table, paths['mapping'])
+
+        # load the bounding box of each row separately, like before the batched loading
+        class RowLoader:
+            def __init__(self, ds, scale):
+                self.ds, self.scale = ds, scale
+
+            def load_data(self, row):
+                return load_data(self.ds, row, self.scale)
+
+        res = [1., 1., 1.]
+        max_batch_voxels = 200000
+        self.assertLess(len(make_batches(table, res, (16, 32, 32), max_batch_voxels)), len(table))
+
+        key = get_keys(paths['cells'], 0)[1]
+        files = [h5py.File(paths[name], 'r') for name in ('cells', 'raw', 'nuclei')]
+        try:
+            ds, ds_raw, ds_nuclei = [f[key] for f in files]
+            # with the nucleus excluded and without, which also computes the radial intensity features
+            for ds_exclude in (ds_nuclei, None):
+                batched = morphology_features_for_label_range(table, ds, ds_raw, None, ds_exclude,
+                                                              res, res, None, res, 0, 6,
+                                                              max_batch_voxels=max_batch_voxels,
+                                                              surface_area_mode='voxel_faces',
+                                                              batched_texture=False)
+                exclude_loader = None if ds_exclude is None else RowLoader(ds_exclude, res)
+                per_row = [morphology_features_for_row(row, RowLoader(ds, res), RowLoader(ds_raw, res),
+                                                       None, exclude_loader, res, res, None,
+                                                       surface_area_mode='voxel_faces')
+                           for row in table.itertuples(index=False)]
+                self.assertEqual(len(batched), len(table))
+                self.assertTrue(np.array_equal(np.array(batched), np.array(per_row), equal_nan=True))
+        finally:
+            for f in files:
+                f.close()
+
+    def test_blockwise_intensity_engine(self):
+        from mmpb.extension.attributes.morphology_impl import morphology_impl_cell
+        _, _, _, table, paths = self.make_synthetic_cells()
+
+        res = [1., 1., 1.]
+        results = []
+        for engine in ('per_row', 'blockwise'):
+            stats = morphology_impl_cell(paths['cells'], paths['raw'], paths['nuclei'], table,
+                                         paths['mapping'], None, 0, None, None,
+                                         res, res, res, 0, 0, 0, 0, 6,
+                                         feature_families=['shape', 'intensity', 'texture'],
+                                         surface_area_mode='voxel_faces', intensity_engine=engine)
+            results.append(stats)
+        per_row, blockwise = results
+        self.assertEqual(list(per_row.columns), list(blockwise.columns))
+        self.assertTrue(np.array_equal(per_row['label_id'].values, [1, 2, 3, 4]))
+        self.assertTrue(np.allclose(per_row.values, blockwise.values))
+
+    def test_blockwise_intensity_engine_scales(self):
+        import h5py
+        from mmpb.extension.attributes.morphology_impl import get_keys, morphology_impl_cell
+        _, raw, _, table, paths = self.make_synthetic_cells()
+        # the raw data at half the resolution of the segmentation, like for the cells in the workflow
+        with h5py.File(paths['raw'], 'a') as f:
+            f.create_dataset(get_keys(paths['raw'], 1)[1], data=raw[::2, ::2, ::2])
+
+        res = [1., 1., 1.]
+        results = []
+        for engine in ('per_row', 'blockwise'):
+            stats = morphology_impl_cell(paths['cells'], paths['raw'], paths['nuclei'], table,
+                                         paths['mapping'], None, 0, None, None,
+                                         res, res, res, 0, 1, 0, 0, 6,
+                                         feature_families=['intensity'], intensity_engine=engine)
+            results.append(stats)
+        per_row, blockwise = results
+        self.assertTrue(np.array_equal(per_row['label_id'].values, blockwise['label_id'].values))
+
+        # the engines only differ in the voxels at the object boundaries,
+        # which changes the number of voxels and the total intensity by a few percent
+        # and the other statistics by a few grey values
+        for name in ('intensity_mean', 'intensity_st_dev', 'intensity_median', 'intensity_iqr'):
+            self.assertTrue(np.allclose(per_row[name].values, blockwise[name].values, rtol=0, atol=2), name)
+        self.assertTrue(np.allclose(per_row['intensity_total'].values, blockwise['intensity_total'].values,
+                                    rtol=0.05))
+
     def test_nucleus_morphology(self):
         from mmpb.attributes.morphology import write_morphology_nuclei
         from mmpb.extension.attributes import MorphologyWorkflow
@@ -100,6 +100,193 @@ class TestRegions(unittest.TestCase):
                           seg_path, seg_key,
                           tissue_path, tissue_key)
 
+    def test_region_overlaps(self):
+        from mmpb.extension.attributes.region_overlaps_impl import (max_overlap_labels, overlap_dict,
+                                                                    region_overlaps)
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        path = os.path.join(self.tmp_folder, 'data.h5')
+        shape = (32, 64, 64)
+        seg = np.random.randint(0, 100, size=shape).astype('uint64')
+        regions = [np.random.randint(0, 4, size=shape).astype('uint8'),
+                   255 * (np.random.rand(*shape) > .5).astype('uint8')]
+        with h5py.File(path, 'a') as f:
+            f.create_dataset('seg', data=seg)
+            for ii, region in enumerate(regions):
+                f.create_dataset('region%i' % ii, data=region)
+
+        overlaps = region_overlaps(path, 'seg', [path, path], ['region0', 'region1'],
+                                   block_shape=(16, 32, 32), n_threads=4)
+        self.assertEqual(len(overlaps), len(regions))
+        for region, region_overlap in zip(regions, overlaps):
+            # check against the overlaps computed for each segment separately
+            overlaps_per_seg = overlap_dict(*region_overlap)
+            labels = max_overlap_labels(*region_overlap, n_labels=100)
+            for seg_id in range(100):
+                region_ids, counts = np.unique(region[seg == seg_id], return_counts=True)
+                expected = dict(zip(region_ids.tolist(), counts.tolist()))
+                self.assertEqual(overlaps_per_seg[seg_id], expected)
+                self.assertEqual(labels[seg_id], region_ids[np.argmax(counts)])
+
+    def test_region_overlaps_rerun(self):
+        from glob import glob
+        from mmpb.attributes.util import region_overlaps
+        from mmpb.extension.attributes.region_overlaps_impl import region_overlaps as region_overlaps_impl
+        config_folder = os.path.join(self.tmp_folder, 'configs')
+        os.makedirs(config_folder, exist_ok=True)
+        conf = NodeLabelWorkflow.get_config()['global']
+        shebang = '#! /g/kreshuk/pape/Work/software/conda/miniconda3/envs/cluster_env37/bin/python'
+        conf.update({'shebang': shebang, 'block_shape': [16, 32, 32]})
+        with open(os.path.join(config_folder, 'global.config'), 'w') as f:
+            json.dump(conf, f)
+
+        path = os.path.join(self.tmp_folder, 'data.h5')
+        shape = (32, 64, 64)
+        with h5py.File(path, 'a') as f:
+            f.create_dataset('seg', data=np.random.randint(0, 100, size=shape).astype('uint64'))
+            f.create_dataset('region', data=np.random.randint(0, 4, size=shape).astype('uint8'))
+        expected = region_overlaps_impl(path, 'seg', [path], ['region'], block_shape=(16, 32, 32))[0]
+
+        # run again in the same tmp folder with less jobs,
+        # the job results of the first run must not be merged into the results of the second run
+        for max_jobs in (8, 2):
+            for log_path in glob(os.path.join(self.tmp_folder, 'region_overlaps_*.log')):
+                os.remove(log_path)
+            overlaps = region_overlaps(path, 'seg', [path], ['region'], 'test',
+                                       self.tmp_folder, 'local', max_jobs, use_cache=False)[0]
+            for result, expected_result in zip(overlaps, expected):
+                self.assertTrue(np.array_equal(result, expected_result))
+
+    def test_max_overlap_labels_node_labels(self):
+        from mmpb.attributes.util import node_labels
+        from mmpb.extension.attributes.region_overlaps_impl import max_overlap_labels, region_overlaps
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        path = os.path.join(self.tmp_folder, 'data.h5')
+
+        # segments of 4x4x4 voxels with a majority region,
+        # except for every third segment, which is split evenly between the regions 2 and 4
+        shape = (32, 64, 64)
+        seg = np.arange(1, np.prod([sh // 4 for sh in shape]) + 1, dtype='uint64')
+        seg = seg.reshape([sh // 4 for sh in shape]).repeat(4, axis=0).repeat(4, axis=1).repeat(4, axis=2)
+        n_labels = int(seg.max()) + 1
+        region = np.random.randint(1, 5, size=n_labels).astype('uint8')[seg]
+        minority = np.arange(shape[2]) % 4 == 3
+        region[:, :, minority] = np.random.randint(0, 5, size=(32, 64, 16))
+        tie_ids = np.arange(3, n_labels, 3)
+        is_tie = np.isin(seg, tie_ids)
+        region[np.logical_and(is_tie, np.arange(shape[2]) % 4 < 2)] = 4
+        region[np.logical_and(is_tie, np.arange(shape[2]) % 4 >= 2)] = 2
+        with h5py.File(path, 'a') as f:
+            ds = f.create_dataset('seg', data=seg, chunks=(16, 32, 32))
+            ds.attrs['maxId'] = n_labels - 1
+            f.create_dataset('region', data=region, chunks=(16, 32, 32))
+
+        config_folder = os.path.join(self.tmp_folder, 'configs')
+        os.makedirs(config_folder, exist_ok=True)
+        conf = NodeLabelWorkflow.get_config()['global']
+        shebang = '#! /g/kreshuk/pape/Work/software/conda/miniconda3/envs/cluster_env37/bin/python'
+        conf.update({'shebang': shebang, 'block_shape': [16, 32, 32]})
+        with open(os.path.join(config_folder, 'global.config'), 'w') as f:
+            json.dump(conf, f)
+        expected = node_labels(path, 'seg', path, 'region', 'region', self.tmp_folder,
+                               'local', 4, max_overlap=True, use_cache=False)
+        overlaps = region_overlaps(path, 'seg', [path], ['region'], block_shape=(16, 32, 32), n_threads=4)
+        labels = max_overlap_labels(*overlaps[0], n_labels=n_labels)
+        self.assertEqual(len(expected), n_labels)
+
+        # the labels agree for all segments without ties
+        no_tie = np.ones(n_labels, dtype='bool')
+        no_tie[tie_ids] = False
+        self.assertTrue(np.array_equal(labels[no_tie], expected[no_tie]))
+        # for ties, node labels picks one of the tied regions and we pick the smaller region id
+        self.assertTrue(np.isin(expected[tie_ids], [2, 4]).all())
+        self.assertTrue((labels[tie_ids] == 2).all())
+
+    def test_overlap_matrix(self):
+        from mmpb.attributes.util import OverlapMatrix, normalize_overlap_dict
+        overlaps = {1: {0: 10, 2: 30}, 2: {3: 5, 4: 5}, 4: {0: 1, 2: 1, 5: 8}}
+        matrix = OverlapMatrix.from_dict(overlaps)
+        self.assertEqual(matrix.n_labels, 5)
+        self.assertEqual(matrix.to_dict(), overlaps)
+
+        normalized = normalize_overlap_dict(overlaps)
+        fraction = matrix.overlap_fraction(2)
+        for label_id in range(matrix.n_labels):
+            self.assertAlmostEqual(fraction[label_id], normalized.get(label_id, {}).get(2, 0.))
+
+        # ties are resolved by the smaller id
+        self.assertEqual(matrix.max_overlap().tolist(), [0, 2, 3, 0, 5])
+        self.assertEqual(matrix.max_overlap(ignore_label=5).tolist(), [0, 2, 3, 0, 0])
+        self.assertEqual(matrix.unique_overlap(.25).tolist(), [0, 2, 0, 0, 5])
+        self.assertEqual(matrix.unique_overlap(.5, ignore_label=0).tolist(), [0, 2, 0, 0, 5])
+
+        # the overlap with the ignore label counts for the normalization, but is never a candidate,
+        # e.g. segment 1 is 80% background and 20% region 2, so it is not mapped for threshold .25;
+        # compare with the dict based mapping that was used in 'map_cells_to_nuclei'
+        overlaps = {1: {0: 80, 2: 20}, 2: {0: 20, 3: 80}, 3: {0: 50, 2: 30, 4: 20}, 4: {0: 100}, 6: {5: 3}}
+        matrix = OverlapMatrix.from_dict(overlaps)
+        for overlap_threshold in (.1, .25, .5):
+            expected = {label_id: [ovlp_id for ovlp_id, ovlp in ovlps.items()
+                                   if ovlp / sum(ovlps.values()) > overlap_threshold and ovlp_id != 0]
+                        for label_id, ovlps in overlaps.items()}
+            expected = [expected[label_id][0] if len(expected.get(label_id, [])) == 1 else 0
+                        for label_id in range(matrix.n_labels)]
+            self.assertEqual(matrix.unique_overlap(overlap_threshold, ignore_label=0).tolist(), expected)
+        self.assertEqual(matrix.unique_overlap(.25, ignore_label=0).tolist(), [0, 0, 3, 2, 0, 0, 5])
+
+    def test_dataset_fingerprint(self):
+        from mmpb.attributes.util import dataset_fingerprint
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        path = os.path.join(self.tmp_folder, 'data.h5')
+        with h5py.File(path, 'a') as f:
+            f.create_dataset('data', data=np.zeros((10, 10), dtype='uint8'))
+        fingerprint = dataset_fingerprint(path, 'data')
+        self.assertEqual(fingerprint, dataset_fingerprint(path, 'data'))
+
+        # the fingerprint is the same for a link to the data
+        link_path = os.path.join(self.tmp_folder, 'link.h5')
+        os.symlink(os.path.abspath(path), link_path)
+        self.assertEqual(fingerprint, dataset_fingerprint(link_path, 'data'))
+
+        # the fingerprint changes if the data changes
+        with h5py.File(path, 'a') as f:
+            f.create_dataset('more_data', data=np.ones((100, 100), dtype='uint8'))
+        self.assertNotEqual(fingerprint, dataset_fingerprint(path, 'data'))
+
+    def test_dataset_fingerprint_n5(self):
+        from mmpb.attributes.util import dataset_fingerprint
+        path = os.path.join(self.tmp_folder, 'data.n5')
+        chunk_folder = os.path.join(path, 'data', '0')
+        os.makedirs(chunk_folder)
+        attrs_path = os.path.join(path, 'data', 'attributes.json')
+        with open(attrs_path, 'w') as f:
+            json.dump({'dimensions': [10, 10], 'blockSize': [5, 5], 'dataType': 'uint8'}, f)
+        with open(os.path.join(chunk_folder, '0'), 'wb') as f:
+            f.write(b'0')
+        # move the modification times to the past, so that writing a chunk changes them
+        os.utime(chunk_folder, ns=(0, 0))
+        os.utime(os.path.join(chunk_folder, '0'), ns=(0, 0))
+        fingerprint = dataset_fingerprint(path, 'data')
+        self.assertEqual(fingerprint, dataset_fingerprint(path, 'data'))
+
+        # the fingerprint changes if a chunk is rewritten in place, which doesn't change the chunk folder
+        with open(os.path.join(chunk_folder, '0'), 'r+b') as f:
+            f.write(b'2')
+        self.assertEqual(os.stat(chunk_folder).st_mtime_ns, 0)
+        new_fingerprint = dataset_fingerprint(path, 'data')
+        self.assertNotEqual(fingerprint, new_fingerprint)
+        fingerprint = new_fingerprint
+
+        # the fingerprint changes if a chunk is added
+        with open(os.path.join(chunk_folder, '1'), 'wb') as f:
+            f.write(b'1')
+        new_fingerprint = dataset_fingerprint(path, 'data')
+        self.assertNotEqual(fingerprint, new_fingerprint)
+
+        # the fingerprint changes if the attributes change
+        with open(attrs_path, 'w') as f:
+            json.dump({'dimensions': [20, 10], 'blockSize': [5, 5], 'dataType': 'uint8'}, f)
+        self.assertNotEqual(new_fingerprint, dataset_fingerprint(path, 'data'))
+
 
 # this indeed fails for the glands, whereas the unittest above passes
 def check_external():
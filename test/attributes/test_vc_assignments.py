@@ -0,0 +1,62 @@
+import unittest
+import sys
+import numpy as np
+sys.path.append('../..')
+
+
+# check that the distance engines for the vc assignments agree on a small synthetic volume
+class TestVCAssignments(unittest.TestCase):
+
+    # vcs 2 and 3 have the same expression, so cells with this expression are tied between them
+    vc_expression = np.array([[0, 0, 0],
+                              [1, 0, 0],
+                              [0, 1, 1],
+                              [0, 1, 1],
+                              [1, 1, 1]], dtype='float64')
+
+    cells_expression = np.array([[0, 0, 0],
+                                 [0, 1, 1],
+                                 [1, 0, 0],
+                                 [1, 1, 1],
+                                 [1, 1, 1],
+                                 [1, 1, 0]], dtype='float64')
+
+    def make_volumes(self):
+        shape = (4, 20, 40)
+        vc_data = np.zeros(shape, dtype='uint32')
+        vc_data[:, :, :8] = 1
+        vc_data[:, :, 10:14] = 2
+        vc_data[:, :, 14:18] = 3
+        vc_data[:, :, 30:] = 4
+
+        em_data = np.zeros(shape, dtype='uint16')
+        # cell 1 overlaps with vcs 2 and 3
+        em_data[:, 2:6, 11:17] = 1
+        # cell 2 lies in vc 1
+        em_data[:, 10:14, 1:5] = 2
+        # cell 3 has no vc within the offset
+        em_data[:, 10:14, 22:26] = 3
+        # cell 4 is not in the volume, e.g. because it was lost in downsampling
+        # cell 5 is within the offset of vc 4
+        em_data[:, 10:14, 27:29] = 5
+        return em_data, vc_data
+
+    def test_distance_engines(self):
+        from mmpb.extension.attributes.vc_assignments_impl import assign_vc, get_distances
+        em_data, vc_data = self.make_volumes()
+        num_cells = self.cells_expression.shape[0]
+
+        results = {}
+        for engine in ('candidates', 'per_vc'):
+            cells, vcs, distances = get_distances(em_data, vc_data, self.cells_expression,
+                                                  self.vc_expression, 1, offset=2, engine=engine)
+            results[engine] = assign_vc(cells, vcs, distances, num_cells, self.vc_expression)
+        self.assertTrue(np.array_equal(results['candidates'], results['per_vc']))
+
+        # ties are assigned to the smaller vc id, cells without vcs within the offset to 0
+        expected = [0, 2, 1, 0, 0, 4]
+        self.assertEqual(results['candidates'][:, -2].tolist(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
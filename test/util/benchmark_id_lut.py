@@ -0,0 +1,52 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+from mmpb.util import apply_id_lut, binary_id_lut_path, convert_id_lut, load_id_lut
+
+
+def _load_and_map(lut_path, prefer_binary, n_ids, queue):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    old_ids, new_ids, _ = load_id_lut(lut_path, prefer_binary=prefer_binary)
+    t_load = time.time() - t0
+    # map some random ids, like when propagating the ids of bookmarks or tables
+    ids = old_ids[np.random.randint(0, len(old_ids), size=n_ids)]
+    apply_id_lut(old_ids, new_ids, ids)
+    t_total = time.time() - t0
+    # ru_maxrss is given in kilobytes on linux
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((t_load, t_total, (rss_after - rss_before) / 1024.))
+
+
+# compare load time and resident memory for the json and the binary id look-up table,
+# each measurement is done in a new process so that the memory peaks don't influence each other
+def benchmark_id_lut(lut_path, n_ids, n_repeats):
+    if not os.path.exists(binary_id_lut_path(lut_path)):
+        print("Converting", lut_path, "to binary look-up table")
+        convert_id_lut(lut_path)
+
+    for name, prefer_binary in (('json', False), ('binary', True)):
+        results = []
+        for _ in range(n_repeats):
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=_load_and_map, args=(lut_path, prefer_binary, n_ids, queue))
+            p.start()
+            results.append(queue.get())
+            p.join()
+        t_load, t_total, rss = np.median(np.array(results), axis=0)
+        print(name, ": load", t_load, "s, load and map", n_ids, "ids", t_total, "s,",
+              "resident memory increase", rss, "MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lut_path', type=str,
+                        default='../../data/1.0.0/misc/new_id_lut_sbem-6dpf-1-whole-segmented-cells.json')
+    parser.add_argument('--n_ids', type=int, default=1000)
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+    benchmark_id_lut(args.lut_path, args.n_ids, args.n_repeats)
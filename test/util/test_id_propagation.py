@@ -52,6 +52,100 @@ class TestIdPropagation(unittest.TestCase):
         self.assertEqual(len(expected_ids), len(mapped_ids))
         self.assertEqual(set(expected_ids), set(mapped_ids))
 
+    def test_binary_id_lut(self):
+        import json
+        import os
+        from shutil import rmtree
+        import numpy as np
+        from mmpb.util import (binary_id_lut_is_current, binary_id_lut_path,
+                               convert_id_lut, load_id_lut, write_id_lut)
+
+        tmp_folder = 'tmp_id_lut'
+        os.makedirs(tmp_folder, exist_ok=True)
+        lut_path = os.path.join(tmp_folder, 'new_id_lut_test.json')
+        lut = np.array([[0, 10], [3, 5], [1, 2], [3, 7]], dtype='uint64')
+        try:
+            write_id_lut(lut, lut_path)
+            self.assertTrue(os.path.exists(binary_id_lut_path(lut_path)))
+            from_json = load_id_lut(lut_path, prefer_binary=False)
+            from_binary = load_id_lut(lut_path)
+            for val_json, val_binary in zip(from_json, from_binary):
+                self.assertTrue(np.array_equal(val_json, val_binary))
+                self.assertEqual(val_json.dtype, val_binary.dtype)
+            self.assertTrue(np.array_equal(from_binary[1], lut[:, 0]))
+
+            # a version that links to the table shares the binary table
+            link_path = os.path.join(tmp_folder, 'link', 'new_id_lut_test.json')
+            os.makedirs(os.path.dirname(link_path))
+            os.symlink(os.path.abspath(lut_path), link_path)
+            self.assertEqual(binary_id_lut_path(link_path), binary_id_lut_path(lut_path))
+
+            # update the json table only, the stale binary table must not be used
+            # and is only rebuilt by 'convert_id_lut'
+            new_lut = np.array([[0, 10], [2, 5], [1, 2], [4, 7]], dtype='uint64')
+            with open(lut_path, 'w') as f:
+                json.dump(dict(zip(range(len(new_lut)), new_lut.tolist())), f)
+            json_mtime = os.stat(lut_path).st_mtime
+            os.utime(binary_id_lut_path(lut_path), (json_mtime - 10, json_mtime - 10))
+            self.assertFalse(binary_id_lut_is_current(lut_path))
+            self.assertTrue(np.array_equal(load_id_lut(link_path)[1], new_lut[:, 0]))
+            self.assertFalse(binary_id_lut_is_current(lut_path))
+            self.assertTrue(np.array_equal(np.load(binary_id_lut_path(lut_path)), lut))
+
+            convert_id_lut(link_path)
+            self.assertTrue(binary_id_lut_is_current(lut_path))
+            self.assertTrue(np.array_equal(np.load(binary_id_lut_path(lut_path)), new_lut))
+            self.assertEqual(os.listdir(os.path.dirname(link_path)), ['new_id_lut_test.json'])
+        finally:
+            rmtree(tmp_folder)
+
+    def test_composed_id_lut_cache(self):
+        import json
+        import os
+        from glob import glob
+        from shutil import rmtree
+        import numpy as np
+        from mmpb.util import propagate_ids, write_id_lut
+
+        tmp_folder = os.path.abspath('tmp_composed_lut')
+        cache_folder = os.path.join(tmp_folder, 'cache')
+        name = 'test-segmentation'
+        versions = ['0.0.0', '0.1.0', '0.2.0']
+        luts = {'0.1.0': np.array([0, 2, 1, 4, 3], dtype='uint64'),
+                '0.2.0': np.array([0, 3, 1, 2, 5], dtype='uint64')}
+        os.makedirs(tmp_folder, exist_ok=True)
+        old_cache_folder = os.environ.get('PLATYBROWSER_CACHE_DIR', None)
+        os.environ['PLATYBROWSER_CACHE_DIR'] = cache_folder
+        try:
+            with open(os.path.join(tmp_folder, 'versions.json'), 'w') as f:
+                json.dump(versions, f)
+            for version in versions:
+                os.makedirs(os.path.join(tmp_folder, version, 'misc'))
+            lut_paths = {version: os.path.join(tmp_folder, version, 'misc', 'new_id_lut_%s.json' % name)
+                         for version in versions}
+            write_id_lut(np.arange(5, dtype='uint64'), lut_paths['0.0.0'])
+            for version, lut in luts.items():
+                write_id_lut(lut, lut_paths[version])
+
+            ids = [1, 2, 3, 4]
+            mapped = propagate_ids(tmp_folder, '0.0.0', '0.2.0', name, ids)
+            self.assertEqual(mapped, [1, 3, 5, 2])
+            self.assertEqual(len(glob(os.path.join(cache_folder, '*.npz'))), 1)
+            # the second call uses the cached look-up table
+            self.assertEqual(propagate_ids(tmp_folder, '0.0.0', '0.2.0', name, ids), mapped)
+            self.assertEqual(len(glob(os.path.join(cache_folder, '*.npz'))), 1)
+
+            # changing a look-up table invalidates the cache
+            write_id_lut(np.array([0, 1, 2, 3, 4, 6], dtype='uint64'), lut_paths['0.2.0'])
+            self.assertEqual(propagate_ids(tmp_folder, '0.0.0', '0.2.0', name, ids), [2, 1, 4, 3])
+            self.assertEqual(len(glob(os.path.join(cache_folder, '*.npz'))), 2)
+        finally:
+            if old_cache_folder is None:
+                os.environ.pop('PLATYBROWSER_CACHE_DIR')
+            else:
+                os.environ['PLATYBROWSER_CACHE_DIR'] = old_cache_folder
+            rmtree(tmp_folder)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -94,6 +94,8 @@ def update_tables(folder, new_folder,
         copy_tables(folder, new_folder, table_folder)
 
     # now update all tables that need to be updated
+    # and keep track of the overlap results that were loaded from the cache
+    cache_hits = {}
     for name in names_to_update:
         properties = image_dict[name]
         table_folder = properties.get("TableFolder", None)
@@ -107,9 +109,12 @@ def update_tables(folder, new_folder,
         paintera_path, paintera_key = properties['PainteraProject']
         resolution = read_resolution(paintera_path, paintera_key, to_um=True)
         seg_has_changed = name in seg_update_names
-        update_function(folder, new_folder, name, tmp_folder, resolution,
-                        target=target, max_jobs=max_jobs,
-                        seg_has_changed=seg_has_changed)
+        table_cache_hits = update_function(folder, new_folder, name, tmp_folder, resolution,
+                                           target=target, max_jobs=max_jobs,
+                                           seg_has_changed=seg_has_changed)
+        if table_cache_hits is not None:
+            cache_hits.update({'%s: %s' % (name, key): hit for key, hit in table_cache_hits.items()})
+    return cache_hits
 
 
 def check_requested_updates(names_to_update, folder):
@@ -169,8 +174,13 @@ def update_patch(update_seg_names, update_table_names,
                                      target=target, max_jobs=max_jobs)
 
     # generate new attribute tables
-    update_tables(folder, new_folder, table_updates, update_seg_names,
-                  target=target, max_jobs=max_jobs)
+    cache_hits = update_tables(folder, new_folder, table_updates, update_seg_names,
+                               target=target, max_jobs=max_jobs)
+    # report which overlaps could be reused from previous releases
+    reused = [name for name, hit in cache_hits.items() if hit]
+    print("Overlap cache:", len(reused), "hits,", len(cache_hits) - len(reused), "misses")
+    for name in reused:
+        print("Reused cached overlaps for", name)
 
     # copy image dict and check that all image and table files are there
     copy_and_check_image_dict(folder, new_folder)